@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+# Compares results pages with every alignment embedded against pages listing
+# hits only, with alignments fetched on demand from the alignment store, for
+# the primer pairs designed from a fasta file. Reports page size and the time
+# taken to produce the page once blast results are available.
+#
+# Requires blastn and the named database to be available via BLASTDB.
+
+import argparse
+import os.path
+import sys
+import tempfile
+import time
+from Bio import SeqIO
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)) + '/../uwsgi')
+import RNAit  # noqa: E402
+
+parser = argparse.ArgumentParser(
+    description="Benchmark embedded and on-demand alignments in RNAit results pages")
+parser.add_argument(
+    '-fasta',
+    help='Query fasta file',
+    default=os.path.dirname(os.path.realpath(__file__)) +
+    '/../databases/multiple_self_hits.fa')
+parser.add_argument('-db', help='Database name', default='TbruceiTREU927')
+parser.add_argument('-max_hits', help='Hits listed per category', type=int, default=50)
+parser.add_argument('-repeats', help='Number of timed runs', type=int, default=5)
+args = parser.parse_args()
+
+RNAit_dir = os.path.dirname(os.path.realpath(__file__)) + '/..'
+params = {
+    'seq': SeqIO.read(args.fasta, 'fasta'),
+    'database': args.db,
+    'melting_temp': 60,
+    'product_min': 400,
+    'product_max': 600,
+    'string_min': 89,
+    'string_max': 99,
+    'subunit_length': 20,
+}
+primers, blast_results, error = RNAit.get_screened_pairs(params, {})
+if error:
+    sys.exit(error)
+for pair in primers:
+    pair['PRODUCT'] = RNAit.get_formatted_product(
+        str(params.get('seq').seq), pair.get('LEFT_START'), pair.get('RIGHT_START'))
+
+hits = 0
+for blast_result in blast_results:
+    for key in ('self_alignments', 'conflicting_alignments', 'matching_alignments'):
+        hits += len(blast_result.get(key))
+print("%s primer pairs, %s hits listed" % (len(primers), hits))
+
+with tempfile.TemporaryDirectory() as tmp_dir:
+    configs = (
+        ('embedded', {'RNAit_dir': RNAit_dir}),
+        ('on demand', {'RNAit_dir': RNAit_dir, 'alignments': {
+            'store': tmp_dir + '/alignments.sqlite'}}),
+        ('on demand, %s hits' % args.max_hits, {'RNAit_dir': RNAit_dir, 'alignments': {
+            'store': tmp_dir + '/alignments.sqlite', 'max_hits': args.max_hits}}),
+    )
+    for name, config in configs:
+        RNAit.hit_alignment_store = None
+        start = time.time()
+        for i in range(args.repeats):
+            alignment_options = RNAit.get_alignment_options(config)
+            for j, blast_result in enumerate(blast_results):
+                RNAit.store_alignments(config, alignment_options, j + 1, blast_result)
+            html = RNAit.get_output_page(RNAit.get_query_info(params), primers,
+                                         RNAit_dir, blast_results, alignment_options)
+        print("%s: page %s bytes; %.3fs per page (mean of %s)" % (
+            name, len(html), (time.time() - start) / args.repeats, args.repeats))
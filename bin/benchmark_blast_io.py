@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+# Compares blastn query/result handling under concurrent load: the original
+# approach of writing the query to a temporary directory and having blastn
+# write its output there, against piping the query to blastn's stdin and
+# reading results from its stdout as RNAit now does.
+#
+# Requires blastn and the named database to be available via BLASTDB.
+
+import argparse
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from Bio import SeqIO
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)) + '/../uwsgi')
+import RNAit  # noqa: E402
+
+parser = argparse.ArgumentParser(
+    description="Benchmark blastn temporary file and pipe I/O under concurrent load")
+parser.add_argument(
+    '-fasta',
+    help='Query fasta file',
+    default=os.path.dirname(os.path.realpath(__file__)) +
+    '/../databases/TbruceiTREU927_multihit_test.fa')
+parser.add_argument('-db', help='Database name', default='TbruceiTREU927')
+parser.add_argument('-concurrency', help='Concurrent searches', type=int, default=8)
+parser.add_argument('-requests', help='Total searches per method', type=int, default=32)
+args = parser.parse_args()
+
+params = {
+    'seq': SeqIO.read(args.fasta, 'fasta'),
+    'product_min': 400,
+    'product_max': 600,
+    'melting_temp': 60,
+}
+primers, error = RNAit.get_primer_pairs(params, format_product=False)
+if error:
+    sys.exit(error)
+queries = []
+for i, pair in enumerate(primers):
+    product = RNAit.get_pcr_product(params.get('seq'), pair)
+    queries.append(RNAit.SeqRecord(product.seq, id='product_' + str(i), description=''))
+outfmt = '6 ' + ' '.join(RNAit.tabular_fields)
+
+
+def tempfile_search():
+    blast_dir = tempfile.mkdtemp()
+    try:
+        SeqIO.write(queries, blast_dir + '/query', 'fasta')
+        subprocess.check_call(['blastn', '-task', 'blastn', '-db', args.db,
+                               '-outfmt', outfmt, '-query', blast_dir + '/query',
+                               '-out', blast_dir + '/output'])
+        with open(blast_dir + '/output') as result_handle:
+            return(result_handle.read())
+    finally:
+        shutil.rmtree(blast_dir)
+
+
+def pipe_search():
+    blast_output, error = RNAit.run_blast(queries, args.db)
+    if error:
+        raise RuntimeError(error)
+    return(blast_output)
+
+
+outputs = {}
+for name, search in (('tempfile', tempfile_search), ('pipe', pipe_search)):
+    latencies = []
+
+    def timed_search(i):
+        start = time.time()
+        output = search()
+        latencies.append(time.time() - start)
+        return(output)
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(timed_search, range(args.requests)))
+    elapsed = time.time() - start
+    outputs[name] = results[0]
+    print("%s: %.2f searches/s; mean latency %.3fs (%s searches, concurrency %s)" % (
+        name, args.requests / elapsed, sum(latencies) / len(latencies),
+        args.requests, args.concurrency))
+
+if outputs['tempfile'] != outputs['pipe']:
+    sys.exit("blastn output differs between methods")
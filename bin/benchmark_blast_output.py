@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+# Compares blastn XML and tabular output pipelines for the PCR products
+# designed from a fasta file, checking both produce the same classification
+# and reporting time spent in blastn and in parsing/classifying the output.
+#
+# Requires blastn and the named database to be available via BLASTDB.
+
+import argparse
+import io
+import os.path
+import sys
+import time
+from Bio import SeqIO
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)) + '/../uwsgi')
+import RNAit  # noqa: E402
+
+parser = argparse.ArgumentParser(
+    description="Benchmark blast output formats for RNAit")
+parser.add_argument(
+    '-fasta',
+    help='Query fasta file',
+    default=os.path.dirname(os.path.realpath(__file__)) +
+    '/../databases/TbruceiTREU927_multihit_test.fa')
+parser.add_argument('-db', help='Database name', default='TbruceiTREU927')
+parser.add_argument('-repeats', help='Number of timed runs', type=int, default=5)
+args = parser.parse_args()
+
+params = {
+    'seq': SeqIO.read(args.fasta, 'fasta'),
+    'product_min': 400,
+    'product_max': 600,
+    'melting_temp': 60,
+}
+primers, error = RNAit.get_primer_pairs(params)
+if error:
+    sys.exit(error)
+products = []
+for pair in primers:
+    products.append(RNAit.get_pcr_product(params.get('seq'), pair))
+
+summaries = {}
+for blast_format in ('xml', 'tabular'):
+    blast_time = 0
+    parse_time = 0
+    output_size = 0
+    for i in range(args.repeats):
+        queries = []
+        for j, product in enumerate(products):
+            queries.append(RNAit.SeqRecord(product.seq, id='product_' + str(j),
+                                           description=''))
+
+        start = time.time()
+        blast_output, error = RNAit.run_blast(
+            queries, args.db, blast_format=blast_format)
+        if error:
+            sys.exit(error)
+        blast_time += time.time() - start
+
+        start = time.time()
+        if blast_format == 'tabular':
+            blast_records = RNAit.parse_tabular_blast(blast_output, queries)
+        else:
+            blast_records = {}
+            for blast_record in RNAit.NCBIXML.parse(io.StringIO(blast_output)):
+                blast_records[blast_record.query.split()[0]] = blast_record
+        blast_results = []
+        for query in queries:
+            blast_results.append(RNAit.classify_blast_record(
+                blast_records[query.id], 89, 99, 20))
+        parse_time += time.time() - start
+        output_size = len(blast_output)
+
+    summary = []
+    for blast_result in blast_results:
+        summary.append((
+            blast_result['primer_status'],
+            [hit['description'] for hit in blast_result['self_alignments']],
+            [hit['description'] for hit in blast_result['conflicting_alignments']],
+            [hit['description'] for hit in blast_result['matching_alignments']],
+        ))
+    summaries[blast_format] = summary
+
+    print("%s: %s products; output %s bytes; blastn %.3fs; parse/classify %.3fs (mean of %s)" % (
+        blast_format, len(products), output_size, blast_time / args.repeats,
+        parse_time / args.repeats, args.repeats))
+
+if summaries['xml'] == summaries['tabular']:
+    print("Classification identical")
+else:
+    sys.exit("Classification differs between xml and tabular output")
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+# Compares the original product highlighting and alignment formatting, which
+# rewrapped the query with textwrap and rebuilt the highlighted sequence by
+# string concatenation for every primer pair, with the current versions which
+# wrap the query once and join each pair's lines in a single pass. Random
+# queries of each -lengths size are formatted for -pairs primer pairs, and the
+# outputs of the two versions are checked to be identical.
+
+import argparse
+import os.path
+import random
+import sys
+import textwrap
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)) + '/../uwsgi')
+import RNAit  # noqa: E402
+
+parser = argparse.ArgumentParser(
+    description="Benchmark RNAit product highlighting and alignment formatting")
+parser.add_argument('-lengths', help='Comma separated query lengths',
+                    default='10000,20000,50000')
+parser.add_argument('-pairs', help='Primer pairs per query', type=int, default=5)
+parser.add_argument('-repeats', help='Number of timed runs', type=int, default=5)
+parser.add_argument('-seed', help='Random seed', type=int, default=1)
+args = parser.parse_args()
+
+
+def original_get_formatted_product(seq, start, end):
+
+    lines = textwrap.wrap(seq, width=60)
+    count = 0
+    formatted_seq = ''
+    for line in lines:
+        max_length = count + 60
+        line_start = count
+        count = count + len(line)
+        num_spaces = max_length - count + 4
+        spaces = '&nbsp;' * num_spaces
+
+        if(start > line_start and start < count):
+            offset = start - line_start
+            left_flank = line[:offset]
+            product = line[offset:]
+            line = "%s%s%s%s" % (
+                left_flank, '<span style="color:red">', product, '</span>')
+
+        if(end > line_start and start < line_start and end > count):
+            line = "%s%s%s" % ('<span style="color:red">', line, '</span>')
+
+        if(end > line_start and end <= count):
+            offset = end - line_start
+            product = line[:offset + 1]
+            right_flank = line[offset + 1:]
+            line = "%s%s%s%s" % ('<span style="color:red">',
+                                 product, '</span>', right_flank)
+
+        formatted_seq = "%s%s%s%s<br/>" % (formatted_seq, line, spaces, count)
+
+    return(formatted_seq)
+
+
+def original_format_alignment(hsp):
+    query_start = hsp.get('query_start')
+    sbjct_start = hsp.get('sbjct_start')
+    offset = 0
+    alignment_lines = []
+
+    line = "Score: %.2f; bits: %.2f; e-value: %.2f\n" % (
+        hsp.get('score'), hsp.get('bits'), hsp.get('expect'))
+    alignment_lines.append(line)
+    alignment_lines.append("\n")
+
+    for i in range(0, hsp.get('align_length'), 75):
+
+        qline = ("Query: %s %s" %
+                 (str(query_start + offset).rjust(4), hsp.get('query')[i:i + 75]))
+        midline = ("            %s" % (hsp.get('match')[i:i + 75]))
+        hline = ("Sbjct: %s %s" %
+                 (str(sbjct_start + offset).rjust(4), hsp.get('sbjct')[i:i + 75]))
+
+        alignment_lines.append(qline)
+        alignment_lines.append(midline)
+        alignment_lines.append(hline)
+        alignment_lines.append('')
+        offset += 75
+
+    alignment = "<br/>".join(alignment_lines)
+    alignment = alignment.replace(' ', '&nbsp;')
+    return(alignment)
+
+
+def original_products(seq, pairs):
+    return([original_get_formatted_product(seq, start, end) for start, end in pairs])
+
+
+def current_products(seq, pairs):
+    seq_lines = RNAit.get_wrapped_sequence(seq)
+    return([RNAit.get_formatted_product(None, start, end, seq_lines) for start, end in pairs])
+
+
+def timed(function, *function_args):
+    start = time.perf_counter()
+    for i in range(args.repeats):
+        output = function(*function_args)
+    return(output, (time.perf_counter() - start) / args.repeats)
+
+
+rand = random.Random(args.seed)
+for length in [int(value) for value in args.lengths.split(',')]:
+    seq = ''.join(rand.choice('ACGT') for i in range(length))
+    pairs = []
+    for i in range(args.pairs):
+        start = rand.randrange(0, length - 600)
+        pairs.append((start, start + rand.randrange(400, 600)))
+
+    original, original_time = timed(original_products, seq, pairs)
+    current, current_time = timed(current_products, seq, pairs)
+    if original != current:
+        sys.exit("Highlighted products differ for %sbp query" % length)
+    print("products, %sbp query, %s pairs: original %.2fms, current %.2fms" % (
+        length, args.pairs, original_time * 1000, current_time * 1000))
+
+    sbjct = ''.join(base if rand.random() < 0.9 else rand.choice('ACGT') for base in seq)
+    hsp = {
+        'score': 1000, 'bits': 900.5, 'expect': 0.0, 'query_start': 1,
+        'sbjct_start': 1, 'align_length': length, 'query': seq, 'sbjct': sbjct,
+        'match': RNAit.get_midline(seq, sbjct),
+    }
+    original, original_time = timed(original_format_alignment, hsp)
+    current, current_time = timed(RNAit.format_alignment, hsp)
+    if original != current:
+        sys.exit("Formatted alignments differ for %sbp alignment" % length)
+    print("alignment, %sbp: original %.2fms, current %.2fms" % (
+        length, original_time * 1000, current_time * 1000))
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+# Measures the memory used by a query: the size of the screening results kept
+# alive from blast until the results page is rendered, the peak allocated
+# while screening and rendering (both from tracemalloc), and the growth in
+# peak RSS of the process over a number of untraced runs, as seen by a uWSGI
+# worker serving them in turn.
+#
+# Requires blastn and the named database to be available via BLASTDB.
+
+import argparse
+import gc
+import json
+import os.path
+import resource
+import sys
+import tracemalloc
+from Bio import SeqIO
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)) + '/../uwsgi')
+import RNAit  # noqa: E402
+
+parser = argparse.ArgumentParser(
+    description="Measure the memory used by an RNAit query")
+parser.add_argument(
+    '-fasta',
+    help='Query fasta file',
+    default=os.path.dirname(os.path.realpath(__file__)) +
+    '/../databases/multiple_self_hits.fa')
+parser.add_argument('-db', help='Database name', default='TbruceiTREU927')
+parser.add_argument('-repeats', help='Number of untraced runs', type=int, default=5)
+parser.add_argument('-blast_format', help="blastn output, 'tabular' or 'xml'", default='tabular')
+args = parser.parse_args()
+
+RNAit_dir = os.path.dirname(os.path.realpath(__file__)) + '/..'
+params = {
+    'seq': SeqIO.read(args.fasta, 'fasta'),
+    'database': args.db,
+    'melting_temp': 60,
+    'product_min': 400,
+    'product_max': 600,
+    'string_min': 89,
+    'string_max': 99,
+    'subunit_length': 20,
+}
+config = {'blast_format': args.blast_format}
+
+# run_query
+#
+# Screens the query and renders its results page, as run_query does
+#
+# optional args: snapshot - function called once the pairs are screened, while
+#                           their results are still held for rendering
+#
+# returns: page - HTML page
+
+
+def run_query(snapshot=None):
+    primers, blast_results, error = RNAit.get_screened_pairs(params, config)
+    if error:
+        sys.exit(error)
+    if snapshot:
+        snapshot()
+    return(RNAit.get_output_page(RNAit.get_query_info(params), primers, RNAit_dir,
+                                 blast_results))
+
+
+# the first run loads templates and primer3, which aren't per request
+run_query()
+gc.collect()
+start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+for i in range(args.repeats):
+    run_query()
+end_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+gc.collect()
+sizes = {}
+tracemalloc.start()
+start = tracemalloc.get_traced_memory()[0]
+run_query(lambda: sizes.update(held=tracemalloc.get_traced_memory()[0] - start))
+sizes['peak'] = tracemalloc.get_traced_memory()[1] - start
+tracemalloc.stop()
+
+print(json.dumps({
+    'query': params.get('seq').id,
+    'held_bytes': sizes.get('held'),
+    'peak_bytes': sizes.get('peak'),
+    'max_rss_kb': end_rss,
+    'max_rss_growth_kb': end_rss - start_rss,
+}, indent=2))
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+# Measures the fixed per-request overhead of loading configuration and
+# rendering templates, comparing the original approach (parse RNAit.yaml and
+# build a new jinja Environment on every request) with the cached worker-level
+# configuration and template environments.
+
+import argparse
+import os.path
+import sys
+import time
+import yaml
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)) + '/../uwsgi')
+import RNAit  # noqa: E402
+
+parser = argparse.ArgumentParser(
+    description="Benchmark RNAit per-request configuration and template overhead")
+parser.add_argument('-requests', help='Number of simulated requests', type=int, default=1000)
+args = parser.parse_args()
+
+RNAit_dir = os.path.dirname(os.path.realpath(__file__)) + '/..'
+config_file = RNAit_dir + '/uwsgi/RNAit.yaml'
+query_info = {
+    'query_seq': 'Tb927.1.120:mRNA',
+    'query_length': 2571,
+    'melting_temp': 60,
+    'product_size': '400-600',
+    'database': 'TbruceiTREU927',
+    'stringency': '89 - 99',
+    'subunit_length': 20,
+}
+
+
+def uncached_request():
+    with open(config_file) as s:
+        yaml.safe_load(s)
+    for template_name in ('error_page.html', 'result_page.html'):
+        env = Environment(
+            loader=FileSystemLoader(RNAit_dir + '/templates'), autoescape=select_autoescape(['html', 'xml'])
+        )
+        template = env.get_template(template_name)
+        template.render(error='benchmark', type='runtime', query_info=query_info,
+                        primers=[], blast=[]).encode('UTF-8')
+
+
+def cached_request():
+    RNAit.get_config()
+    RNAit.get_error_page(RNAit_dir, 'benchmark', 'runtime')
+    RNAit.get_output_page(query_info, [], RNAit_dir, [])
+
+
+for name, request in (('uncached', uncached_request), ('cached', cached_request)):
+    # warm up, so the cached case measures steady state
+    request()
+    start = time.time()
+    for i in range(args.requests):
+        request()
+    elapsed = time.time() - start
+    print("%s: %.1f us per request (%s requests)" % (
+        name, elapsed / args.requests * 1000000, args.requests))
@@ -0,0 +1,396 @@
+#!/usr/bin/env python
+
+# Benchmarks the primer design and blast screening pipeline on a corpus of CDS
+# queries drawn from a blast database, and reports the results as JSON so they
+# can be compared across commits.
+#
+# The corpus is a fixed-seed sample of the database's sequences, stratified by
+# length (short, medium and long thirds) and by repeat content (the fraction of
+# each sequence's 15-mers found more than once in the database, split at the
+# median within each length band). With -corpus, the sample is saved to that
+# file on the first run and read back on later runs, so every commit is
+# measured on the same queries.
+#
+# Two sets of measurements are made:
+#
+#   stages - each stage of a query timed separately: get_primer_pairs,
+#            get_formatted_product, blast_product, format_alignment and
+#            rendering of the results page
+#   wsgi   - latency and throughput of complete query form submissions, driven
+#            in-process through application() at each -concurrency level.
+#            Requests run on threads, where uWSGI would use worker processes,
+#            so these show contention for blastn and the GIL within one worker.
+#
+# The application is run with the configuration given by -config, less its
+# result_cache, primer_cache, atlas and metrics sections (unless -keep_caches
+# is given) so that every request does the full work, and always less its
+# admission section, as in-process requests all come from the same client and
+# would be turned away at higher concurrency levels rather than measured.
+# Requires blastn and the named database to be available via BLASTDB, as for
+# bin/build_atlas.py.
+
+import argparse
+import io
+import json
+import os
+import os.path
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+import numpy as np
+import yaml
+from concurrent.futures import ThreadPoolExecutor
+from wsgiref.util import setup_testing_defaults
+from Bio import SeqIO
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)) + '/../uwsgi')
+import RNAit  # noqa: E402
+import kmer_index  # noqa: E402
+
+RNAit_dir = os.path.realpath(os.path.dirname(os.path.realpath(__file__)) + '/..')
+
+# build_corpus
+#
+# Samples the queries to benchmark from a database fasta file
+#
+# required args: fasta - database fasta file (string)
+#                per_stratum - number of sequences from each stratum (int)
+#                min_length - shortest sequence to include (int)
+#                seed - random seed (int)
+#
+# returns: corpus - list of Bio.seqRecord objects, with the stratum and repeat
+#                   fraction in their descriptions
+
+
+def build_corpus(fasta, per_stratum, min_length, seed):
+    records = [record for record in SeqIO.parse(fasta, 'fasta')
+               if len(record.seq) >= min_length]
+    if not records:
+        sys.exit("No sequences of at least %sbp in %s" % (min_length, fasta))
+
+    # count each 15-mer across the whole database
+    all_kmers = []
+    for record in records:
+        kmers, valid = kmer_index.get_kmers(str(record.seq))
+        all_kmers.append(kmers[valid])
+    unique_kmers, kmer_counts = np.unique(np.concatenate(all_kmers), return_counts=True)
+
+    measured = []
+    for record, kmers in zip(records, all_kmers):
+        repeat_fraction = 0.0
+        if len(kmers):
+            counts = kmer_counts[np.searchsorted(unique_kmers, kmers)]
+            repeat_fraction = float(np.mean(counts > 1))
+        measured.append((len(record.seq), repeat_fraction, record))
+    measured.sort(key=lambda entry: (entry[0], entry[2].id))
+
+    rand = random.Random(seed)
+    corpus = []
+    band_size = -(-len(measured) // 3)
+    for band, name in enumerate(('short', 'medium', 'long')):
+        band_records = sorted(measured[band * band_size:(band + 1) * band_size],
+                              key=lambda entry: (entry[1], entry[2].id))
+        half = len(band_records) // 2
+        for repeat, stratum_records in (('low', band_records[:half]),
+                                        ('high', band_records[half:])):
+            chosen = rand.sample(stratum_records, min(per_stratum, len(stratum_records)))
+            for length, repeat_fraction, record in chosen:
+                record.description = "stratum=%s/%s repeat_fraction=%.4f" % (
+                    name, repeat, repeat_fraction)
+                corpus.append(record)
+    return(corpus)
+
+# get_corpus_info
+#
+# required args: record - Bio.seqRecord object from build_corpus
+#
+# returns: info - dictionary of id, length, stratum and repeat fraction
+
+
+def get_corpus_info(record):
+    info = {'id': record.id, 'length': len(record.seq)}
+    for field in record.description.split()[1:]:
+        name, sep, value = field.partition('=')
+        if name == 'stratum':
+            info['stratum'] = value
+        elif name == 'repeat_fraction':
+            info['repeat_fraction'] = float(value)
+    return(info)
+
+# summarise
+#
+# required args: times - list of durations in seconds
+#
+# returns: summary - dictionary of call count and total, mean, median, 95th
+#                    percentile and maximum durations
+
+
+def summarise(times):
+    if not times:
+        return({'calls': 0})
+    ordered = sorted(times)
+    summary = {
+        'calls': len(times),
+        'total': sum(times),
+        'mean': statistics.mean(times),
+        'median': statistics.median(times),
+        'p95': ordered[min(len(ordered) - 1, int(round(0.95 * (len(ordered) - 1))))],
+        'max': ordered[-1],
+    }
+    return(summary)
+
+# time_stages
+#
+# Runs each stage of a query in turn, timing every call
+#
+# required args: record - query Bio.seqRecord object
+#                query_params - dictionary of query parameters
+#                config - dictionary of configuration settings
+#                times - dictionary of stage name to list of durations, added to
+#
+# returns: counts - dictionary of primer pairs, hits and errors for the query
+
+
+def time_stages(record, query_params, config, times):
+    params = dict(query_params)
+    params['seq'] = record
+    pool_socket = (config.get('blast_pool') or {}).get('socket')
+    counts = {'pairs': 0, 'hits': 0, 'errors': 0}
+
+    start = time.perf_counter()
+    primers, error = RNAit.get_primer_pairs(params, format_product=False)
+    times['get_primer_pairs'].append(time.perf_counter() - start)
+    if error or not primers:
+        counts['errors'] += 1
+        return(counts)
+    counts['pairs'] = len(primers)
+
+    seq = str(record.seq)
+    for pair in primers:
+        start = time.perf_counter()
+        pair['PRODUCT'] = RNAit.get_formatted_product(
+            seq, pair.get('LEFT_START'), pair.get('RIGHT_START'))
+        times['get_formatted_product'].append(time.perf_counter() - start)
+
+    blast_results = []
+    for pair in primers:
+        product = RNAit.get_pcr_product(record, pair)
+        start = time.perf_counter()
+        blast_result, error = RNAit.blast_product(
+            product, query_params.get('database'), query_params.get('string_min'),
+            query_params.get('string_max'), query_params.get('subunit_length'), pool_socket)
+        times['blast_product'].append(time.perf_counter() - start)
+        if error:
+            counts['errors'] += 1
+            return(counts)
+        blast_results.append(blast_result)
+
+    for blast_result in blast_results:
+        for key in ('self_alignments', 'conflicting_alignments', 'matching_alignments'):
+            for alignment in blast_result.get(key):
+                counts['hits'] += 1
+                for hsp in alignment.get('hsp_alignments'):
+                    start = time.perf_counter()
+                    RNAit.format_alignment(hsp)
+                    times['format_alignment'].append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    RNAit.get_output_page(RNAit.get_query_info(params), primers, RNAit_dir, blast_results)
+    times['render'].append(time.perf_counter() - start)
+    return(counts)
+
+# wsgi_request
+#
+# Submits a query to the application as the query form would, reading the
+# whole streamed response
+#
+# required args: record - query Bio.seqRecord object
+#                query_params - dictionary of query parameters
+#
+# returns: seconds - request wall time (float)
+#          status - response status line (string)
+#          size - response size in bytes (int)
+
+
+def wsgi_request(record, query_params):
+    fields = dict(query_params)
+    fields['seqpaste'] = ">%s\n%s\n" % (record.id, record.seq)
+    body = urllib.parse.urlencode(fields).encode('UTF-8')
+    environ = {
+        'REQUEST_METHOD': 'POST',
+        'PATH_INFO': '/RNAit/query',
+        'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.input': io.BytesIO(body),
+    }
+    setup_testing_defaults(environ)
+    status = []
+
+    def start_response(status_line, headers, exc_info=None):
+        status.append(status_line)
+
+    start = time.perf_counter()
+    size = 0
+    response = RNAit.application(environ, start_response)
+    try:
+        for piece in response:
+            size += len(piece)
+    finally:
+        if hasattr(response, 'close'):
+            response.close()
+    return(time.perf_counter() - start, status[-1] if status else None, size)
+
+# get_revision
+#
+# returns: revision - git commit of the working tree, None if unavailable
+
+
+def get_revision():
+    try:
+        revision = subprocess.check_output(
+            ['git', '-C', RNAit_dir, 'rev-parse', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode('UTF-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return(None)
+    return(revision)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Benchmark RNAit primer design and blast screening, reporting JSON")
+    parser.add_argument('-db', help='Database name', default='TbruceiTREU927')
+    parser.add_argument('-fasta', help='Database fasta file (default: <BLASTDB>/<db>)')
+    parser.add_argument(
+        '-config',
+        help='RNAit configuration file',
+        default=RNAit_dir + '/uwsgi/RNAit.yaml')
+    parser.add_argument('-corpus', help='Corpus fasta file, created if it does not exist')
+    parser.add_argument('-per_stratum', type=int, default=2,
+                        help='Sequences sampled from each length/repeat stratum')
+    parser.add_argument('-min_length', type=int, default=700,
+                        help='Shortest database sequence to sample')
+    parser.add_argument('-seed', type=int, default=1, help='Corpus sampling seed')
+    parser.add_argument('-repeats', type=int, default=3,
+                        help='Number of times each query is run through the stages')
+    parser.add_argument('-concurrency', default='1,2,4,8',
+                        help='Comma separated concurrency levels for WSGI requests')
+    parser.add_argument('-requests', type=int,
+                        help='WSGI requests per concurrency level (default: corpus size)')
+    parser.add_argument('-keep_caches', action='store_true',
+                        help='Leave the result and primer caches and atlas configured')
+    parser.add_argument('-label', help='Label stored with the results, e.g. a branch name')
+    parser.add_argument('-output', help='JSON output file (default: stdout)')
+    args = parser.parse_args()
+
+    with open(args.config) as s:
+        config = yaml.safe_load(s)
+    config['RNAit_dir'] = RNAit_dir
+    # admission control would turn most concurrent requests away as busy
+    config.pop('admission', None)
+    if not args.keep_caches:
+        for section in ('result_cache', 'primer_cache', 'atlas', 'metrics'):
+            config.pop(section, None)
+
+    if args.corpus and os.path.exists(args.corpus):
+        corpus = list(SeqIO.parse(args.corpus, 'fasta'))
+    else:
+        fasta = args.fasta or os.path.join(
+            os.environ.get('BLASTDB', config.get('db_dir') or ''), args.db)
+        corpus = build_corpus(fasta, args.per_stratum, args.min_length, args.seed)
+        if args.corpus:
+            SeqIO.write(corpus, args.corpus, 'fasta')
+    sys.stderr.write("%s queries in corpus\n" % len(corpus))
+
+    query_params = {
+        'database': args.db,
+        'melting_temp': 60,
+        'product_min': 400,
+        'product_max': 600,
+        'string_min': 89,
+        'string_max': 99,
+        'subunit_length': 20,
+    }
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        config_file = os.path.join(tmp_dir, 'RNAit.yaml')
+        with open(config_file, 'w') as fh:
+            yaml.safe_dump(config, fh)
+        os.environ['RNAIT_CONFIG'] = config_file
+        config = RNAit.get_config()
+
+        # warm up, so templates are compiled and the database is in the page cache
+        wsgi_request(corpus[0], query_params)
+
+        stage_names = ('get_primer_pairs', 'get_formatted_product', 'blast_product',
+                       'format_alignment', 'render')
+        times = {name: [] for name in stage_names}
+        queries = []
+        for record in corpus:
+            query_times = {name: [] for name in stage_names}
+            for i in range(args.repeats):
+                counts = time_stages(record, query_params, config, query_times)
+            query = get_corpus_info(record)
+            query.update(counts)
+            query['seconds'] = {name: sum(query_times[name]) / args.repeats
+                                for name in stage_names}
+            queries.append(query)
+            for name in stage_names:
+                times[name].extend(query_times[name])
+            sys.stderr.write("%s: %.3fs per run\n" % (
+                record.id, sum(query['seconds'].values())))
+
+        wsgi = []
+        for concurrency in [int(level) for level in args.concurrency.split(',')]:
+            requests = args.requests or len(corpus)
+            jobs = [corpus[i % len(corpus)] for i in range(requests)]
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                responses = list(pool.map(
+                    lambda record: wsgi_request(record, query_params), jobs))
+            elapsed = time.perf_counter() - start
+            level = {
+                'concurrency': concurrency,
+                'requests': requests,
+                'seconds': elapsed,
+                'throughput': requests / elapsed,
+                'latency': summarise([response[0] for response in responses]),
+                'errors': len([response for response in responses
+                               if response[1] != '200 OK']),
+                'bytes': sum(response[2] for response in responses),
+            }
+            wsgi.append(level)
+            sys.stderr.write("concurrency %s: %.2f requests/s, median latency %.3fs\n" % (
+                concurrency, level['throughput'], level['latency'].get('median')))
+
+    report = {
+        'label': args.label,
+        'revision': get_revision(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'host': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+        },
+        'settings': {
+            'db': args.db,
+            'seed': args.seed,
+            'per_stratum': args.per_stratum,
+            'repeats': args.repeats,
+            'keep_caches': args.keep_caches,
+            'query_params': query_params,
+        },
+        'queries': queries,
+        'stages': {name: summarise(times[name]) for name in stage_names},
+        'wsgi': wsgi,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as fh:
+            fh.write(output + "\n")
+    else:
+        print(output)
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+# Builds the precomputed atlas of primer designs for every CDS in a blast
+# database (see uwsgi/atlas.py), to be run after bin/reformat_tritrypdb_fasta.py
+# has built the database.
+#
+# Sequences are designed and screened in parallel in groups of -chunk_size,
+# with each group's results committed to the atlas as it completes. Genes
+# already in the atlas for the current database version and parameters are
+# skipped, so an interrupted build can simply be rerun.
+
+import argparse
+import os.path
+import sys
+import time
+import yaml
+from concurrent.futures import ProcessPoolExecutor
+from Bio import SeqIO
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)) + '/../uwsgi')
+import RNAit  # noqa: E402
+import atlas  # noqa: E402
+import result_cache  # noqa: E402
+
+# run_chunk
+#
+# Designs and screens primers for a group of sequences
+#
+# required args: job - tuple of (list of (gene id, sequence) tuples,
+#                      dictionary of query parameters, configuration dictionary)
+#
+# returns: entries - list of (gene id, sequence, result) tuples to store
+#          errors - list of (gene id, error) tuples for sequences whose blast
+#                   search failed
+
+
+def run_chunk(job):
+    records, query_params, config = job
+    entries = []
+    errors = []
+    for gene_id, seq in records:
+        params = dict(query_params)
+        params['seq'] = RNAit.SeqRecord(RNAit.Seq(seq), id=gene_id, description='')
+        # the off-target stretches are stored too, so pages served from the
+        # atlas draw the query's profile without searching it again
+        profile, error = RNAit.get_offtarget_profile(params, config)
+        if not error:
+            primers, blast_results, error = RNAit.get_screened_pairs(
+                params, config, profile=profile)
+        if error == 'No suitable primers found' or isinstance(error, OSError):
+            # primer3 failures depend only on the sequence, so are kept
+            entries.append((gene_id, seq, {'error': str(error)}))
+        elif error:
+            # blast errors aren't stored, so are retried on the next run
+            errors.append((gene_id, str(error)))
+        else:
+            stored = [blast_result.to_dict() for blast_result in blast_results]
+            result = {'primers': primers, 'blast_results': stored}
+            if profile:
+                result['offtarget_runs'] = profile.get('runs')
+            entries.append((gene_id, seq, result))
+    return(entries, errors)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Precompute RNAit primer designs for every sequence in a database")
+    parser.add_argument('-db', help='Database name', required=True)
+    parser.add_argument('-fasta', help='Database fasta file (default: <BLASTDB>/<db>)')
+    parser.add_argument(
+        '-config',
+        help='RNAit configuration file',
+        default=os.path.dirname(os.path.realpath(__file__)) + '/../etc/RNAit.yaml')
+    parser.add_argument('-atlas', help='Atlas file (default: atlas.path from the configuration)')
+    parser.add_argument('-processes', type=int, default=4,
+                        help='Number of sequences to process in parallel')
+    parser.add_argument('-chunk_size', type=int, default=20,
+                        help='Number of sequences per checkpoint')
+    parser.add_argument('-melting_temp', type=int, default=60)
+    parser.add_argument('-product_min', type=int, default=400)
+    parser.add_argument('-product_max', type=int, default=600)
+    parser.add_argument('-string_min', type=int, default=89)
+    parser.add_argument('-string_max', type=int, default=99)
+    parser.add_argument('-subunit_length', type=int, default=20)
+    args = parser.parse_args()
+
+    with open(args.config) as s:
+        config = yaml.safe_load(s)
+
+    atlas_path = args.atlas or (config.get('atlas') or {}).get('path')
+    if not atlas_path:
+        sys.exit('No atlas path given in the configuration or with -atlas')
+    fasta = args.fasta or os.path.join(
+        os.environ.get('BLASTDB', config.get('db_dir') or ''), args.db)
+
+    query_params = {
+        'database': args.db,
+        'melting_temp': args.melting_temp,
+        'product_min': args.product_min,
+        'product_max': args.product_max,
+        'string_min': args.string_min,
+        'string_max': args.string_max,
+        'subunit_length': args.subunit_length,
+    }
+    for name, value in query_params.items():
+        error = RNAit.check_param(
+            name, str(value), os.environ.get('BLASTDB') or config.get('db_dir') or '')
+        if error:
+            sys.exit(error)
+
+    store = atlas.Atlas(atlas_path)
+    db_version = result_cache.database_version(args.db)
+    params = atlas.params_key(query_params, config)
+    done = store.gene_ids(args.db, db_version, params)
+
+    records = []
+    for record in SeqIO.parse(fasta, 'fasta'):
+        if record.id not in done:
+            records.append((record.id, str(record.seq)))
+    sys.stderr.write("%s sequences already in atlas, %s to design\n" % (
+        len(done), len(records)))
+
+    def get_jobs():
+        for i in range(0, len(records), args.chunk_size):
+            yield (records[i:i + args.chunk_size], query_params, config)
+
+    start = time.time()
+    completed = 0
+    failed = 0
+    with ProcessPoolExecutor(max_workers=args.processes) as pool:
+        for entries, errors in pool.map(run_chunk, get_jobs()):
+            store.put_many(args.db, db_version, params, entries)
+            completed += len(entries)
+            failed += len(errors)
+            for gene_id, error in errors:
+                sys.stderr.write("%s: %s\n" % (gene_id, error))
+            sys.stderr.write("%s/%s sequences stored (%.0fs)\n" % (
+                completed, len(records), time.time() - start))
+
+    if failed:
+        sys.stderr.write("%s sequence(s) failed, rerun to retry them\n" % failed)
+        sys.exit(1)
@@ -10,7 +10,7 @@ fi
 # VNU_PATH will need to be updated to wherever brew installs vnu.jar
 export VNU_PATH=/usr/local/Cellar/vnu/18.3.0/libexec
 
-PAGES=(${RNAIT_ROOT}/htdocs/index.html)
+PAGES=(${RNAIT_ROOT}/htdocs/index.html ${RNAIT_ROOT}/htdocs/RNAit/batch.html)
 
 for PAGE in ${PAGES[@]} ; do
         if [ -e ${PAGE} ]; then
@@ -36,11 +36,33 @@ cp -vR $RNAIT_ROOT/databases /mount/dag_web_uwsgi/RNAit/
 cp -vR $RNAIT_ROOT/templates /mount/dag_web_uwsgi/RNAit/
 cp -v $RNAIT_ROOT/etc/RNAit.prod.yaml /mount/dag_web_uwsgi/RNAit/RNAit.yaml
 cp -v $RNAIT_ROOT/uwsgi/RNAit.py /mount/dag_web_uwsgi/RNAit/
+cp -v $RNAIT_ROOT/uwsgi/blast_pool.py /mount/dag_web_uwsgi/RNAit/
+cp -v $RNAIT_ROOT/uwsgi/result_cache.py /mount/dag_web_uwsgi/RNAit/
+cp -v $RNAIT_ROOT/uwsgi/jobs.py /mount/dag_web_uwsgi/RNAit/
+cp -v $RNAIT_ROOT/uwsgi/kmer_index.py /mount/dag_web_uwsgi/RNAit/
+cp -v $RNAIT_ROOT/uwsgi/atlas.py /mount/dag_web_uwsgi/RNAit/
+cp -v $RNAIT_ROOT/uwsgi/alignment_store.py /mount/dag_web_uwsgi/RNAit/
+cp -v $RNAIT_ROOT/uwsgi/metrics.py /mount/dag_web_uwsgi/RNAit/
+cp -v $RNAIT_ROOT/uwsgi/databases.py /mount/dag_web_uwsgi/RNAit/
+cp -v $RNAIT_ROOT/uwsgi/admission.py /mount/dag_web_uwsgi/RNAit/
+cp -v $RNAIT_ROOT/uwsgi/offtarget.py /mount/dag_web_uwsgi/RNAit/
+cp -v $RNAIT_ROOT/uwsgi/screen_result.py /mount/dag_web_uwsgi/RNAit/
 ssh dag-web "touch /var/www/uwsgi/dag.compbio.dundee.ac.uk/RNAit/reload_RNAit"
 ssh dag-web "chmod 0755 /var/www/uwsgi/dag.compbio.dundee.ac.uk/RNAit"
 ssh dag-web "chmod 0755 /var/www/uwsgi/dag.compbio.dundee.ac.uk/RNAit/templates"
 ssh dag-web "chmod 0755 /var/www/uwsgi/dag.compbio.dundee.ac.uk/RNAit/databases"
 ssh dag-web "chmod 0755 /var/www/uwsgi/dag.compbio.dundee.ac.uk/RNAit/RNAit.py"
+ssh dag-web "chmod 0755 /var/www/uwsgi/dag.compbio.dundee.ac.uk/RNAit/blast_pool.py"
+ssh dag-web "chmod 0755 /var/www/uwsgi/dag.compbio.dundee.ac.uk/RNAit/result_cache.py"
+ssh dag-web "chmod 0755 /var/www/uwsgi/dag.compbio.dundee.ac.uk/RNAit/jobs.py"
+ssh dag-web "chmod 0755 /var/www/uwsgi/dag.compbio.dundee.ac.uk/RNAit/kmer_index.py"
+ssh dag-web "chmod 0755 /var/www/uwsgi/dag.compbio.dundee.ac.uk/RNAit/atlas.py"
+ssh dag-web "chmod 0755 /var/www/uwsgi/dag.compbio.dundee.ac.uk/RNAit/alignment_store.py"
+ssh dag-web "chmod 0755 /var/www/uwsgi/dag.compbio.dundee.ac.uk/RNAit/metrics.py"
+ssh dag-web "chmod 0755 /var/www/uwsgi/dag.compbio.dundee.ac.uk/RNAit/databases.py"
+ssh dag-web "chmod 0755 /var/www/uwsgi/dag.compbio.dundee.ac.uk/RNAit/admission.py"
+ssh dag-web "chmod 0755 /var/www/uwsgi/dag.compbio.dundee.ac.uk/RNAit/offtarget.py"
+ssh dag-web "chmod 0755 /var/www/uwsgi/dag.compbio.dundee.ac.uk/RNAit/screen_result.py"
 ssh dag-web "chmod 0744 /var/www/uwsgi/dag.compbio.dundee.ac.uk/RNAit/RNAit.yaml"
 ssh dag-web "chmod 0744 /var/www/uwsgi/dag.compbio.dundee.ac.uk/RNAit/templates/*"
 ssh dag-web "chmod 0744 /var/www/uwsgi/dag.compbio.dundee.ac.uk/RNAit/databases/*"
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+# Generates concurrent query load from several simulated clients, to check
+# admission control (see uwsgi/admission.py) keeps the server responsive and
+# shares it fairly. Each group of clients in -clients is given as
+# name=<clients>x<concurrent requests per client>, and every client gets its
+# own /24 address. The default is one heavy client with 8 requests at a time
+# against four light clients with one at a time.
+#
+# Requests are made in-process through application(), with the configuration
+# given by -config, or with -url to a running server, in which case
+# admission.client_header must be set to HTTP_X_FORWARDED_FOR for the clients
+# to be told apart. Results for each group are written as JSON.
+
+import argparse
+import io
+import json
+import os
+import os.path
+import statistics
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from wsgiref.util import setup_testing_defaults
+from Bio import SeqIO
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)) + '/../uwsgi')
+import RNAit  # noqa: E402
+
+parser = argparse.ArgumentParser(
+    description="Generate query load from several clients against RNAit")
+parser.add_argument(
+    '-fasta',
+    help='Query fasta file, whose sequences are submitted in turn',
+    default=os.path.dirname(os.path.realpath(__file__)) +
+    '/../databases/TbruceiTREU927_multihit_test.fa')
+parser.add_argument('-db', help='Database name', default='TbruceiTREU927')
+parser.add_argument('-clients', default='heavy=1x8,light=4x1',
+                    help='Client groups, as name=<clients>x<concurrency>,...')
+parser.add_argument('-duration', type=float, default=60, help='Seconds to run for')
+parser.add_argument('-think', type=float, default=1,
+                    help='Seconds each client waits between requests')
+parser.add_argument(
+    '-config',
+    help='RNAit configuration file, for in-process requests',
+    default=os.path.dirname(os.path.realpath(__file__)) + '/../uwsgi/RNAit.yaml')
+parser.add_argument('-url', help='Base url of a running server, e.g. http://localhost:8080')
+args = parser.parse_args()
+
+records = list(SeqIO.parse(args.fasta, 'fasta'))
+query_params = {
+    'database': args.db,
+    'melting_temp': 60,
+    'product_min': 400,
+    'product_max': 600,
+    'string_min': 89,
+    'string_max': 99,
+    'subunit_length': 20,
+}
+
+# send_query
+#
+# required args: record - query Bio.seqRecord object
+#                address - client address (string)
+#
+# returns: status - HTTP status code (int)
+#          retry_after - Retry-After header value (string or None)
+
+
+def send_query(record, address):
+    fields = dict(query_params)
+    fields['seqpaste'] = ">%s\n%s\n" % (record.id, record.seq)
+    body = urllib.parse.urlencode(fields).encode('UTF-8')
+
+    if args.url:
+        request = urllib.request.Request(
+            args.url.rstrip('/') + '/RNAit/query', data=body,
+            headers={'X-Forwarded-For': address})
+        try:
+            with urllib.request.urlopen(request) as response:
+                response.read()
+                return(response.status, None)
+        except urllib.error.HTTPError as error:
+            return(error.code, error.headers.get('Retry-After'))
+
+    environ = {
+        'REQUEST_METHOD': 'POST',
+        'PATH_INFO': '/RNAit/query',
+        'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+        'CONTENT_LENGTH': str(len(body)),
+        'REMOTE_ADDR': address,
+        'wsgi.input': io.BytesIO(body),
+    }
+    setup_testing_defaults(environ)
+    reply = {}
+
+    def start_response(status_line, headers, exc_info=None):
+        reply['status'] = int(status_line.split()[0])
+        reply['retry_after'] = dict(headers).get('Retry-After')
+
+    response = RNAit.application(environ, start_response)
+    try:
+        for piece in response:
+            pass
+    finally:
+        if hasattr(response, 'close'):
+            response.close()
+    return(reply.get('status'), reply.get('retry_after'))
+
+
+if not args.url:
+    os.environ['RNAIT_CONFIG'] = os.path.realpath(args.config)
+
+results = []
+results_lock = threading.Lock()
+end_time = time.time() + args.duration
+
+
+def run_client(group, address, offset):
+    i = offset
+    while time.time() < end_time:
+        start = time.time()
+        status, retry_after = send_query(records[i % len(records)], address)
+        with results_lock:
+            results.append((group, status, time.time() - start, retry_after))
+        i += 1
+        time.sleep(args.think)
+
+
+threads = []
+groups = []
+for group_index, group in enumerate(args.clients.split(',')):
+    name, counts = group.split('=')
+    clients, concurrency = [int(count) for count in counts.split('x')]
+    groups.append(name)
+    for client in range(clients):
+        address = "10.%s.%s.1" % (group_index + 1, client + 1)
+        for thread in range(concurrency):
+            threads.append(threading.Thread(
+                target=run_client, args=(name, address, thread)))
+for thread in threads:
+    thread.start()
+for thread in threads:
+    thread.join()
+
+report = {}
+for name in groups:
+    group_results = [result for result in results if result[0] == name]
+    ok = [result[2] for result in group_results if result[1] == 200]
+    busy = [result for result in group_results if result[1] == 503]
+    report[name] = {
+        'requests': len(group_results),
+        'ok': len(ok),
+        'busy': len(busy),
+        'other': len(group_results) - len(ok) - len(busy),
+        'ok_per_minute': len(ok) * 60 / args.duration,
+        'median_latency': statistics.median(ok) if ok else None,
+        'max_latency': max(ok) if ok else None,
+        'median_busy_latency': statistics.median([result[2] for result in busy]) if busy else None,
+        'retry_after': sorted(set(int(result[3]) for result in busy if result[3])),
+    }
+print(json.dumps(report, indent=2))
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+# Builds the blast databases and k-mer indexes for a TriTrypDB release, and
+# records them in the database manifest (see uwsgi/databases.py).
+#
+# The databases to build are listed in etc/databases.yaml, and their source
+# fasta files are looked for in -source_dir. Databases are built in parallel,
+# each into a new version directory which is switched to once complete.
+# Databases whose source file is unchanged since the last build are skipped,
+# so a release can be rerun after fixing a failed download.
+#
+#   bin/manage_databases.py -release 68 -source_dir ~/TriTrypDB-68
+#   bin/manage_databases.py -list
+
+import argparse
+import os.path
+import sys
+import yaml
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)) + '/../uwsgi')
+import databases  # noqa: E402
+
+# run_build
+#
+# Builds a single database
+#
+# required args: job - tuple of (database directory, database name, source
+#                      file, organism, release, manifest entry, force, keep)
+#
+# returns: entry - new manifest entry, None if the build was skipped
+
+
+def run_build(job):
+    return(databases.build_database(*job))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Build RNAit blast databases from TriTrypDB CDS fasta files")
+    parser.add_argument('-release', help='TriTrypDB release number')
+    parser.add_argument('-source_dir', help='Directory of TriTrypDB fasta files', default='.')
+    parser.add_argument('-db', action='append',
+                        help='Database to build (default: all in the database list)')
+    parser.add_argument(
+        '-databases',
+        help='Database list',
+        default=os.path.dirname(os.path.realpath(__file__)) + '/../etc/databases.yaml')
+    parser.add_argument(
+        '-config',
+        help='RNAit configuration file',
+        default=os.path.dirname(os.path.realpath(__file__)) + '/../etc/RNAit.yaml')
+    parser.add_argument('-db_dir', help='Database directory (default: BLASTDB, or db_dir '
+                        'from the configuration)')
+    parser.add_argument('-processes', type=int, default=4,
+                        help='Number of databases to build in parallel')
+    parser.add_argument('-keep', type=int, default=2,
+                        help='Number of versions of each database to keep')
+    parser.add_argument('-force', action='store_true',
+                        help='Rebuild databases whose source is unchanged')
+    parser.add_argument('-list', action='store_true', help='List installed databases')
+    args = parser.parse_args()
+
+    db_dir = args.db_dir or os.environ.get('BLASTDB')
+    if not db_dir:
+        with open(args.config) as s:
+            db_dir = yaml.safe_load(s).get('db_dir')
+    if not db_dir:
+        sys.exit('No database directory given with -db_dir, BLASTDB or db_dir')
+    manifest = databases.load_manifest(db_dir) or {}
+
+    if args.list:
+        for name, entry in sorted(manifest.items()):
+            print("\t".join([name, entry.get('organism'), entry.get('release'),
+                             str(entry.get('sequences')), entry.get('version'),
+                             entry.get('built')]))
+        sys.exit(0)
+
+    if not args.release:
+        sys.exit('-release is required to build databases')
+    with open(args.databases) as s:
+        database_list = yaml.safe_load(s)
+    names = args.db or sorted(database_list)
+    jobs = []
+    for name in names:
+        if name not in database_list:
+            sys.exit("%s is not in %s" % (name, args.databases))
+        source = os.path.join(args.source_dir, database_list[name].get('source').format(
+            release=args.release))
+        if not os.path.exists(source):
+            sys.exit("Source file %s not found for %s" % (source, name))
+        jobs.append((db_dir, name, source, database_list[name].get('organism'),
+                     args.release, manifest.get(name), args.force, args.keep))
+
+    failed = 0
+    with ProcessPoolExecutor(max_workers=args.processes) as pool:
+        futures = dict((pool.submit(run_build, job), job[1]) for job in jobs)
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                entry = future.result()
+            except Exception as error:
+                failed += 1
+                sys.stderr.write("%s: build failed: %s\n" % (name, error))
+                continue
+            if entry is None:
+                sys.stderr.write("%s: source unchanged, skipped\n" % name)
+                continue
+            # the manifest is only written from here, so builds can't race
+            manifest[name] = entry
+            databases.save_manifest(db_dir, manifest)
+            sys.stderr.write("%s: built %s (%s sequences)\n" % (
+                name, entry.get('version'), entry.get('sequences')))
+
+    if failed:
+        sys.stderr.write("%s database(s) failed\n" % failed)
+        sys.exit(1)
@@ -1,13 +1,19 @@
 #!/usr/bin/env python
 
 # reformats description line of fasta files from TryTrypDB and writes blast
-# indexes into RNAit database directory
+# and k-mer indexes into RNAit database directory. bin/manage_databases.py
+# does the same for all databases of a release, with versioned builds and a
+# manifest.
 
 import argparse
 import os.path
 import subprocess
+import sys
 import yaml
-from Bio import SeqIO
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)) + '/../uwsgi')
+import databases  # noqa: E402
+import kmer_index  # noqa: E402
 
 parser = argparse.ArgumentParser(
     description="Reformat TryTyrpDb CDS fasta files for RNAit")
@@ -29,11 +35,8 @@ with open(config_file) as s:
 db_dir = config.get('db_dir')
 
 db_path = "%s//%s" % (db_dir, args.name)
-out_handle = open(db_path, 'w')
-
-for record in SeqIO.parse(args.fasta, "fasta"):
-    record.description = ((record.description.split("|"))[2])
-    SeqIO.write(record, out_handle, "fasta")
+databases.reformat_fasta(args.fasta, db_path)
 
 subprocess.check_call(['makeblastdb', '-dbtype', 'nucl',
                        '-in', db_path, '-title', args.name])
+kmer_index.build_index(db_path, db_path + '.kmi')
@@ -9,14 +9,18 @@
           event.stopPropagation();
         }
         //standard validation doesnt' seem to support 'or' operations between fields
-        if (document.getElementById('seqpaste').value=='' && document.getElementById('upload').value=='') {
+        //batch form also accepts gene ids in place of sequences
+        var gene_ids = document.getElementById('gene_ids');
+        if (document.getElementById('seqpaste').value=='' && document.getElementById('upload').value=='' && (gene_ids==null || gene_ids.value=='')) {
           document.getElementById('seqpaste').setCustomValidity("Invalid field.");
           document.getElementById('upload').setCustomValidity("Invalid field.");
+          if (gene_ids!=null) {gene_ids.setCustomValidity("Invalid field.");}
           event.preventDefault();
           event.stopPropagation();
         } else {
           document.getElementById('seqpaste').setCustomValidity("");
           document.getElementById('upload').setCustomValidity("");
+          if (gene_ids!=null) {gene_ids.setCustomValidity("");}
         }
         form.classList.add('was-validated');
       }, false);
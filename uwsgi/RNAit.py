@@ -1,82 +1,1371 @@
 #!/usr/bin/env python
 
 import cgi
+import hashlib
+import itertools
+import json
 from Bio import SeqIO
-from Bio.Blast.Applications import NcbiblastnCommandline
-from Bio.Blast import NCBIXML
-from Bio.Application import ApplicationError
-from tempfile import mkdtemp
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+from Bio.Blast import NCBIXML, Record
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import io
 import re
 import primer3
 import pprint
-import shutil
 import textwrap
+import time
 import os
-from jinja2 import Environment, FileSystemLoader, select_autoescape
+import uuid
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader, select_autoescape
+import numpy as np
 import yaml
 
+import admission
+import alignment_store
+import atlas
+import blast_pool
+import databases
+import jobs
+import kmer_index
+import metrics
+import offtarget
+import result_cache
+import screen_result
+
 import cgitb
 cgitb.enable(format='text')
 
+# per-worker configuration and templates, see get_config() and
+# get_template_env()
+app_config = None
+app_config_mtime = None
+template_envs = {}
+
+# per-worker cache of classified blast results, see get_result_cache()
+blast_result_cache = None
+
+# per-worker cache of primer3 designs, see get_primer_cache()
+primer_design_cache = None
+
+# per-worker store of precomputed results, see get_atlas()
+atlas_store = None
+
+# per-worker connection to the alignment store, see get_alignment_store()
+hit_alignment_store = None
+
+# per-worker connection to the admission database, see get_admission()
+request_admission = None
+
+# For parameter validation...
+param_checks = {
+    'melting_temp': 'int:50-75',
+    'product_min': 'int',
+    'product_max': 'int',
+    'string_min': 'int:>80',
+    'string_max': 'int:<99',
+    'subunit_length': 'int:15-25',
+    'database': 'database',
+    'format': 'string:"tsv|json"',
+}
+
+# for user-friendly output messages....
+param_names = {
+    'melting_temp': 'melting temperature',
+    'product_min': 'minimum PCR product size',
+    'product_max': 'maximum PCR product size',
+    'string_min': 'minimum similarity',
+    'string_max': 'maximum similarity',
+    'subunit_length': 'subunit length',
+    'database': 'database',
+    'format': 'output format',
+}
+
+# query form defaults, used for parameters the JSON api isn't given
+param_defaults = {
+    'melting_temp': '60',
+    'product_min': '400',
+    'product_max': '600',
+    'string_min': '89',
+    'string_max': '99',
+    'subunit_length': '20',
+}
+
+# version of the JSON api's output, part of its ETags (see get_result_etag)
+JSON_FORMAT = 1
+
+# primer3's default oligo size limits and optimum, which RNAit doesn't change
+# (see get_narrowed_design)
+primer_sizes = (18, 27)
+primer_opt_size = 20
+
+# smallest oligo penalty bound tried by get_narrowed_design
+narrow_bound = 0.5
+
+# databases offered when the database directory has no manifest (see
+# databases.py)
+default_databases = ['TbruceiTREU927', 'TbruceiGambienseDAL972', 'TbruceiLister427',
+                     'TcongolenseIL3000']
+
+# valid values of string parameters, parsed from param_checks
+param_options = dict(
+    (name, set(param_type.split(':')[1].strip('"').split('|')))
+    for name, param_type in param_checks.items() if param_type.startswith('string:'))
+
+# midline regexes for identical stretches of each valid subunit length
+midline_regexes = dict(
+    (length, re.compile(r"\|{" + str(length) + r",}")) for length in range(15, 26))
+ident_regex = re.compile(r"\|5,}")
+
+# columns of batch query summaries, see get_batch_summary()
+batch_fields = ['query', 'length', 'status', 'pairs', 'suitable_pairs', 'pair',
+                'left_seq', 'right_seq', 'left_start', 'right_start', 'left_tm',
+                'right_tm', 'product_size']
+
+# fields requested from blastn for tabular output, see parse_tabular_blast()
+tabular_fields = ['qseqid', 'sseqid', 'slen', 'length', 'nident', 'evalue',
+                  'bitscore', 'score', 'qstart', 'sstart', 'qseq', 'sseq',
+                  'stitle']
+
 
 def application(environ, start_response):
+    path = environ.get('PATH_INFO', '')
+    # only the exact endpoint, which nginx restricts to localhost - any other
+    # path ending in /metrics falls through to the public query location
+    if re.match(r'^/RNAit/query/metrics/?$', path):
+        return(metrics_application(environ, start_response, get_config()))
+
+    if re.search(r'/job(/|$)', path):
+        endpoint, handler = 'job', job_application
+    elif re.search(r'/batch/?$', path):
+        endpoint, handler = 'batch', batch_application
+    elif re.search(r'/alignment/', path):
+        endpoint, handler = 'alignment', alignment_application
+    elif re.search(r'/json/?$', path):
+        endpoint, handler = 'json', json_application
+    else:
+        endpoint, handler = 'query', query_application
+
+    request = metrics.start_request(endpoint)
+    status = []
+
+    def instrumented_start_response(status_line, headers, *exc_info):
+        status.append(status_line)
+        return(start_response(status_line, headers, *exc_info))
+
+    try:
+        with metrics.span('config'):
+            config = get_config()
+        response = handler(environ, instrumented_start_response, config)
+    except Exception:
+        metrics.finish_request(request, 'exception')
+        raise
+    return(metrics.instrument_response(
+        request, response, lambda: status[-1] if status else None))
+
+# query_application
+#
+# Runs a query submitted from the query form, streaming back the results page
+#
+# required args: environ - WSGI environment
+#                start_response - WSGI start_response function
+#                config - dictionary of configuration settings
+#
+# returns: html - iterable of encoded HTML page pieces
+
+
+def query_application(environ, start_response, config):
+    RNAit_dir = config.get('RNAit_dir')
+
+    with metrics.span('params'):
+        params = get_params(environ)
+
+    if ('error' in params):
+        start_response('200 OK', [('Content-Type', 'text/html')])
+        return([get_error_page(RNAit_dir, params.get('error'), 'submission')])
+
+    database_count = len(params.get('databases') or [1])
+    ticket, retry_after = admit_request(
+        config, environ, [len(params.get('seq').seq)],
+        get_query_slots(config, database_count), database_count=database_count)
+    if retry_after:
+        return(get_busy_response(start_response, RNAit_dir, retry_after))
+
     start_response('200 OK', [('Content-Type', 'text/html')])
+    return(admitted_response(config, ticket, stream_query(params, config)))
+
+# json_application
+#
+# Runs a query given as the query form's fields, either as a GET query string
+# or POSTed, returning its primer pairs and screens as JSON (see
+# get_json_result). Parameters not given take the query form's defaults.
+#
+# Responses carry an ETag identifying the sequence, parameters, database
+# versions and screening settings, which is known before any work is done, so
+# GET requests whose If-None-Match matches are answered with 304 Not Modified
+# at once, and caches (see etc/nginx-site.conf) can revalidate cheaply.
+# Results are kept in the result cache by ETag, so repeated POSTs are answered
+# from there.
+#
+# required args: environ - WSGI environment
+#                start_response - WSGI start_response function
+#                config - dictionary of configuration settings
+#
+# returns: json - list containing the encoded response
+
+
+def json_application(environ, start_response, config):
+    method = environ.get('REQUEST_METHOD')
+    if method not in ('GET', 'HEAD', 'POST'):
+        return(get_json_response(start_response, '405 Method Not Allowed',
+                                 {'error': 'Queries must be made by GET or POST'},
+                                 [('Allow', 'GET, HEAD, POST')]))
+
+    with metrics.span('params'):
+        params = get_params(environ, query_string=True)
+    if 'error' not in params and 'seq' not in params:
+        params['error'] = 'No query sequence provided'
+    if 'error' not in params and 'database' not in params:
+        params['error'] = 'No database provided'
+    if 'error' in params:
+        return(get_json_response(start_response, '400 Bad Request',
+                                 {'error': params.get('error')}))
+    for name, value in param_defaults.items():
+        params.setdefault(name, value)
+
+    etag = get_result_etag(params, config)
+    headers = [
+        ('ETag', etag),
+        ('Cache-Control', 'public, max-age=%s' % int(
+            (config.get('json_api') or {}).get('max_age', 3600))),
+    ]
+    if method != 'POST' and etag_matches(environ.get('HTTP_IF_NONE_MATCH'), etag):
+        metrics.count('rnait_cache_lookups_total', store='etag', result='hit')
+        start_response('304 Not Modified', headers)
+        return([b''])
+
+    cache = get_result_cache(config)
+    body = None
+    if cache:
+        body = cache.get('json:' + etag)
+        metrics.count('rnait_cache_lookups_total', store='json',
+                      result='miss' if body is None else 'hit')
+    if body is None:
+        database_count = len(params.get('databases') or [1])
+        ticket, retry_after = admit_request(
+            config, environ, [len(params.get('seq').seq)],
+            get_query_slots(config, database_count), database_count=database_count)
+        if retry_after:
+            return(get_json_response(
+                start_response, '503 Service Unavailable',
+                {'error': 'The server is busy, please try again in %s seconds' % retry_after},
+                [('Retry-After', str(retry_after))]))
+        try:
+            result = get_json_result(params, config)
+        finally:
+            if ticket:
+                get_admission(config).release(ticket)
+        if result.get('error'):
+            # runtime errors may not recur, so aren't kept
+            return(get_json_response(start_response, '200 OK', result))
+        body = json.dumps(result, sort_keys=True)
+        if cache:
+            cache.put('json:' + etag, body)
+
+    return(get_json_response(start_response, '200 OK', body, headers))
+
+# get_json_response
+#
+# required args: start_response - WSGI start_response function
+#                status - HTTP status line (string)
+#                data - response data (dictionary), or encoded JSON (string)
+#
+# optional args: headers - further response headers (list of tuples); without
+#                          them the response isn't to be cached
+#
+# returns: json - list containing the encoded response
+
+
+def get_json_response(start_response, status, data, headers=None):
+    if not isinstance(data, str):
+        data = json.dumps(data, sort_keys=True)
+    body = data.encode('UTF-8')
+    start_response(status, [('Content-Type', 'application/json'),
+                            ('Content-Length', str(len(body)))] +
+                   (headers or [('Cache-Control', 'no-store')]))
+    return([body])
+
+# get_result_etag
+#
+# Generates the ETag of a query's JSON result, from everything that result
+# depends on: the query id and sequence, the query parameters and screening
+# settings (see atlas.params_key), the version of each database, the primer3
+# version and the output format
+#
+# required args: params - dictionary of query parameters
+#                config - dictionary of configuration settings
+#
+# returns: etag - quoted ETag (string)
+
+
+def get_result_etag(params, config):
+    seq = params.get('seq')
+    parts = [str(JSON_FORMAT), primer3.__version__, atlas.params_key(params, config),
+             seq.id, str(seq.seq).upper()]
+    for db in params.get('databases') or [params.get('database')]:
+        parts.append("%s=%s" % (db, result_cache.database_version(db)))
+    digest = hashlib.sha256("\n".join(parts).encode('UTF-8')).hexdigest()
+    return('"%s"' % digest[:32])
+
+# etag_matches
+#
+# required args: header - If-None-Match header value (string or None)
+#                etag - quoted ETag (string)
+#
+# returns: match - True if the header lists the ETag or is '*'
+
+
+def etag_matches(header, etag):
+    if not header:
+        return(False)
+    for value in header.split(','):
+        value = value.strip()
+        if value.startswith('W/'):
+            value = value[2:]
+        if value == '*' or value == etag:
+            return(True)
+    return(False)
+
+# get_json_result
+#
+# Designs primers for a query and screens their products, as plain data
+#
+# required args: params - dictionary of parsed form parameters
+#                config - dictionary of configuration settings
+#
+# returns: result - dictionary as returned by design_primers, with
+#                   'databases' listing those screened. Against several
+#                   databases, each pair's 'PRIMER_STATUS' summarises its
+#                   screens (see get_database_status), and 'DATABASES' holds
+#                   the 'PRIMER_STATUS' and 'BLAST' of each.
+
+
+def get_json_result(params, config):
+    seq = params.get('seq')
+    dbs = params.get('databases') or [params.get('database')]
+    result = {
+        'query': seq.id,
+        'length': len(seq.seq),
+        'database': params.get('database'),
+        'databases': dbs,
+        'error': None,
+        'pairs': [],
+    }
+
+    entry = None
+    if len(dbs) < 2:
+        entry = get_atlas_entry(params, config)
+    if entry:
+        primers = entry.get('primers')
+        blast_results = entry.get('blast_results')
+        error = entry.get('error')
+    elif len(dbs) > 1:
+        primers, screens, error = get_database_screens(params, config)
+    else:
+        primers, blast_results, error = get_screened_pairs(params, config)
+    if error:
+        result['error'] = str(error)
+        return(result)
+
+    for i, pair in enumerate(primers):
+        if len(dbs) > 1:
+            pair_data = dict(pair)
+            pair_data.pop('PRODUCT', None)
+            pair_data['PRIMER_STATUS'] = get_database_status(screens[i])
+            pair_data['DATABASES'] = dict(
+                (db, get_pair_data({}, blast_result)) for db, blast_result in screens[i])
+        else:
+            pair_data = get_pair_data(pair, blast_results[i])
+        result['pairs'].append(pair_data)
+
+    return(result)
+
+# metrics_application
+#
+# Returns the request metrics of all workers in Prometheus text format
+#
+# required args: environ - WSGI environment
+#                start_response - WSGI start_response function
+#                config - dictionary of configuration settings
+#
+# returns: text - list containing the encoded metrics
+
 
-    config_file = (
+def metrics_application(environ, start_response, config):
+    text = metrics.render((config.get('metrics') or {}).get('dir'))
+    start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4')])
+    return([text.encode('UTF-8')])
+
+# get_config
+#
+# Returns the parsed RNAit.yaml configuration for this worker. The file is
+# only re-read when its modification time changes. RNAIT_CONFIG in the
+# environment names a different configuration file, e.g. for benchmarking.
+#
+# returns: config - dictionary of configuration settings
+
+
+def get_config():
+    global app_config, app_config_mtime
+    config_file = os.environ.get('RNAIT_CONFIG') or (
         os.path.dirname(
             os.path.realpath(__file__)) +
         '/RNAit.yaml')
-    with open(config_file) as s:
-        config = yaml.safe_load(s)
+    mtime = os.path.getmtime(config_file)
+    if app_config is None or mtime != app_config_mtime:
+        with open(config_file) as s:
+            app_config = yaml.safe_load(s)
+        app_config_mtime = mtime
+        metrics.configure(app_config.get('metrics'))
+    return(app_config)
+
+# get_template_env
+#
+# Returns the jinja Environment for an RNAit installation, creating it on
+# first use. Compiled templates are cached in memory by the Environment and on
+# disk by its bytecode cache, while jinja's auto_reload still picks up changes
+# to the template files.
+#
+# required args: RNAit_dir - path to RNAit installation (string)
+#
+# returns: env - jinja2.Environment
+
+
+def get_template_env(RNAit_dir):
+    env = template_envs.get(RNAit_dir)
+    if env is None:
+        env = Environment(
+            loader=FileSystemLoader(RNAit_dir + '/templates'), autoescape=select_autoescape(['html', 'xml']),
+            bytecode_cache=FileSystemBytecodeCache()
+        )
+        env.filters['format_alignment'] = format_alignment
+        template_envs[RNAit_dir] = env
+    return(env)
+
+# run_query
+#
+# Designs primers for a query and screens their products, returning the
+# results page (or an error page if a runtime error occurs). Queries found in
+# the precomputed atlas (see atlas.py) are answered from there. Queries against
+# several databases are screened against each (see screen_databases), and the
+# page shows the suitability of each pair in each database. With
+# 'offtarget_profile' configured, the query's off-target profile is shown for
+# each pair (see get_offtarget_profile).
+#
+# required args: params - dictionary of parsed form parameters
+#                config - dictionary of configuration settings
+#
+# optional args: progress - function called with (stage, done, total) as the
+#                           query progresses
+#
+# returns: html - encoded HTML page
+
+
+def run_query(params, config, progress=None):
 
     RNAit_dir = config.get('RNAit_dir')
-    db_dir = config.get('db_dir')
-    tmp_dir = config.get('tmp_dir')
+    seq = params.get('seq')
+
+    screens = None
+    profile = None
+    entry = None
+    if len(params.get('databases') or []) < 2:
+        entry = get_atlas_entry(params, config)
+    if entry:
+        primers = entry.get('primers')
+        blast_results = entry.get('blast_results')
+        error = entry.get('error')
+        if not error:
+            profile, error = get_offtarget_profile(
+                params, config, progress, entry.get('offtarget_runs'))
+    else:
+        profile, error = get_offtarget_profile(params, config, progress)
+        if error:
+            primers = []
+        elif len(params.get('databases') or []) > 1:
+            primers, screens, error = get_database_screens(params, config, progress, profile)
+            blast_results = [{'primer_status': get_database_status(screen)} for screen in screens]
+        else:
+            primers, blast_results, error = get_screened_pairs(params, config, progress, profile)
+    if (error):
+        return(get_error_page(RNAit_dir, error, 'runtime'))
+    alignment_options = get_alignment_options(config)
+    # only the pairs shown need their product highlighting
+    seq_lines = get_wrapped_sequence(str(seq.seq))
+    for i, pair in enumerate(primers):
+        pair['PRODUCT'] = get_pair_product(pair, seq_lines, profile)
+        if screens:
+            for db, blast_result in screens[i]:
+                store_alignments(config, alignment_options, i + 1, blast_result, db)
+        else:
+            store_alignments(config, alignment_options, i + 1, blast_results[i])
+    html = get_output_page(get_query_info(params), primers, RNAit_dir,
+                           blast_results, alignment_options, screens)
 
-    params = get_params(environ)
+    return(html)
+
+# stream_query
+#
+# As run_query, but yields the results page in pieces: the page header and
+# query details as soon as primers have been designed, then each primer pair
+# as its screen completes (see iter_screened_pairs). Queries against several
+# databases show every pair once all are screened, after the suitability
+# matrix. A runtime error once the page has started is shown in place of the
+# remaining primer pairs.
+#
+# required args: params - dictionary of parsed form parameters
+#                config - dictionary of configuration settings
+#
+# yields: html - encoded HTML page pieces
 
-    if ('error' in params):
-        return(get_error_page(RNAit_dir, params.get('error'), 'submission'))
 
+def stream_query(params, config):
+
+    RNAit_dir = config.get('RNAit_dir')
     seq = params.get('seq')
-    db = params.get('database')
+    dbs = params.get('databases') or [params.get('database')]
+
+    screens = None
+    profile = None
+    entry = None
+    if len(dbs) < 2:
+        entry = get_atlas_entry(params, config)
+    if entry:
+        profile, error = None, entry.get('error')
+        if not error:
+            profile, error = get_offtarget_profile(params, config,
+                                                   runs=entry.get('offtarget_runs'))
+        if error:
+            yield get_error_page(RNAit_dir, error, 'runtime')
+            return
+        results = zip(entry.get('primers'), entry.get('blast_results'),
+                      itertools.repeat(None))
+    else:
+        profile, error = get_offtarget_profile(params, config)
+        primers = []
+        if not error:
+            primers, error = get_query_primers(params, config, profile)
+        if not error and len(primers) == 0:
+            error = 'No suitable primers found'
+        if error:
+            yield get_error_page(RNAit_dir, error, 'runtime')
+            return
+        if len(dbs) > 1:
+            results = None
+        else:
+            results = iter_screened_pairs(
+                seq, primers, params.get('database'), int(params.get('string_min')),
+                int(params.get('string_max')), int(params.get('subunit_length')),
+                config)
+
+    query_info = get_query_info(params)
+    alignment_options = get_alignment_options(config)
+    blocks = get_template_env(RNAit_dir).get_template('result_blocks.html').module
+    with metrics.span('render'):
+        html = blocks.page_header(query_info).encode('UTF-8')
+    yield html
+    if results is None:
+        primers, screens, error = screen_databases(
+            seq, primers, dbs, int(params.get('string_min')),
+            int(params.get('string_max')), int(params.get('subunit_length')),
+            config)
+        if error:
+            yield blocks.page_error(error).encode('UTF-8')
+            yield blocks.page_footer().encode('UTF-8')
+            return
+        results = [(pair, {'primer_status': get_database_status(screen)}, None)
+                   for pair, screen in zip(primers, screens)]
+        with metrics.span('render'):
+            html = blocks.database_matrix(primers, screens).encode('UTF-8')
+        yield html
+    seq_lines = get_wrapped_sequence(str(seq.seq))
+    for i, (pair, blast_result, error) in enumerate(results):
+        if error:
+            yield blocks.page_error(error).encode('UTF-8')
+            break
+        pair['PRODUCT'] = get_pair_product(pair, seq_lines, profile)
+        if screens:
+            for db, db_result in screens[i]:
+                store_alignments(config, alignment_options, i + 1, db_result, db)
+        else:
+            store_alignments(config, alignment_options, i + 1, blast_result)
+        with metrics.span('render'):
+            html = blocks.primer_card(pair, blast_result, i + 1, query_info,
+                                      alignment_options,
+                                      screens[i] if screens else None).encode('UTF-8')
+        yield html
+    yield blocks.page_footer().encode('UTF-8')
+
+# get_query_info
+#
+# Captures the query parameters for display on the results page
+#
+# required args: params - dictionary of parsed form parameters
+#
+# returns: query_info - dictionary
 
-    primers, error = get_primer_pairs(params)
-    # capture query parameters for display on results page
+
+def get_query_info(params):
+    seq = params.get('seq')
     query_info = {
         'query_seq': seq.id,
         'query_length': len(seq.seq),
         'melting_temp': params.get('melting_temp'),
         'product_size': params.get('product_size'),
-        'database': params.get('database'),
+        'database': ', '.join(params.get('databases') or [params.get('database')]),
         'stringency': "%s - %s" % (params.get('string_min'), params.get('string_max')),
         'subunit_length': params.get('subunit_length'),
     }
+    return(query_info)
 
+# get_atlas_entry
+#
+# Looks a query up in the precomputed atlas, if one is configured
+#
+# required args: params - dictionary of parsed form parameters
+#                config - dictionary of configuration settings
+#
+# returns: entry - dictionary (see atlas.Atlas.lookup), None if not found
+
+
+def get_atlas_entry(params, config):
+    store = get_atlas(config)
+    if not store:
+        return(None)
+    db = params.get('database')
+    entry = store.lookup(db, result_cache.database_version(db),
+                         atlas.params_key(params, config),
+                         str(params.get('seq').seq))
+    metrics.count('rnait_cache_lookups_total', store='atlas',
+                  result='miss' if entry is None else 'hit')
+    if entry and entry.get('blast_results'):
+        entry['blast_results'] = [screen_result.ScreenResult.from_dict(blast_result)
+                                  for blast_result in entry.get('blast_results')]
+    return(entry)
+
+# get_alignment_options
+#
+# Determines how hit alignments are shown on a results page
+#
+# required args: config - dictionary of configuration settings
+#
+# returns: alignment_options - dictionary of 'max_hits' (maximum hits listed
+#                              per category, None for all), 'token' (unique to
+#                              the page) and 'url' (base url the page fetches
+#                              alignments from), with token and url None if
+#                              alignments are embedded in the page
+
+
+def get_alignment_options(config):
+    alignment_options = {
+        'max_hits': (config.get('alignments') or {}).get('max_hits'),
+        'token': None,
+        'url': None,
+    }
+    if get_alignment_store(config):
+        alignment_options['token'] = uuid.uuid4().hex
+        alignment_options['url'] = '/RNAit/query/alignment/' + alignment_options['token']
+    return(alignment_options)
+
+# store_alignments
+#
+# Saves the alignments of the hits listed for a primer pair to the alignment
+# store, when the page fetches them on demand
+#
+# required args: config - dictionary of configuration settings
+#                alignment_options - dictionary (see get_alignment_options)
+#                primer_index - position of the pair on the page (int)
+#                blast_result - screen_result.ScreenResult (see classify_blast_record)
+#
+# optional args: database - database screened, when the page shows several
+
+
+def store_alignments(config, alignment_options, primer_index, blast_result,
+                     database=None):
+    if not alignment_options.get('url'):
+        return
+    max_hits = alignment_options.get('max_hits')
+    hit_key = primer_index
+    if database:
+        hit_key = "%s/%s" % (primer_index, database)
+    entries = {}
+    for category, key in (('self', 'self_alignments'),
+                          ('other', 'conflicting_alignments'),
+                          ('matching', 'matching_alignments')):
+        for i, hit in enumerate(blast_result.get(key)[:max_hits]):
+            entries["%s/%s/%s/%s" % (alignment_options.get('token'), hit_key,
+                                     category, i + 1)] = [
+                hsp.to_dict() for hsp in hit.get('hsp_alignments')]
+    get_alignment_store(config).put_many(entries)
+
+# get_screened_pairs
+#
+# Designs primers for a query and screens their products
+#
+# required args: params - dictionary of query parameters
+#                config - dictionary of configuration settings
+#
+# optional args: progress - function called with (stage, done, total) as the
+#                           query progresses
+#                profile - off-target profile (see get_offtarget_profile),
+#                          found here if not given
+#
+# returns: primers - list of primer pair dictionaries (see get_primer_pairs),
+#                    without formatted products
+#          blast_results - list of blast_data dictionaries (see
+#                          classify_blast_record), in the same order as primers
+#          error - runtime error (string)
+
+
+def get_screened_pairs(params, config, progress=None, profile=None):
+    if progress:
+        progress('Designing primers')
+    primers, error = get_query_primers(params, config, profile)
     if error:
-        return(get_error_page(RNAit_dir, error, 'runtime'))
+        return([], [], error)
+    if (len(primers) == 0):
+        return([], [], 'No suitable primers found')
 
+    return(screen_primer_pairs(
+        params.get('seq'), primers, params.get('database'),
+        int(params.get('string_min')), int(params.get('string_max')),
+        int(params.get('subunit_length')), config, progress))
+
+# get_database_screens
+#
+# Designs primers for a query once, and screens their products against each of
+# the selected databases (params['databases'])
+#
+# required args: params - dictionary of query parameters
+#                config - dictionary of configuration settings
+#
+# optional args: progress - function called with (stage, done, total) as the
+#                           query progresses
+#                profile - off-target profile (see get_offtarget_profile),
+#                          found here if not given
+#
+# returns: primers - list of primer pair dictionaries (see get_primer_pairs),
+#                    without formatted products
+#          screens - list of (database, blast_data) lists (see
+#                    screen_databases), in the same order as primers
+#          error - runtime error (string)
+
+
+def get_database_screens(params, config, progress=None, profile=None):
+    if progress:
+        progress('Designing primers')
+    primers, error = get_query_primers(params, config, profile)
+    if error:
+        return([], [], error)
     if (len(primers) == 0):
-        return(get_error_page(RNAit_dir, 'No suitable primers found', 'runtime'))
-        encode = html.encode('UTF-8')
-        return(encode)
+        return([], [], 'No suitable primers found')
 
-    blast_results = []
+    return(screen_databases(
+        params.get('seq'), primers, params.get('databases'),
+        int(params.get('string_min')), int(params.get('string_max')),
+        int(params.get('subunit_length')), config, progress))
+
+# get_query_primers
+#
+# Designs the candidate primer pairs for a query. With an off-target profile
+# whose clean regions are to be kept to, products are placed within them; if
+# no pairs fit, pairs are designed over the whole query as usual.
+#
+# required args: params - dictionary of query parameters
+#                config - dictionary of configuration settings
+#
+# optional args: profile - off-target profile (see get_offtarget_profile),
+#                          found here if not given
+#
+# returns: primers - list of primer pair dictionaries (see get_primer_pairs),
+#                    without formatted products
+#          error - runtime error (string)
+
+
+def get_query_primers(params, config, profile=None):
+    num_return = (config.get('adaptive_screen') or {}).get('candidates')
+    cache = get_primer_cache(config)
+    if profile is None:
+        profile, error = get_offtarget_profile(params, config)
+        if error:
+            return([], error)
+    if profile and profile.get('regions'):
+        primers, error = get_primer_pairs(
+            params, format_product=False, num_return=num_return, cache=cache,
+            regions=profile.get('regions'))
+        if error or primers:
+            return(primers, error)
+    return(get_primer_pairs(params, format_product=False, num_return=num_return,
+                            cache=cache))
+
+# get_offtarget_profile
+#
+# Searches the whole query against each selected database once, before
+# primers are designed, and builds its off-target profile (see offtarget.py)
+# from the identical stretches of at least the subunit length it shares with
+# other transcripts. With offtarget_profile.exclude set, products are kept to
+# the clean regions between stretches (see get_query_primers).
+#
+# required args: params - dictionary of query parameters
+#                config - dictionary of configuration settings
+#
+# optional args: progress - function called with (stage, done, total) as the
+#                           query progresses
+#                runs - stretches found previously (see offtarget.get_runs),
+#                       such as those stored with an atlas entry, in which case
+#                       the query isn't searched again
+#
+# returns: profile - dictionary of 'coverage' (numpy array of the stretches
+#                    covering each base), 'subunit_length', 'regions' (clean
+#                    regions to design within, None to design anywhere) and
+#                    'runs', or None if offtarget_profile isn't configured
+#          error - runtime error (string)
+
+
+def get_offtarget_profile(params, config, progress=None, runs=None):
+    profile_config = config.get('offtarget_profile')
+    if not profile_config:
+        return(None, None)
+    seq = str(params.get('seq').seq)
+    subunit_length = int(params.get('subunit_length'))
+    dbs = params.get('databases') or [params.get('database')]
+
+    if runs is None:
+        if progress:
+            progress('Screening query for off-target sequence')
+        runs = []
+        with ThreadPoolExecutor(max_workers=len(dbs)) as executor:
+            futures = [executor.submit(metrics.context(), get_offtarget_runs, seq, db,
+                                       subunit_length, config) for db in dbs]
+            for future in futures:
+                db_runs, error = future.result()
+                if error:
+                    return(None, error)
+                runs.extend(db_runs)
+
+    with metrics.span('offtarget'):
+        coverage = offtarget.get_coverage(runs, len(seq))
+        regions = None
+        if runs and profile_config.get('exclude'):
+            regions = offtarget.clean_regions(coverage, subunit_length,
+                                              int(params.get('product_min')))
+    profile = {
+        'coverage': coverage,
+        'subunit_length': subunit_length,
+        'regions': regions,
+        'runs': runs,
+    }
+    return(profile, None)
+
+# get_offtarget_runs
+#
+# required args: seq - query sequence (string)
+#                db - blast database name (string)
+#                subunit_length - minimum identical stretch (int)
+#                config - dictionary of configuration settings
+#
+# returns: runs - list of off-target stretches (see offtarget.get_runs)
+#          error - runtime error (string)
+
+
+def get_offtarget_runs(seq, db, subunit_length, config):
+    cache = get_result_cache(config)
+    cache_key = None
+    if cache:
+        cache_key = result_cache.profile_key(
+            db, result_cache.database_version(db), seq, subunit_length)
+        runs = cache.get(cache_key)
+        metrics.count('rnait_cache_lookups_total', store='offtarget_profile',
+                      result='miss' if runs is None else 'hit')
+        if runs is not None:
+            return(runs, None)
+
+    query = SeqRecord(Seq(seq), id='query', description='')
+    blast_format = config.get('blast_format', 'tabular')
+    pool_config = config.get('blast_pool') or {}
+    blast_output, error = run_blast(
+        [query], db, pool_config.get('socket'), blast_format, pool_config.get('timeout'))
+    if error:
+        return([], error)
+    with metrics.span('parse'):
+        if blast_format == 'tabular':
+            blast_record = parse_tabular_blast(blast_output, [query]).get('query')
+        else:
+            blast_record = next(NCBIXML.parse(io.StringIO(blast_output)))
+    runs = offtarget.get_runs(blast_record, subunit_length)
+    if cache_key:
+        cache.put(cache_key, runs)
+    return(runs, None)
+
+# design_primers
+#
+# Library entry point: designs primers for a sequence and screens their
+# products against a blast database, returning structured results rather than
+# HTML. Parameters are validated as for the web form.
+#
+# required args: seq - Bio.seqRecord object or sequence string
+#                database - blast database name (string)
+#
+# optional args: melting_temp, product_min, product_max, string_min,
+#                string_max, subunit_length - query parameters as for the web
+#                form (int)
+#                config - dictionary of configuration settings, as read from
+#                         RNAit.yaml (db_dir, blast_pool, result_cache,
+#                         blast_format, kmer_index and adaptive_screen are used
+#                         if present)
+#
+# returns: result - dictionary containing 'query', 'length', 'database',
+#                   'error' and 'pairs', a list of primer pair dictionaries
+#                   (see get_primer_pairs) each with 'PRIMER_STATUS' and
+#                   'BLAST' (blast_data, see classify_blast_record, without
+#                   the blast record or formatted alignments)
+
+
+def design_primers(seq, database, melting_temp=60, product_min=400,
+                   product_max=600, string_min=89, string_max=99,
+                   subunit_length=20, config=None):
+    if config is None:
+        config = {}
+    if not isinstance(seq, SeqRecord):
+        seq = SeqRecord(Seq(str(seq)), id='query', description='')
+
+    params = {
+        'seq': seq,
+        'database': database,
+        'melting_temp': melting_temp,
+        'product_min': product_min,
+        'product_max': product_max,
+        'string_min': string_min,
+        'string_max': string_max,
+        'subunit_length': subunit_length,
+    }
+    result = {
+        'query': seq.id,
+        'length': len(seq.seq),
+        'database': database,
+        'error': None,
+        'pairs': [],
+    }
+
+    # databases are checked against the caller's configuration, not RNAit.yaml
+    db_dir = os.environ.get('BLASTDB') or config.get('db_dir') or ''
+    for name in param_checks:
+        if name in params:
+            error = check_param(name, str(params.get(name)), db_dir)
+            if error:
+                result['error'] = error
+                return(result)
+
+    primers, blast_results, error = get_screened_pairs(params, config)
+    if error:
+        result['error'] = str(error)
+        return(result)
+
+    for pair, blast_result in zip(primers, blast_results):
+        result['pairs'].append(get_pair_data(pair, blast_result))
+
+    return(result)
+
+# get_pair_data
+#
+# Converts a primer pair and its screen to plain data, for JSON output
+#
+# required args: pair - primer pair dictionary (see get_primer_pairs)
+#                blast_result - screen_result.ScreenResult (see classify_blast_record)
+#
+# returns: pair - copy of the pair dictionary without 'PRODUCT', with
+#                 'PRIMER_STATUS' and 'BLAST' (blast_result as a dictionary,
+#                 without hit alignments)
+
+
+def get_pair_data(pair, blast_result):
+    pair = dict(pair)
+    pair.pop('PRODUCT', None)
+    blast_data = blast_result.to_dict()
+    for key in ('self_alignments', 'conflicting_alignments', 'matching_alignments'):
+        for hit in blast_data.get(key):
+            del hit['hsp_alignments']
+    pair['PRIMER_STATUS'] = blast_result.get('primer_status')
+    pair['BLAST'] = blast_data
+    return(pair)
+
+# job_application
+#
+# Handles requests for asynchronous jobs:
+#   POST .../job           validates the submission and starts a job, then
+#                          redirects to the job page
+#   GET  .../job/<id>      job progress page, or the results once complete
+#   GET  .../job/<id>/status job state as JSON
+#
+# required args: environ - environment dictionary
+#                start_response - WSGI start_response function
+#                config - dictionary of configuration settings
+#
+# returns: list containing encoded response body
+
+
+def job_application(environ, start_response, config):
+    RNAit_dir = config.get('RNAit_dir')
+    job_config = config.get('jobs') or {}
+    job_dir = job_config.get('dir', os.path.join(config.get('tmp_dir'), 'jobs'))
+    timeout = int(job_config.get('timeout', 3600))
+    path = environ.get('PATH_INFO', '')
+
+    match = re.search(r'/job/([^/]+)(/status)?/?$', path)
+    if match:
+        job_id = match.group(1)
+        job = jobs.get_job(job_dir, job_id, timeout)
+        if job is None:
+            start_response('404 Not Found', [('Content-Type', 'text/html')])
+            return([get_error_page(RNAit_dir, 'Job not found - results are only kept for a limited time', 'runtime')])
+        if match.group(2):
+            start_response('200 OK', [('Content-Type', 'application/json')])
+            return([json.dumps(job).encode('UTF-8')])
+        start_response('200 OK', [('Content-Type', 'text/html')])
+        if job.get('state') == 'complete':
+            html = jobs.get_result(job_dir, job_id)
+            if html is not None:
+                return([html])
+            job['error'] = 'Job results could not be found'
+        if job.get('state') == 'failed' or job.get('state') == 'complete':
+            return([get_error_page(RNAit_dir, job.get('error'), 'runtime')])
+        return([get_job_page(RNAit_dir, job)])
+
+    if environ.get('REQUEST_METHOD') != 'POST':
+        start_response('405 Method Not Allowed', [('Content-Type', 'text/html'), ('Allow', 'POST')])
+        return([get_error_page(RNAit_dir, 'Queries must be submitted from the query form', 'submission')])
+
+    with metrics.span('params'):
+        params = get_params(environ)
+    if ('error' in params):
+        start_response('200 OK', [('Content-Type', 'text/html')])
+        return([get_error_page(RNAit_dir, params.get('error'), 'submission')])
+
+    job_id = jobs.create_job(job_dir, int(job_config.get('queue_size', 20)),
+                             int(job_config.get('expiry', 86400)), timeout)
+    if job_id is None:
+        start_response('503 Service Unavailable', [('Content-Type', 'text/html'), ('Retry-After', '30')])
+        return([get_error_page(RNAit_dir, 'The server is busy, please try again in a few minutes', 'runtime')])
+
+    client = admission.client_id(environ, config.get('admission') or {})
+
+    def run_job(progress, params):
+        # jobs wait on a background thread rather than holding up a request,
+        # so wait their turn rather than being turned away. Progress is
+        # reported while waiting, so the job isn't taken to be interrupted.
+        progress('Waiting for a search slot')
+        database_count = len(params.get('databases') or [1])
+        ticket, retry_after = admit_request(
+            config, client, [len(params.get('seq').seq)],
+            get_query_slots(config, database_count), blocking=True,
+            database_count=database_count,
+            waiting_function=lambda: progress('Waiting for a search slot'))
+        try:
+            return(run_query(params, config, progress))
+        finally:
+            if ticket:
+                get_admission(config).release(ticket)
+
+    jobs.submit(job_dir, job_id, int(job_config.get('workers', 2)), run_job, params)
+
+    location = re.sub(r'/job/?$', '', path) + '/job/' + job_id
+    start_response('303 See Other', [('Content-Type', 'text/html'), ('Location', location)])
+    return([b''])
+
+# batch_application
+#
+# Handles batch queries, designing and screening primers for each sequence of
+# a multi-fasta submission, or for a list of gene ids from the selected
+# database. A summary with the best suitable pair for each sequence is
+# streamed back as a TSV or JSON download as each group of sequences completes.
+#
+# required args: environ - environment dictionary
+#                start_response - WSGI start_response function
+#                config - dictionary of configuration settings
+#
+# returns: iterable of encoded response body chunks
+
+
+def batch_application(environ, start_response, config):
+    RNAit_dir = config.get('RNAit_dir')
+    batch_config = config.get('batch') or {}
+
+    with metrics.span('params'):
+        params = get_params(environ, batch=True)
+    records = params.get('seqs', [])
+    missing = []
+    if 'error' not in params and params.get('gene_ids'):
+        gene_records, missing, error = get_gene_records(
+            config, params.get('database'), params.get('gene_ids'))
+        if error:
+            params['error'] = error
+        records = records + gene_records
+    if 'error' not in params and len(records) + len(missing) == 0:
+        params['error'] = 'No sequences or gene ids provided'
+    max_records = int(batch_config.get('max_records', 1000))
+    if 'error' not in params and len(records) + len(missing) > max_records:
+        params['error'] = 'Batch queries are limited to %s sequences' % max_records
+
+    if 'error' in params:
+        start_response('200 OK', [('Content-Type', 'text/html')])
+        return([get_error_page(RNAit_dir, params.get('error'), 'submission')])
+
+    # the batch is admitted for as many blast searches as run_batch runs at once
+    processes = get_batch_processes(config)
+    ticket, retry_after = admit_request(
+        config, environ, [len(record.seq) for record in records], processes)
+    if retry_after:
+        return(get_busy_response(start_response, RNAit_dir, retry_after))
+
+    if params.get('format') == 'json':
+        start_response('200 OK', [
+            ('Content-Type', 'application/json'),
+            ('Content-Disposition', 'attachment; filename="RNAit_batch.json"')])
+    else:
+        start_response('200 OK', [
+            ('Content-Type', 'text/tab-separated-values'),
+            ('Content-Disposition', 'attachment; filename="RNAit_batch.tsv"')])
+
+    return(admitted_response(config, ticket,
+                             stream_batch(records, missing, params, config, processes)))
+
+# stream_batch
+#
+# Generates the encoded batch summary as results become available
+#
+# required args: records - list of Bio.seqRecord query objects
+#                missing - list of gene ids not found in the database
+#                params - dictionary of parsed form parameters
+#                config - dictionary of configuration settings
+#                processes - number of design processes and concurrent blastn
+#                            runs (see get_batch_processes)
+#
+# returns: generator of encoded TSV lines or JSON fragments
+
+
+def stream_batch(records, missing, params, config, processes):
+    json_format = params.get('format') == 'json'
+    summaries = []
+    for gene_id in missing:
+        summaries.append({'query': gene_id, 'status': 'Gene id not found in database'})
+
+    if json_format:
+        yield b'['
+    else:
+        yield ("\t".join(batch_fields) + "\n").encode('UTF-8')
+
+    first = True
+    for summary in itertools.chain(summaries, run_batch(records, params, config, processes)):
+        if json_format:
+            yield ((first and '\n' or ',\n') + json.dumps(summary)).encode('UTF-8')
+        else:
+            yield ("\t".join([str(summary.get(field, '')) for field in batch_fields]) +
+                   "\n").encode('UTF-8')
+        first = False
+
+    if json_format:
+        yield b'\n]\n'
+
+# run_batch
+#
+# Designs and screens primers for a list of query sequences. Primer design runs
+# in a process pool. Products are deduplicated across the whole batch, and
+# each group of queries has its new products screened in a few concurrent
+# blastn runs, split between the available cores.
+#
+# required args: records - list of Bio.seqRecord query objects
+#                params - dictionary of parsed form parameters
+#                config - dictionary of configuration settings
+#                processes - number of design processes and concurrent blastn
+#                            runs (see get_batch_processes)
+#
+# returns: generator of summary dictionaries (see get_batch_summary), in the
+#          same order as records
+
+
+def run_batch(records, params, config, processes):
+    batch_config = config.get('batch') or {}
+    chunk_size = int(batch_config.get('chunk_size', 20))
+    pool_socket = (config.get('blast_pool') or {}).get('socket')
+    blast_timeout = (config.get('blast_pool') or {}).get('timeout')
+    cache = get_result_cache(config)
+    blast_format = config.get('blast_format', 'tabular')
+    db = params.get('database')
     string_min = int(params.get('string_min'))
     string_max = int(params.get('string_max'))
     subunit_length = int(params.get('subunit_length'))
 
-    for pair in primers:
-        product = get_pcr_product(seq, pair)
-        blast_result, error = blast_product(
-            product, tmp_dir, db, string_min, string_max, subunit_length)
-        if (error):
-            return(get_error_page(RNAit_dir, error, 'runtime'))
-        blast_results.append(blast_result)
-    html = get_output_page(query_info, primers, RNAit_dir, blast_results)
+    # blast results for each product sequence screened so far
+    screened = {}
+
+    with ProcessPoolExecutor(max_workers=processes) as design_pool, \
+            ThreadPoolExecutor(max_workers=processes) as blast_threads:
+        for chunk_start in range(0, len(records), chunk_size):
+            chunk = records[chunk_start:chunk_start + chunk_size]
+            record_params = []
+            for record in chunk:
+                record_params.append(dict(params, seq=record, seqs=None))
+            designs = list(design_pool.map(
+                get_primer_pairs, record_params, itertools.repeat(False)))
+
+            new_products = {}
+            for record, (primers, error) in zip(chunk, designs):
+                if error:
+                    continue
+                for pair in primers:
+                    product = get_pcr_product(record, pair)
+                    if str(product.seq) not in screened:
+                        new_products[str(product.seq)] = product
+            new_products = list(new_products.values())
+
+            groups = []
+            group_size = max(1, -(-len(new_products) // processes))
+            for i in range(0, len(new_products), group_size):
+                groups.append(blast_threads.submit(
+                    metrics.context(), blast_products, new_products[i:i + group_size], db,
+                    string_min, string_max, subunit_length, pool_socket, cache,
+                    blast_format, None, bool(config.get('kmer_index')), blast_timeout))
+            blast_error = None
+            for i, group in zip(range(0, len(new_products), group_size), groups):
+                blast_results, error = group.result()
+                if error:
+                    blast_error = str(error)
+                    continue
+                for product, blast_result in zip(new_products[i:i + group_size], blast_results):
+                    screened[str(product.seq)] = blast_result
+
+            for record, (primers, error) in zip(chunk, designs):
+                if error or blast_error:
+                    yield {'query': record.id, 'length': len(record.seq),
+                           'status': str(error or blast_error)}
+                    continue
+                blast_results = []
+                for pair in primers:
+                    blast_results.append(
+                        screened.get(str(get_pcr_product(record, pair).seq)))
+                yield get_batch_summary(record, primers, blast_results)
+
+# get_batch_summary
+#
+# Summarises the results for one query of a batch, selecting the first (i.e.
+# lowest penalty) suitable primer pair
+#
+# required args: record - Bio.seqRecord query object
+#                primers - list of primer pair dictionaries
+#                blast_results - list of blast_data dictionaries for each pair
+#
+# returns: summary - dictionary with keys from batch_fields
+
 
-    return [html]
+def get_batch_summary(record, primers, blast_results):
+    summary = {
+        'query': record.id,
+        'length': len(record.seq),
+        'pairs': len(primers),
+        'suitable_pairs': 0,
+    }
+    for i, (pair, blast_result) in enumerate(zip(primers, blast_results)):
+        if blast_result.get('primer_status') != 'Suitable':
+            continue
+        summary['suitable_pairs'] += 1
+        if summary['suitable_pairs'] > 1:
+            continue
+        summary.update({
+            'pair': i + 1,
+            'left_seq': pair.get('LEFT_SEQ'),
+            'right_seq': pair.get('RIGHT_SEQ'),
+            'left_start': pair.get('LEFT_START'),
+            'right_start': pair.get('RIGHT_START'),
+            'left_tm': pair.get('LEFT_MELTING'),
+            'right_tm': pair.get('RIGHT_MELTING'),
+            'product_size': pair.get('PRODUCT_SIZE'),
+        })
+
+    if len(primers) == 0:
+        summary['status'] = 'No suitable primers found'
+    elif summary['suitable_pairs'] == 0:
+        summary['status'] = 'No suitable pairs'
+    else:
+        summary['status'] = 'Suitable'
+    return(summary)
+
+# alignment_application
+#
+# Returns the formatted alignments of a single hit from the alignment store,
+# for a results page fetching them on demand. Requests are
+# GET .../alignment/<page token>/<primer pair>/<self|other|matching>/<hit>, with
+# the database after the primer pair when the page shows several
+#
+# required args: environ - WSGI environment
+#                start_response - WSGI start_response function
+#                config - dictionary of configuration settings
+#
+# returns: html - list containing the encoded alignments
+
+
+def alignment_application(environ, start_response, config):
+    match = re.search(r'/alignment/([0-9a-f]{32}/\d+(?:/\w+)?/(self|other|matching)/\d+)$',
+                      environ.get('PATH_INFO', ''))
+    store = get_alignment_store(config)
+    hsp_alignments = None
+    if match and store:
+        hsp_alignments = store.get(match.group(1))
+    if hsp_alignments is None:
+        start_response('404 Not Found', [('Content-Type', 'text/html')])
+        return([b'These alignments have expired, please resubmit your query'])
+
+    blocks = get_template_env(config.get('RNAit_dir')).get_template('result_blocks.html').module
+    html = blocks.hit_alignments(hsp_alignments, match.group(2) == 'self')
+    start_response('200 OK', [('Content-Type', 'text/html')])
+    return([html.encode('UTF-8')])
+
+# get_gene_records
+#
+# Retrieves sequences for gene ids from the fasta file the selected blast
+# database was built from (see bin/reformat_tritrypdb_fasta.py). Ids may be
+# given with or without a transcript suffix i.e. Tb927.1.120 or
+# Tb927.1.120:mRNA
+#
+# required args: config - dictionary of configuration settings
+#                db - blast database name (string)
+#                gene_ids - list of gene ids
+#
+# returns: records - list of Bio.seqRecord objects, in the order requested
+#          missing - list of gene ids not found
+#          error - runtime error (string)
+
+
+def get_gene_records(config, db, gene_ids):
+    db_dir = os.environ.get('BLASTDB', config.get('db_dir'))
+    fasta_file = os.path.join(db_dir or '', db)
+    if not os.path.exists(fasta_file):
+        return([], [], 'Gene id lookup is not available for the %s database' % db)
+
+    wanted = set(gene_ids)
+    found = {}
+    for record in SeqIO.parse(fasta_file, 'fasta'):
+        for record_id in (record.id, record.id.split(':')[0]):
+            if record_id in wanted and record_id not in found:
+                found[record_id] = record
+
+    records = []
+    missing = []
+    for gene_id in gene_ids:
+        if gene_id in found:
+            records.append(found[gene_id])
+        else:
+            missing.append(gene_id)
+    return(records, missing, None)
 
 # get_params
 #
@@ -86,81 +1375,148 @@ def application(environ, start_response):
 #
 # required args: environ - environment dictionary
 #
-# returns: params - dictionary of parsed parameters
+# optional args: batch - accept multiple sequences (as params['seqs']) and
+#                        gene ids (as params['gene_ids']) for batch queries
+#                query_string - read the parameters of GET requests from the
+#                               query string
+#
+# returns: params - dictionary of parsed parameters. The 'database' field may
+#                   be given more than once: 'databases' lists each selected,
+#                   and 'database' is the first
 
 
-def get_params(environ):
+def get_params(environ, batch=False, query_string=False):
 
     post_env = environ.copy()
-    post_env['QUERY_STRING'] = ''
+    if not (query_string and environ.get('REQUEST_METHOD') in ('GET', 'HEAD')):
+        post_env['QUERY_STRING'] = ''
     post = cgi.FieldStorage(
         fp=environ['wsgi.input'],
         environ=post_env,
         keep_blank_values=True)
 
-    # For parameter validation...
-    param_checks = {
-        'melting_temp': 'int:50-75',
-        'product_min': 'int',
-        'product_max': 'int',
-        'string_min': 'int:>80',
-        'string_max': 'int:<99',
-        'subunit_length': 'int:15-25',
-        'database': 'string:"TbruceiTREU927|TbruceiGambienseDAL972|TbruceiLister427|TcongolenseIL3000"',
-    }
-
-    # for user-friendly output messages....
-    param_names = {
-        'melting_temp': 'melting temperature',
-        'product_min': 'minimum PCR product size',
-        'product_max': 'maximum PCR product size',
-        'string_min': 'minimum similarity',
-        'string_max': 'maximum similarity',
-        'subunit_length': 'subunit length',
-        'database': 'database',
-    }
-
     params = {}
     for f in post.list:
         # sequence fields need SeqIO.records creating
         if f.name == 'seqpaste' and f.value != '':
             seqH = io.StringIO(f.value)
             try:
-                record = SeqIO.read(seqH, 'fasta')
-                params['seq'] = record
+                if batch:
+                    params['seqs'] = read_batch_fasta(seqH)
+                else:
+                    record = SeqIO.read(seqH, 'fasta')
+                    params['seq'] = record
             except ValueError:
                 params['error'] = 'the entered sequence does not appear to be valid fasta format'
         elif f.name == 'upload' and post.getvalue('seqpaste') == '':
+            if batch and not f.filename:
+                continue
             raw_fasta = f.value.decode("utf-8")
             seqH = io.StringIO(raw_fasta)
             try:
-                record = SeqIO.read(seqH, 'fasta')
-                params['seq'] = record
+                if batch:
+                    params['seqs'] = read_batch_fasta(seqH)
+                else:
+                    record = SeqIO.read(seqH, 'fasta')
+                    params['seq'] = record
             except ValueError:
                 params['error'] = 'the uploaded sequence does not appear to be valid fasta format'
+        elif f.name == 'gene_ids' and batch:
+            gene_ids = re.split(r'[\s,;]+', f.value.strip())
+            params['gene_ids'] = [gene_id for gene_id in gene_ids if gene_id]
         else:  # other parameters need validating against criteria defined in param_checks
             param_type = param_checks.get(f.name)
             if param_type:
-                param_types = param_type.split(':')
-                criteria = ''
-                if len(param_types) > 1:
-                    criteria = param_types[1]
-                if param_types[0] == 'int':
-                    error = check_int(f.name, f.value, criteria, param_names)
-                    if error:
-                        params['error'] = error
-                elif param_types[0] == 'string':
-                    if not f.value in criteria:
-                        params['error'] = 'Invalid value (%s) provided for %s parameter: Valid options are %s' % (
-                            f.value, param_names.get(f.name), param_types[1])
+                error = check_param(f.name, f.value)
+                if error:
+                    params['error'] = error
+                    if param_type.startswith('string') or param_type == 'database':
                         return(params)
 
+            if f.name == 'database':
+                # several databases may be selected, the first being the one
+                # used where only one can be (e.g. batch gene id lookups)
+                params.setdefault('database', f.value)
+                if f.value not in params.setdefault('databases', []):
+                    params['databases'].append(f.value)
+                continue
             params[f.name] = f.value
     if bool(params) == False:
         params['error'] = 'No valid input parameters provided'
 
     return(params)
 
+# read_batch_fasta
+#
+# Reads all records from a multi-fasta handle
+#
+# required args: seqH - file handle
+#
+# returns: records - list of Bio.seqRecord objects
+#
+# raises ValueError if no records are found
+
+
+def read_batch_fasta(seqH):
+    records = list(SeqIO.parse(seqH, 'fasta'))
+    if len(records) == 0:
+        raise ValueError('No fasta records found')
+    return(records)
+
+# check_param
+#
+# checks a parameter value against the criteria defined in param_checks
+#
+# required args: name - parameter name (string)
+#                value - parameter value (string)
+#
+# optional args: db_dir - database directory to check database names against
+#                         (see get_database_names)
+#
+# returns: string (empty on success, error on failure)
+
+
+def check_param(name, value, db_dir=None):
+    param_type = param_checks.get(name)
+    if not param_type:
+        return('')
+    param_types = param_type.split(':')
+    criteria = ''
+    if len(param_types) > 1:
+        criteria = param_types[1]
+    if param_types[0] == 'int':
+        return(check_int(name, value, criteria, param_names))
+    elif param_types[0] == 'string':
+        if not value in param_options.get(name):
+            return('Invalid value (%s) provided for %s parameter: Valid options are %s' % (
+                value, param_names.get(name), param_types[1]))
+    elif param_types[0] == 'database':
+        database_names = get_database_names(db_dir)
+        if not value in database_names:
+            return('Invalid value (%s) provided for %s parameter: Valid options are "%s"' % (
+                value, param_names.get(name), '|'.join(database_names)))
+    return('')
+
+# get_database_names
+#
+# Lists the databases which can be searched, from the manifest of the
+# database directory (BLASTDB, or db_dir in the configuration)
+#
+# optional args: db_dir - database directory, for callers with their own
+#                         configuration ('' for none, so the defaults are
+#                         listed)
+#
+# returns: names - list of database names
+
+
+def get_database_names(db_dir=None):
+    if db_dir is None:
+        db_dir = os.environ.get('BLASTDB') or get_config().get('db_dir')
+    manifest = databases.load_manifest(db_dir) if db_dir else None
+    if not manifest:
+        return(default_databases)
+    return(sorted(manifest))
+
 # check_int
 #
 # checks provided integer parameter against specified critera
@@ -205,16 +1561,32 @@ def check_int(name, value, criteria, param_names):
 #
 # required args: params - dictionary of parsed form parameters
 #
-# returns: primers - list of primer pair dictionaries
+# optional args: format_product - add HTML formatted product (PRODUCT) to each
+#                                 pair (default True)
+#                num_return - number of pairs to ask primer3 for (int, default
+#                             primer3's own default of 5)
+#                cache - result_cache.ResultCache of previous primer3 designs,
+#                        and of the penalties of each template's designs, used
+#                        to narrow primer3's search (see get_narrowed_design)
+#                regions - list of [start, end] regions products must lie
+#                          within (see offtarget.clean_regions)
+#
+# returns: primers - list of primer pair dictionaries, lowest penalty first
 #          error - runtime error (string)
 
 
-def get_primer_pairs(params):
+def get_primer_pairs(params, format_product=True, num_return=None, cache=None,
+                     regions=None):
 
     seq_args = {
         'SEQUENCE_ID': params.get('seq').id,
         'SEQUENCE_TEMPLATE': str(params.get('seq').seq),
     }
+    if regions:
+        # each region allows both primers anywhere within it, so the product
+        # lies within it too
+        seq_args['SEQUENCE_PRIMER_PAIR_OK_REGION_LIST'] = [
+            [start, end - start, start, end - start] for start, end in regions]
 
     global_args = {
         'PRIMER_TASK': 'generic',
@@ -223,18 +1595,58 @@ def get_primer_pairs(params):
         'PRIMER_MAX_TM': 65,
         'PRIMER_MIN_TM': 55,
     }
+    if num_return:
+        global_args['PRIMER_NUM_RETURN'] = int(num_return)
 
     primers = {}
-    try:
-        primers = primer3.bindings.designPrimers(seq_args, global_args)
-    except OSError as error:
-        return(primers, error)
+    cache_key = None
+    if cache is not None:
+        # the design depends only on the template and primer3's arguments, so
+        # is shared by queries differing only in stringency or database
+        design_args = global_args
+        if regions:
+            design_args = dict(global_args, SEQUENCE_PRIMER_PAIR_OK_REGION_LIST=seq_args.get(
+                'SEQUENCE_PRIMER_PAIR_OK_REGION_LIST'))
+        cache_key = result_cache.design_key(seq_args.get('SEQUENCE_TEMPLATE'), design_args)
+        primers = cache.get(cache_key)
+        metrics.count('rnait_cache_lookups_total', store='primer_cache',
+                      result='miss' if primers is None else 'hit')
+    if not primers:
+        # designs of the same template with other settings suggest how far the
+        # search can be narrowed
+        template_key = None
+        bound = narrow_bound
+        if cache is not None:
+            template_key = result_cache.template_key(seq_args.get('SEQUENCE_TEMPLATE'))
+            template = cache.get(template_key)
+            if template:
+                bound = max(bound, 2 * template.get('penalty'))
+        try:
+            with metrics.span('primer3'):
+                primers = get_narrowed_design(seq_args, global_args, bound)
+                metrics.count('rnait_primer3_searches_total',
+                              search='full' if primers is None else 'narrowed')
+                if primers is None:
+                    primers = primer3.bindings.designPrimers(seq_args, global_args)
+        except OSError as error:
+            return({}, error)
+        if cache_key:
+            cache.put(cache_key, get_design_results(primers))
+        if template_key and primers.get('PRIMER_PAIR_NUM_RETURNED'):
+            cache.put(template_key, {'penalty': get_design_penalty(primers)})
 
     pair_count = int(primers.get('PRIMER_PAIR_NUM_RETURNED'))
     pairs = []
+    if format_product:
+        seq_lines = get_wrapped_sequence(str(params.get('seq').seq))
     for i in range(pair_count):
-        formatted_product = get_formatted_product(
-            str(params.get('seq').seq), primers, i)
+        formatted_product = None
+        if format_product:
+            formatted_product = get_formatted_product(
+                None,
+                (primers.get('PRIMER_LEFT_' + str(i)))[0],
+                (primers.get('PRIMER_RIGHT_' + str(i)))[0],
+                seq_lines)
 
         pair = {
             'LEFT_START': (primers.get('PRIMER_LEFT_' + str(i)))[0],
@@ -251,45 +1663,145 @@ def get_primer_pairs(params):
             'RIGHT_END_STAB': primers.get('PRIMER_RIGHT_' + str(i) + '_END_STABILITY'),
             'PRODUCT_SIZE': primers.get('PRIMER_PAIR_' + str(i) + '_PRODUCT_SIZE'),
             'COMP_END': primers.get('PRIMER_PAIR_' + str(i) + '_COMPL_END'),
+            'PENALTY': primers.get('PRIMER_PAIR_' + str(i) + '_PENALTY'),
             'PRODUCT': formatted_product,
         }
         pairs.append(pair)
 
     return(pairs, None)
 
-# get_formatted_product
+# get_narrowed_design
 #
-# Adds HTML highlighting to region of sequence to be amplified by primers
+# Runs primer3 with its oligo search limited to melting temperatures and sizes
+# within a penalty bound of the optimum, which avoids most of the work of a
+# full search. With the arguments RNAit gives primer3, an oligo's penalty is
+# its distance from the optimum melting temperature plus its distance from the
+# optimum size, and a pair's is the sum of its oligos', so oligos left out all
+# have penalties above the bound, and can't be part of a pair scoring below it.
+# primer3 orders oligos and pairs by penalty and then position, so leaving them
+# out doesn't change which of the remaining pairs it picks: if every pair
+# returned scores below the bound, the design is that of a full search.
 #
-# required args: seq - sequence
-#                primers - dictionary of primers returned from primer3.binding.designPrimers
-#                i - index of primer pair to use
+# required args: seq_args - dictionary of primer3 sequence arguments
+#                global_args - dictionary of primer3 global arguments
+#                bound - oligo penalty bound (float)
 #
-# returns: formatted_seq - sequence with html formatting applied
+# returns: primers - dictionary returned by designPrimers, None if the design
+#                    may differ from a full search
+
+
+def get_narrowed_design(seq_args, global_args, bound):
+    opt_tm = global_args.get('PRIMER_OPT_TM')
+    min_size = max(primer_sizes[0], primer_opt_size - int(bound))
+    max_size = min(primer_sizes[1], primer_opt_size + int(bound))
+    narrowed_args = dict(
+        global_args,
+        PRIMER_MIN_TM=max(global_args.get('PRIMER_MIN_TM'), opt_tm - bound),
+        PRIMER_MAX_TM=min(global_args.get('PRIMER_MAX_TM'), opt_tm + bound),
+        PRIMER_MIN_SIZE=min_size,
+        PRIMER_MAX_SIZE=max_size,
+    )
+    if narrowed_args['PRIMER_MIN_TM'] == global_args.get('PRIMER_MIN_TM') and \
+            narrowed_args['PRIMER_MAX_TM'] == global_args.get('PRIMER_MAX_TM') and \
+            (min_size, max_size) == primer_sizes:
+        return(None)
+
+    primers = primer3.bindings.designPrimers(seq_args, narrowed_args)
+    # primer3 treats pair penalties within 1e-6 as equal
+    if int(primers.get('PRIMER_PAIR_NUM_RETURNED')) < global_args.get('PRIMER_NUM_RETURN', 5) \
+            or get_design_penalty(primers) > bound - 1e-5:
+        return(None)
+    return(primers)
+
+# get_design_penalty
+#
+# required args: primers - dictionary returned by designPrimers, or its
+#                          cached fields (see get_design_results)
+#
+# returns: penalty - highest penalty of the pairs designed (float)
 
 
-def get_formatted_product(seq, primers, i):
+def get_design_penalty(primers):
+    return(max([primers.get('PRIMER_PAIR_%s_PENALTY' % i)
+                for i in range(int(primers.get('PRIMER_PAIR_NUM_RETURNED')))] or [0]))
+
+# get_wrapped_sequence
+#
+# Splits a sequence into the 60 column lines shown on the results page, each
+# with the padding and position which follow it. This is done once per query,
+# and the lines shared by the highlighting of every primer pair.
+#
+# required args: seq - sequence (string)
+#
+# returns: lines - list of (line start, line end, line, line suffix) tuples
 
-    start = (primers.get('PRIMER_LEFT_' + str(i)))[0]
-    end = (primers.get('PRIMER_RIGHT_' + str(i)))[0]
 
-    lines = textwrap.wrap(seq, width=60)
+def get_wrapped_sequence(seq):
+
+    if re.search(r'[\s-]', seq):
+        # textwrap drops whitespace and breaks after hyphens
+        wrapped = textwrap.wrap(seq, width=60)
+    else:
+        wrapped = [seq[i:i + 60] for i in range(0, len(seq), 60)]
+
+    lines = []
     count = 0
-    formatted_seq = ''
-    for line in lines:
-        max_length = count + 60
+    for line in wrapped:
         line_start = count
         count = count + len(line)
-        num_spaces = max_length - count + 4
-        spaces = '&nbsp;' * num_spaces
+        num_spaces = line_start + 60 - count + 4
+        lines.append((line_start, count, line, '&nbsp;' * num_spaces + str(count) + '<br/>'))
+
+    return(lines)
+
+# get_design_results
+#
+# Picks out the fields of a primer3 design used by get_primer_pairs, for
+# caching
+#
+# required args: primers - dictionary returned by designPrimers
+#
+# returns: results - dictionary
+
+
+def get_design_results(primers):
+    results = {'PRIMER_PAIR_NUM_RETURNED': primers.get('PRIMER_PAIR_NUM_RETURNED')}
+    for i in range(int(primers.get('PRIMER_PAIR_NUM_RETURNED'))):
+        for field in ('PRIMER_LEFT_%s', 'PRIMER_RIGHT_%s', 'PRIMER_LEFT_%s_SEQUENCE',
+                      'PRIMER_RIGHT_%s_SEQUENCE', 'PRIMER_LEFT_%s_GC_PERCENT',
+                      'PRIMER_RIGHT_%s_GC_PERCENT', 'PRIMER_LEFT_%s_TM', 'PRIMER_RIGHT_%s_TM',
+                      'PRIMER_LEFT_%s_END_STABILITY', 'PRIMER_RIGHT_%s_END_STABILITY',
+                      'PRIMER_PAIR_%s_PRODUCT_SIZE', 'PRIMER_PAIR_%s_COMPL_END',
+                      'PRIMER_PAIR_%s_PENALTY'):
+            results[field % i] = primers.get(field % i)
+    return(results)
+
+# get_formatted_product
+#
+# Adds HTML highlighting to region of sequence to be amplified by primers
+#
+# required args: seq - sequence (string, may be None if lines are given)
+#                start - start of the left primer (int)
+#                end - start of the right primer (int)
+#
+# optional args: lines - seq wrapped by get_wrapped_sequence, to reuse between
+#                        primer pairs
+#
+# returns: formatted_seq - sequence with html formatting applied
+
+
+def get_formatted_product(seq, start, end, lines=None):
+
+    if lines is None:
+        lines = get_wrapped_sequence(seq)
+    pieces = []
+    for line_start, count, line, suffix in lines:
 
         # add a <span> at the beginning of the product
         if(start > line_start and start < count):
             offset = start - line_start
-            left_flank = line[:offset]
-            product = line[offset:]
             line = "%s%s%s%s" % (
-                left_flank, '<span style="color:red">', product, '</span>')
+                line[:offset], '<span style="color:red">', line[offset:], '</span>')
 
         # wrap lines completely within product in <span>s
         if(end > line_start and start < line_start and end > count):
@@ -298,14 +1810,99 @@ def get_formatted_product(seq, primers, i):
         # add a <span> around the end of the product
         if(end > line_start and end <= count):
             offset = end - line_start
-            product = line[:offset + 1]
-            right_flank = line[offset + 1:]
             line = "%s%s%s%s" % ('<span style="color:red">',
-                                 product, '</span>', right_flank)
+                                 line[:offset + 1], '</span>', line[offset + 1:])
+
+        pieces.append(line)
+        pieces.append(suffix)
+
+    return(''.join(pieces))
+
+# get_pair_product
+#
+# Formats the product of a primer pair for the results page: highlighted in
+# the query, or with an off-target profile, drawn over the query's profile
+# (see get_profile_product)
+#
+# required args: pair - primer pair dictionary (see get_primer_pairs)
+#                lines - query wrapped by get_wrapped_sequence
+#                profile - off-target profile (see get_offtarget_profile), or
+#                          None
+#
+# returns: formatted_seq - html
 
-        formatted_seq = "%s%s%s%s<br/>" % (formatted_seq, line, spaces, count)
 
-    return(formatted_seq)
+def get_pair_product(pair, lines, profile):
+    if profile:
+        return(get_profile_product(pair.get('LEFT_START'), pair.get('RIGHT_START'),
+                                   lines, profile))
+    return(get_formatted_product(None, pair.get('LEFT_START'), pair.get('RIGHT_START'),
+                                 lines))
+
+# get_profile_product
+#
+# Draws the off-target profile of the query, with a product marked, above the
+# query sequence, in which the product is shown in bold and off-target
+# stretches are shaded
+#
+# required args: start - start of the left primer (int)
+#                end - start of the right primer (int)
+#                lines - query wrapped by get_wrapped_sequence
+#                profile - off-target profile (see get_offtarget_profile)
+#
+# returns: formatted_seq - html
+
+
+def get_profile_product(start, end, lines, profile):
+    coverage = profile.get('coverage')
+    length = lines[-1][1] if lines else 0
+    width = 600
+    height = 40
+
+    # the profile, as the highest coverage in each bin, and product as bars
+    values = offtarget.get_bins(coverage, width)
+    top = max(int(coverage.max()) if len(coverage) else 0, 1)
+    step = width / max(len(values), 1)
+    path = ["M0,%s" % height]
+    bounds = np.concatenate(([0], np.flatnonzero(np.diff(values)) + 1, [len(values)]))
+    for bin_start, bin_end in zip(bounds[:-1], bounds[1:]):
+        y = height - height * int(values[bin_start]) / top
+        path.append("L%.1f,%.1f L%.1f,%.1f" % (bin_start * step, y, bin_end * step, y))
+    path.append("L%s,%s Z" % (width, height))
+    scale = width / max(length, 1)
+    pieces = [
+        "<svg xmlns='http://www.w3.org/2000/svg' width='100%%' height='%s' "
+        "viewBox='0 0 %s %s' preserveAspectRatio='none'>" % (height, width, height),
+        "<rect x='%.1f' y='0' width='%.1f' height='%s' fill='#cce5ff'/>" % (
+            start * scale, (end - start + 1) * scale, height),
+        "<path d='%s' fill='#dc3545'/></svg><br/>" % ' '.join(path),
+        "Off-target stretches of %s bp or more (up to %s per base): shaded; "
+        "product: bold<br/>" % (profile.get('subunit_length'), int(coverage.max())
+                                 if len(coverage) else 0),
+    ]
+
+    # 1 marks product bases and 2 off-target ones, and the sequence is split
+    # into spans wherever the marking changes
+    state = np.zeros(max(length, len(coverage)), dtype=np.int8)
+    state[:len(coverage)] = (coverage > 0) * 2
+    state[start:end + 1] += 1
+    changes = np.flatnonzero(np.diff(state)) + 1
+    styles = ('', 'font-weight:bold', 'background-color:#f8d7da',
+              'font-weight:bold;background-color:#f8d7da')
+    for line_start, count, line, suffix in lines:
+        bounds = [line_start] + changes[
+            np.searchsorted(changes, line_start, side='right'):
+            np.searchsorted(changes, count, side='left')].tolist() + [count]
+        for segment_start, segment_end in zip(bounds[:-1], bounds[1:]):
+            text = line[segment_start - line_start:segment_end - line_start]
+            style = styles[state[segment_start]]
+            if style:
+                pieces.append('<span style="%s">%s</span>' % (style, text))
+            else:
+                pieces.append(text)
+        pieces.append(suffix)
+
+    return(''.join(pieces))
 
 # get_pcr_product
 #
@@ -326,6 +1923,261 @@ def get_pcr_product(seq, pair):
     product = seq[start:end]
     return(product)
 
+# screen_primer_pairs
+#
+# Screens the products of a set of primer pairs against a blast database (see
+# iter_screened_pairs)
+#
+# required args: seq - Bio.seqRecord object of query sequence
+#                primers - list of primer pair dictionaries (see get_primer_pairs)
+#                db - blast database name
+#                string_min - minimum identity of conflicting hits (int)
+#                string_max - maximum identity of conflicting hits (int)
+#                subunit_length - maximum permitted identical stretch (int)
+#                config - dictionary of configuration settings
+#
+# optional args: progress - function called with (stage, done, total) as
+#                           products are screened
+#
+# returns: primers - list of primer pair dictionaries
+#          blast_results - list of blast_data dictionaries (see
+#                          classify_blast_record), in the same order as primers
+#          error - runtime error (string)
+
+
+def screen_primer_pairs(seq, primers, db, string_min, string_max,
+                        subunit_length, config, progress=None):
+    pairs = []
+    blast_results = []
+    for pair, blast_result, error in iter_screened_pairs(
+            seq, primers, db, string_min, string_max, subunit_length, config,
+            progress):
+        if error:
+            return([], [], error)
+        pairs.append(pair)
+        blast_results.append(blast_result)
+    return(pairs, blast_results, None)
+
+# iter_screened_pairs
+#
+# Screens the products of a set of primer pairs against a blast database,
+# yielding each pair to be shown as soon as its result is known.
+#
+# With 'adaptive_screen' configured, primers should have been designed with
+# adaptive_screen.candidates pairs requested. Pairs amplifying the same
+# product are grouped, keeping the lowest penalty pair of each, and the
+# distinct products are screened in groups of adaptive_screen.batch_size, up
+# to adaptive_screen.workers groups at once, in penalty order. Suitable pairs
+# are yielded, lowest penalty first, as their group completes, until
+# adaptive_screen.suitable_pairs have been found. If fewer are found, the
+# lowest penalty unsuitable pairs make up the numbers.
+#
+# Otherwise every pair is screened in a single search and yielded in its
+# original order.
+#
+# required args: as for screen_primer_pairs
+#
+# optional args: progress - function called with (stage, done, total) as
+#                           products are screened
+#
+# yields: (pair, blast_data, None) tuples, or (None, None, error) if a runtime
+#         error occurs, after which nothing further is yielded
+
+
+def iter_screened_pairs(seq, primers, db, string_min, string_max,
+                        subunit_length, config, progress=None):
+    blast_args = (
+        (config.get('blast_pool') or {}).get('socket'),
+        get_result_cache(config),
+        config.get('blast_format', 'tabular'),
+    )
+    kmer_screen = bool(config.get('kmer_index'))
+    blast_timeout = (config.get('blast_pool') or {}).get('timeout')
+    screen_config = config.get('adaptive_screen')
+
+    if not screen_config:
+        products = []
+        for pair in primers:
+            products.append(get_pcr_product(seq, pair))
+        blast_results, error = blast_products(
+            products, db, string_min, string_max, subunit_length,
+            *blast_args, progress=progress, kmer_screen=kmer_screen,
+            blast_timeout=blast_timeout)
+        if error:
+            yield (None, None, error)
+            return
+        for pair, blast_result in zip(primers, blast_results):
+            yield (pair, blast_result, None)
+        return
+
+    suitable_pairs = int(screen_config.get('suitable_pairs', 5))
+    batch_size = int(screen_config.get('batch_size', 5))
+    workers = int(screen_config.get('workers', 4))
+
+    # primer3 returns pairs lowest penalty first, so the first pair for each
+    # product is the best
+    pairs = {}
+    for pair in sorted(primers, key=lambda p: p.get('PENALTY') or 0):
+        pairs.setdefault((pair.get('LEFT_START'), pair.get('RIGHT_START')), pair)
+    pairs = list(pairs.values())
+
+    def screen_batch(batch):
+        products = []
+        for pair in batch:
+            products.append(get_pcr_product(seq, pair))
+        return(blast_products(products, db, string_min, string_max,
+                              subunit_length, *blast_args,
+                              kmer_screen=kmer_screen, blast_timeout=blast_timeout))
+
+    # batches are submitted in penalty order and collected in the same order,
+    # so the pairs found are always the best suitable ones, whichever batch
+    # finishes first. Batches not yet started are cancelled on stopping.
+    executor = ThreadPoolExecutor(max_workers=workers)
+    futures = []
+    for i in range(0, len(pairs), batch_size):
+        batch = pairs[i:i + batch_size]
+        futures.append((batch, executor.submit(metrics.context(), screen_batch, batch)))
+
+    screened = 0
+    found = 0
+    unsuitable = []
+    try:
+        for batch, future in futures:
+            blast_results, error = future.result()
+            if error:
+                yield (None, None, error)
+                return
+            screened += len(batch)
+            if progress:
+                progress('Screening candidate primer pairs', screened, len(pairs))
+            for pair, blast_result in zip(batch, blast_results):
+                if blast_result.get('primer_status') != 'Suitable':
+                    unsuitable.append((pair, blast_result))
+                elif found < suitable_pairs:
+                    found += 1
+                    yield (pair, blast_result, None)
+            if found >= suitable_pairs:
+                return
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    for pair, blast_result in unsuitable[:suitable_pairs - found]:
+        yield (pair, blast_result, None)
+
+# screen_databases
+#
+# Screens the products of a set of primer pairs against several blast
+# databases at once. The products are prepared once, and searched against each
+# database concurrently, in a single search per database, so the screen takes
+# about as long as the slowest database. Pairs amplifying the same product are
+# grouped, keeping the lowest penalty pair of each. Pairs are returned suitable
+# in the most databases first, then lowest penalty first.
+#
+# With adaptive screening configured, at most adaptive_screen.suitable_pairs
+# are returned, and pairs are screened in groups of adaptive_screen.batch_size
+# in penalty order, each group against every database at once. Screening stops
+# once enough pairs are suitable in every database, as no pair not yet screened
+# could rank above them.
+#
+# required args: seq - Bio.seqRecord object of the query
+#                primers - list of primer pair dictionaries (see get_primer_pairs)
+#                dbs - blast database names (list of strings)
+#                string_min - minimum identity of conflicting hits (int)
+#                string_max - maximum identity of conflicting hits (int)
+#                subunit_length - maximum permitted identical stretch (int)
+#                config - dictionary of configuration settings
+#
+# optional args: progress - function called with (stage, done, total) as
+#                           databases are screened
+#
+# returns: primers - list of primer pair dictionaries
+#          screens - list of (database, blast_data) lists, one entry per
+#                    database in the order of dbs, in the same order as primers
+#          error - runtime error (string)
+
+
+def screen_databases(seq, primers, dbs, string_min, string_max,
+                     subunit_length, config, progress=None):
+    pairs = {}
+    for pair in sorted(primers, key=lambda p: p.get('PENALTY') or 0):
+        pairs.setdefault((pair.get('LEFT_START'), pair.get('RIGHT_START')), pair)
+    pairs = list(pairs.values())
+
+    screen_config = config.get('adaptive_screen')
+    suitable_pairs = None
+    batch_size = max(1, len(pairs))
+    if screen_config:
+        suitable_pairs = int(screen_config.get('suitable_pairs', 5))
+        batch_size = max(1, int(screen_config.get('batch_size', 5)))
+
+    blast_args = (
+        (config.get('blast_pool') or {}).get('socket'),
+        get_result_cache(config),
+        config.get('blast_format', 'tabular'),
+    )
+    kmer_screen = bool(config.get('kmer_index'))
+    blast_timeout = (config.get('blast_pool') or {}).get('timeout')
+    screens = []
+    found = 0
+    if progress:
+        progress('Screening against databases', 0, len(pairs))
+    with ThreadPoolExecutor(max_workers=len(dbs)) as executor:
+        for start in range(0, len(pairs), batch_size):
+            products = []
+            for pair in pairs[start:start + batch_size]:
+                products.append(get_pcr_product(seq, pair))
+            futures = {}
+            for db in dbs:
+                future = executor.submit(
+                    metrics.context(), blast_products, products, db, string_min,
+                    string_max, subunit_length, *blast_args, kmer_screen=kmer_screen,
+                    blast_timeout=blast_timeout)
+                futures[future] = db
+            results = {}
+            for future in as_completed(futures):
+                blast_results, error = future.result()
+                if error:
+                    for other in futures:
+                        other.cancel()
+                    return([], [], error)
+                results[futures[future]] = blast_results
+            for i in range(len(products)):
+                screen = [(db, results[db][i]) for db in dbs]
+                screens.append(screen)
+                if all(r.get('primer_status') == 'Suitable' for db, r in screen):
+                    found += 1
+            if progress:
+                progress('Screening against databases', len(screens), len(pairs))
+            if suitable_pairs is not None and found >= suitable_pairs:
+                break
+
+    order = sorted(range(len(screens)), key=lambda i: (
+        -len([r for db, r in screens[i] if r.get('primer_status') == 'Suitable']),
+        pairs[i].get('PENALTY') or 0))
+    if suitable_pairs is not None:
+        order = order[:suitable_pairs]
+    return([pairs[i] for i in order], [screens[i] for i in order], None)
+
+# get_database_status
+#
+# Summarises the screens of a primer pair against several databases
+#
+# required args: screen - list of (database, blast_data) tuples (see
+#                         screen_databases)
+#
+# returns: status - 'Suitable' if suitable against every database, 'Bad' if
+#                   against none, otherwise the number of databases it is
+#                   suitable against (string)
+
+
+def get_database_status(screen):
+    suitable = len([r for db, r in screen if r.get('primer_status') == 'Suitable'])
+    if suitable == len(screen):
+        return('Suitable')
+    if suitable == 0:
+        return('Bad')
+    return("Suitable in %s of %s databases" % (suitable, len(screen)))
+
 # blast_product
 #
 # Blasts pcr product against organism genome database to identify
@@ -333,42 +2185,518 @@ def get_pcr_product(seq, pair):
 # required args: product - Bio:seqRecord object representing pcr product
 #                db - blast database name
 #
-# returns: blast_data - dictionary containing 'record' (blast_record
-# object), alignment status etc.
+# returns: blast_data - screen_result.ScreenResult (see classify_blast_record)
 
 
-def blast_product(product, tmp_dir, db, string_min,
-                  string_max, subunit_length):
-    blast_dir = mkdtemp(dir=tmp_dir)
-    queryFileName = blast_dir + '/query'
-    outFileName = blast_dir + '/output.xml'
+def blast_product(product, db, string_min,
+                  string_max, subunit_length, pool_socket=None):
+    blast_results, error = blast_products(
+        [product], db, string_min, string_max, subunit_length,
+        pool_socket)
+    if error:
+        return('', error)
+    return(blast_results[0], None)
 
-    SeqIO.write(product, queryFileName, 'fasta')
-    cline = NcbiblastnCommandline(
-        cmd='blastn',
-        query=queryFileName,
-        out=outFileName,
-        outfmt=5,
-        db=db,
-        task='blastn'
+# blast_products
+#
+# Blasts a set of pcr products against organism genome database in a single
+# blastn run. Products are written as one multi-fasta query with unique ids,
+# and the resulting records are split back out by query id, so blastn startup
+# and database loading are only paid once per request
+#
+# required args: products - list of Bio:seqRecord objects representing pcr products
+#                db - blast database name
+#                string_min - minimum identity of conflicting hits (int)
+#                string_max - maximum identity of conflicting hits (int)
+#                subunit_length - maximum permitted identical stretch (int)
+#
+# optional args: pool_socket - path to blast pool socket (see blast_pool.py)
+#                cache - result_cache.ResultCache for previously classified products
+#                blast_format - 'tabular' (default) or 'xml' blastn output
+#                progress - function called with (stage, done, total) as
+#                           products are screened
+#                kmer_screen - check products against the database k-mer index
+#                              first, and skip blast for products which can
+#                              only be suitable (see kmer_index.py)
+#                blast_timeout - seconds allowed for the blast search (see
+#                                run_blast)
+#
+# returns: blast_results - list of screen_result.ScreenResult (see
+#                          classify_blast_record), in the same order as products
+#          error - runtime error (string)
+
+
+def blast_products(products, db, string_min,
+                   string_max, subunit_length, pool_socket=None, cache=None,
+                   blast_format='tabular', progress=None, kmer_screen=False,
+                   blast_timeout=None):
+    blast_results = [None] * len(products)
+    cache_keys = [None] * len(products)
+    if cache:
+        db_version = result_cache.database_version(db)
+        for i, product in enumerate(products):
+            cache_keys[i] = result_cache.result_key(
+                db, db_version, str(product.seq), string_min, string_max,
+                subunit_length)
+            cached = cache.get(cache_keys[i])
+            if cached is not None:
+                blast_results[i] = screen_result.ScreenResult.from_dict(cached)
+            metrics.count('rnait_cache_lookups_total', store='result_cache',
+                          result='miss' if blast_results[i] is None else 'hit')
+
+    index = None
+    if kmer_screen:
+        index = kmer_index.load(db)
+    if index is not None:
+        for i, product in enumerate(products):
+            if blast_results[i] is not None:
+                continue
+            shared = kmer_index.screen(index, str(product.seq), subunit_length)
+            if kmer_index.classify(str(product.seq), shared, subunit_length) == 'unique':
+                blast_results[i] = get_kmer_blast_data(index, product, shared)
+            metrics.count('rnait_cache_lookups_total', store='kmer_index',
+                          result='miss' if blast_results[i] is None else 'hit')
+
+    # products from the same query all share its id, so give each a unique one
+    queries = []
+    for i, product in enumerate(products):
+        if blast_results[i] is None:
+            queries.append(SeqRecord(product.seq, id='product_' + str(i), description=''))
+    if progress:
+        progress('Searching primer pairs', len(products) - len(queries), len(products))
+    if not queries:
+        count_blast_results(blast_results)
+        return(blast_results, None)
+
+    blast_output, error = run_blast(
+        queries, db, pool_socket, blast_format, blast_timeout)
+    if error:
+        return([], error)
+
+    with metrics.span('parse'):
+        if blast_format == 'tabular':
+            blast_records = parse_tabular_blast(blast_output, queries)
+        else:
+            blast_records = {}
+            for blast_record in NCBIXML.parse(io.StringIO(blast_output)):
+                blast_records[blast_record.query.split()[0]] = blast_record
+
+    for query in queries:
+        blast_record = blast_records.get(query.id)
+        if blast_record is None:
+            return([], 'No blast results returned for ' + query.id)
+        i = int(query.id.split('_')[1])
+        with metrics.span('classify'):
+            blast_results[i] = classify_blast_record(
+                blast_record, string_min, string_max, subunit_length)
+        if cache:
+            cache.put(cache_keys[i], blast_results[i].to_dict())
+        if progress:
+            progress('Searching primer pairs',
+                     len([r for r in blast_results if r is not None]), len(products))
+
+    count_blast_results(blast_results)
+    return(blast_results, None)
+
+# count_blast_results
+#
+# Adds screened products and their hits to the request metrics
+#
+# required args: blast_results - list of blast_data dictionaries (see
+#                                classify_blast_record)
+
+
+def count_blast_results(blast_results):
+    for blast_result in blast_results:
+        metrics.count('rnait_primer_pairs_total', status=blast_result.get('primer_status'))
+        for category in ('self', 'conflicting', 'matching'):
+            hits = len(blast_result.get(category + '_alignments'))
+            if hits:
+                metrics.count('rnait_hits_total', hits, category=category)
+
+# get_kmer_blast_data
+#
+# Generates the blast_data for a product found to be unique by the k-mer index,
+# which will have at most one (identical) self hit. Alignments of the self
+# hit aren't available without a blast search.
+#
+# required args: index - k-mer index (see kmer_index.load)
+#                product - Bio:seqRecord object representing pcr product
+#                shared - list of (transcript id, stretch) from kmer_index.screen
+#
+# returns: blast_data - screen_result.ScreenResult as for classify_blast_record
+
+
+def get_kmer_blast_data(index, product, shared):
+    self_alignments = []
+    for transcript, stretch in shared:
+        self_alignments.append(screen_result.Hit(
+            accession='gnl|BL_ORD_ID|%s' % transcript,
+            description=index['titles'][transcript],
+            subj_length=int(index['lengths'][transcript]),
+            status='Self alignment',
+            reasons=[],
+            hsps=1,
+            ident=format_ident(1),
+            hsp_alignments=[],
+            hsp_hit_lengths=str(len(product.seq)),
+        ))
+
+    blast_data = screen_result.ScreenResult(
+        primer_status='Suitable',
+        self_hits=len(self_alignments),
+        self_alignments=self_alignments,
+        conflicting_alignments=[],
+        matching_alignments=[],
+        kmer_screened=True,
     )
-    stderr = ''
+    return(blast_data)
+
+# get_result_cache
+#
+# Returns the blast result cache for this worker process, creating it on first
+# use from the 'result_cache' section of the configuration
+#
+# required args: config - dictionary of configuration settings
+#
+# returns: cache - result_cache.ResultCache object, or None if not configured
+
+
+def get_result_cache(config):
+    global blast_result_cache
+    cache_config = config.get('result_cache')
+    if not cache_config:
+        return(None)
+    if blast_result_cache is None:
+        blast_result_cache = result_cache.ResultCache(
+            memory_entries=int(cache_config.get('memory_entries', 1024)),
+            disk_path=cache_config.get('disk_path'),
+            disk_entries=int(cache_config.get('disk_entries', 100000)))
+    return(blast_result_cache)
+
+# get_primer_cache
+#
+# Returns this worker's cache of primer3 designs, creating it on first use
+#
+# required args: config - dictionary of configuration settings
+#
+# returns: cache - result_cache.ResultCache, None if not configured
+
+
+def get_primer_cache(config):
+    global primer_design_cache
+    cache_config = config.get('primer_cache')
+    if not cache_config:
+        return(None)
+    if primer_design_cache is None:
+        primer_design_cache = result_cache.ResultCache(
+            memory_entries=int(cache_config.get('memory_entries', 256)),
+            disk_path=cache_config.get('disk_path'),
+            disk_entries=int(cache_config.get('disk_entries', 10000)))
+    return(primer_design_cache)
+
+# get_atlas
+#
+# Returns the precomputed results store for this worker process, opening it on
+# first use from the 'atlas' section of the configuration
+#
+# required args: config - dictionary of configuration settings
+#
+# returns: atlas_store - atlas.Atlas object, or None if not configured or not
+#                        yet built
+
+
+def get_atlas(config):
+    global atlas_store
+    atlas_config = config.get('atlas')
+    if not atlas_config:
+        return(None)
+    if atlas_store is None and os.path.exists(atlas_config.get('path')):
+        atlas_store = atlas.Atlas(atlas_config.get('path'), readonly=True)
+    return(atlas_store)
+
+# get_alignment_store
+#
+# Returns the alignment store for this worker process, opening it on first
+# use from the 'alignments' section of the configuration
+#
+# required args: config - dictionary of configuration settings
+#
+# returns: store - alignment_store.AlignmentStore object, or None if
+#                  alignments are embedded in the results page
+
+
+def get_alignment_store(config):
+    global hit_alignment_store
+    alignment_config = config.get('alignments') or {}
+    if not alignment_config.get('store'):
+        return(None)
+    if hit_alignment_store is None:
+        hit_alignment_store = alignment_store.AlignmentStore(
+            alignment_config.get('store'),
+            int(alignment_config.get('expiry', 86400)))
+    return(hit_alignment_store)
+
+# get_admission
+#
+# Returns this worker's connection to the admission database, creating it on
+# first use
+#
+# required args: config - dictionary of configuration settings
+#
+# returns: admission - admission.Admission, None if admission control is not
+#                      configured
+
+
+def get_admission(config):
+    global request_admission
+    admission_config = config.get('admission') or {}
+    if not admission_config.get('path'):
+        return(None)
+    if request_admission is None:
+        request_admission = admission.Admission(admission_config.get('path'), admission_config)
+    request_admission.settings = admission_config
+    return(request_admission)
+
+# admit_request
+#
+# Waits for a query to be admitted (see admission.py)
+#
+# required args: config - dictionary of configuration settings
+#                client - WSGI environment of the request, or client id (string)
+#                lengths - lengths of the query sequences (list of int)
+#                slots - blast searches the query may run at once (int)
+#
+# optional args: blocking - wait until admitted, however long it takes
+#                database_count - number of databases each sequence is
+#                                 screened against (int, default 1)
+#                waiting_function - function called periodically while the
+#                                   query waits (see admission.acquire)
+#
+# returns: ticket - admission ticket to release once the query is complete,
+#                   None if not admitted or admission control isn't configured
+#          retry_after - seconds the client should wait before retrying when
+#                        the server is too busy (int), otherwise None
+
+
+def admit_request(config, client, lengths, slots, blocking=False, database_count=1,
+                  waiting_function=None):
+    store = get_admission(config)
+    if store is None:
+        return(None, None)
+    if isinstance(client, dict):
+        client = admission.client_id(client, store.settings)
+    start = time.time()
+    ticket, retry_after = store.acquire(
+        client, admission.estimate_cost(lengths, store.settings, database_count), slots,
+        blocking, waiting_function)
+    metrics.observe('rnait_admission_wait_seconds', time.time() - start)
+    metrics.count('rnait_admissions_total', result='busy' if retry_after else 'admitted')
+    return(ticket, retry_after)
+
+# admitted_response
+#
+# Releases a query's admission once its response has been sent
+#
+# required args: config - dictionary of configuration settings
+#                ticket - ticket from admit_request (string or None)
+#                response - WSGI response iterable
+#
+# yields: response pieces
+
+
+def admitted_response(config, ticket, response):
     try:
-        stdout, stderr = cline()
-    except ApplicationError as err:
-        return('', err.stderr)
+        for piece in response:
+            yield piece
+    finally:
+        if ticket:
+            get_admission(config).release(ticket)
+
+# get_query_slots
+#
+# required args: config - dictionary of configuration settings
+#
+# optional args: database_count - number of databases the query is screened
+#                                 against (int, default 1)
+#
+# returns: slots - blast searches a single query may run at once (int)
+
+
+def get_query_slots(config, database_count=1):
+    if database_count > 1:
+        # one search per database, all at once (see screen_databases)
+        return(database_count)
+    screen_config = config.get('adaptive_screen')
+    if not screen_config:
+        return(1)
+    return(int(screen_config.get('workers', 4)))
+
+# get_batch_processes
+#
+# required args: config - dictionary of configuration settings
+#
+# returns: processes - design processes and concurrent blast searches of a
+#                      batch query (int)
+
+
+def get_batch_processes(config):
+    batch_config = config.get('batch') or {}
+    return(int(batch_config.get('processes', os.cpu_count())))
+
+# get_busy_response
+#
+# Turns a query away while the server is busy
+#
+# required args: start_response - WSGI start_response function
+#                RNAit_dir - path to RNAit installation (string)
+#                retry_after - seconds the client should wait (int)
+#
+# returns: list containing encoded error page
+
+
+def get_busy_response(start_response, RNAit_dir, retry_after):
+    start_response('503 Service Unavailable', [('Content-Type', 'text/html'),
+                                                ('Retry-After', str(retry_after))])
+    return([get_error_page(
+        RNAit_dir, 'The server is busy, please try again in %s seconds' % retry_after,
+        'runtime')])
+
+# run_blast
+#
+# Runs blastn for a set of query sequences, using the persistent blast pool
+# if one is configured and running, otherwise running blastn directly
+#
+# required args: queries - list of Bio:seqRecord objects
+#                db - blast database name
+#
+# optional args: pool_socket - path to blast pool socket, or None
+#                blast_format - 'tabular' (default) or 'xml'
+#                timeout - seconds allowed for the search (default
+#                          blast_pool.BLAST_TIMEOUT)
+#
+# returns: blast_output - blastn output (string)
+#          error - runtime error (string)
+
+
+def run_blast(queries, db, pool_socket=None, blast_format='tabular', timeout=None):
+    timeout = int(timeout or blast_pool.BLAST_TIMEOUT)
+    if blast_format == 'tabular':
+        outfmt = '6 ' + ' '.join(tabular_fields)
+    else:
+        outfmt = '5'
+
+    queryH = io.StringIO()
+    SeqIO.write(queries, queryH, 'fasta')
+
+    with metrics.span('blast', database=db):
+        if pool_socket:
+            try:
+                return(blast_pool.submit(pool_socket, db, queryH.getvalue(), outfmt,
+                                         timeout))
+            except OSError:
+                # pool not running, or not yet serving a newly added database -
+                # fall back to running blastn ourselves
+                pass
+
+        # query is piped to blastn and results read back from its stdout, so no
+        # temporary files are needed
+        return(blast_pool.run_blastn(db, queryH.getvalue(), outfmt, timeout))
+
+# parse_tabular_blast
+#
+# Parses tabular blastn output (see tabular_fields) into Bio.Blast.Record
+# objects, so results can be classified in the same way as XML output without
+# the cost of generating and parsing XML. Hits and HSPs are kept in the order
+# reported by blastn. The '|' alignment midline is not part of tabular output,
+# so is reconstructed from the aligned query and subject sequences.
+#
+# required args: blast_output - tabular blastn output (string)
+#                queries - list of Bio:seqRecord query objects
+#
+# returns: blast_records - dictionary of query id -> Bio.Blast.Record.Blast
+
+
+def parse_tabular_blast(blast_output, queries):
+    blast_records = {}
+    for query in queries:
+        blast_record = Record.Blast()
+        blast_record.query = query.id
+        blast_record.query_letters = len(query.seq)
+        blast_records[query.id] = blast_record
+
+    hits = {}
+    for line in blast_output.splitlines():
+        if not line or line.startswith('#'):
+            continue
+        fields = dict(zip(tabular_fields, line.split('\t')))
+        blast_record = blast_records.get(fields['qseqid'])
+        if blast_record is None:
+            continue
+        alignment = hits.get((fields['qseqid'], fields['sseqid']))
+        if alignment is None:
+            alignment = Record.Alignment()
+            alignment.hit_id = fields['sseqid']
+            alignment.hit_def = fields['stitle']
+            alignment.length = int(fields['slen'])
+            hits[(fields['qseqid'], fields['sseqid'])] = alignment
+            blast_record.alignments.append(alignment)
+
+        hsp = Record.HSP()
+        hsp.score = float(fields['score'])
+        hsp.bits = float(fields['bitscore'])
+        hsp.expect = float(fields['evalue'])
+        hsp.identities = int(fields['nident'])
+        hsp.align_length = int(fields['length'])
+        hsp.query_start = int(fields['qstart'])
+        hsp.sbjct_start = int(fields['sstart'])
+        hsp.query = fields['qseq']
+        hsp.sbjct = fields['sseq']
+        hsp.match = get_midline(hsp.query, hsp.sbjct)
+        alignment.hsps.append(hsp)
+
+    return(blast_records)
+
+# get_midline
+#
+# Generates a blastn style alignment midline, with '|' for identical bases
+#
+# required args: query - aligned query sequence (string)
+#                sbjct - aligned subject sequence (string)
+#
+# returns: midline - string
+
 
-    result_handle = open(outFileName)
+def get_midline(query, sbjct):
+    if query == sbjct:
+        return('|' * len(query))
+    return(''.join(['|' if q == s else ' ' for q, s in zip(query, sbjct)]))
+
+# classify_blast_record
+#
+# Classifies the hits of a single pcr product blast record as self,
+# conflicting or matching alignments and determines the primer status
+#
+# required args: blast_record - Bio.Blast.Record.Blast object
+#                string_min - minimum identity of conflicting hits (int)
+#                string_max - maximum identity of conflicting hits (int)
+#                subunit_length - maximum permitted identical stretch (int)
+#
+# returns: blast_data - screen_result.ScreenResult with the primer status and
+#                       the self, conflicting and matching hits. The blast
+#                       record itself isn't kept, nor hits which aren't listed.
+
+
+def classify_blast_record(blast_record, string_min, string_max, subunit_length):
     status = ''
 
-    blast_record = NCBIXML.read(result_handle)
-    midline_regex = r"\|{" + str(subunit_length) + r",}"
-    ident_regex = re.compile(r"\|5,}")
+    midline_regex = midline_regexes.get(subunit_length)
+    if midline_regex is None:
+        midline_regex = re.compile(r"\|{" + str(subunit_length) + r",}")
     alignment_status = ''
     self_alignments = []
     conflicting_alignments = []
     matching_alignments = []
-    reasons = []
 
     # counter for tracking number of self hits
     selfhits = 0
@@ -379,17 +2707,14 @@ def blast_product(product, tmp_dir, db, string_min,
 
     for alignment in blast_record.alignments:
 
-        alignment_data = {
-            'accession': alignment.hit_id,
-            'description': alignment.hit_def,
-            'subj_length': alignment.length,
-        }
+        # list the hit is shown in, None if it isn't listed
+        hits = None
+        reasons = []
         hsp_count = 0
         match_len = 0
         hsp_idents = []
         # lengths of consecutive bases...
         hsp_match_lengths = []
-        hsp_alignments = []
         hsp_hit_lengths = []
 
         # Original RNAit implementation reports single value for identity, which
@@ -404,7 +2729,7 @@ def blast_product(product, tmp_dir, db, string_min,
             have_20 = 0
             # check for matches of >20bp identity by checking for stretches of
             # >20 '|' characters in the HSP midline
-            match = re.search(midline_regex, hsp.match)
+            match = midline_regex.search(hsp.match)
             if match:
                 match_len = match.end() - match.start()
                 have_20 = 1
@@ -418,26 +2743,22 @@ def blast_product(product, tmp_dir, db, string_min,
             hsp_match_lengths.append(match_len)
             hsp_hit_lengths.append(hsp.align_length)
 
-            # pretty format alignment
-            text_alignment = format_alignment(hsp)
-            hsp_alignments.append(text_alignment)
-
         if (hsp_count == 1):
             length_cov = hsp_match_lengths[0] / blast_record.query_letters
             if (have_20 == 1 and hsp_idents[0] > 0.99 and length_cov >= 1):
                 alignment_status = 'Self alignment'
-                self_alignments.append(alignment_data)
+                hits = self_alignments
                 selfhits += 1
                 if selfhits > 1:
                     reasons.append('Multiple self hits')
             elif (have_20 == 1 and hsp_idents[0] * 100 > string_min and hsp_idents[0] * 100 < string_max):
                 alignment_status = 'Conflicting hits'
-                conflicting_alignments.append(alignment_data)
+                hits = conflicting_alignments
                 conflicting += 1
                 reasons.append("Identity is %s" % (hsp_idents[0]))
             elif (hsp_match_lengths[0] > subunit_length):
                 alignment_status = 'Match exceeding subunit length'
-                matching_alignments.append(alignment_data)
+                hits = matching_alignments
                 matching += 1
                 reasons.append(
                     "%s bp identical sequence" %
@@ -447,13 +2768,21 @@ def blast_product(product, tmp_dir, db, string_min,
         else:
             alignment_status = 'Multiple HPSs'
 
+        if hits is None:
+            continue
         hsp_idents = list(map(format_ident, hsp_idents))
-        alignment_data['status'] = alignment_status
-        alignment_data['reasons'] = reasons
-        alignment_data['hsps'] = hsp_count
-        alignment_data['ident'] = ";".join(map(str, hsp_idents))
-        alignment_data['hsp_alignments'] = hsp_alignments
-        alignment_data['hsp_hit_lengths'] = ";".join(map(str, hsp_hit_lengths))
+        hits.append(screen_result.Hit(
+            accession=alignment.hit_id,
+            description=alignment.hit_def,
+            subj_length=alignment.length,
+            status=alignment_status,
+            reasons=reasons,
+            hsps=hsp_count,
+            ident=";".join(map(str, hsp_idents)),
+            # alignments are formatted when displayed (see format_alignment)
+            hsp_alignments=[get_hsp_data(hsp) for hsp in alignment.hsps],
+            hsp_hit_lengths=";".join(map(str, hsp_hit_lengths)),
+        ))
 
     if selfhits > 1:
         primer_status = 'Bad'
@@ -464,17 +2793,14 @@ def blast_product(product, tmp_dir, db, string_min,
     else:
         primer_status = 'Suitable'
 
-    blast_data = {
-        'record': blast_record,
-        'primer_status': primer_status,
-        'self_hits': selfhits,
-        'self_alignments': self_alignments,
-        'conflicting_alignments': conflicting_alignments,
-        'matching_alignments': matching_alignments,
-    }
-    shutil.rmtree(blast_dir)
-
-    return(blast_data, None)
+    blast_data = screen_result.ScreenResult(
+        primer_status=primer_status,
+        self_hits=selfhits,
+        self_alignments=self_alignments,
+        conflicting_alignments=conflicting_alignments,
+        matching_alignments=matching_alignments,
+    )
+    return(blast_data)
 
 # get_output_page
 #
@@ -484,18 +2810,27 @@ def blast_product(product, tmp_dir, db, string_min,
 #                primers - dictionary of primers produced by get_primer_pairs
 #                blast_data - dictionary of blast results generated by blast_product
 #
+# optional args: alignment_options - dictionary (see get_alignment_options)
+#                screens - list of (database, blast_data) lists for each pair,
+#                          when screened against several databases (see
+#                          screen_databases)
+#
 # returns: page - HTML page
 
 
-def get_output_page(query_info, primers, RNAit_dir, blast_results):
-    env = Environment(
-        loader=FileSystemLoader(RNAit_dir + '/templates'), autoescape=select_autoescape(['html', 'xml'])
-    )
+def get_output_page(query_info, primers, RNAit_dir, blast_results,
+                    alignment_options=None, screens=None):
+    if alignment_options is None:
+        alignment_options = {'max_hits': None, 'token': None, 'url': None}
+    env = get_template_env(RNAit_dir)
     template = env.get_template('result_page.html')
-    html = template.render(
-        query_info=query_info,
-        primers=primers,
-        blast=blast_results)
+    with metrics.span('render'):
+        html = template.render(
+            query_info=query_info,
+            primers=primers,
+            blast=blast_results,
+            alignment_options=alignment_options,
+            screens=screens)
     encode = html.encode('UTF-8')
     return(encode)
 
@@ -510,14 +2845,28 @@ def get_output_page(query_info, primers, RNAit_dir, blast_results):
 
 
 def get_error_page(RNAit_dir, error, type):
-    env = Environment(
-        loader=FileSystemLoader(RNAit_dir + '/templates'), autoescape=select_autoescape(['html', 'xml'])
-    )
+    env = get_template_env(RNAit_dir)
     template = env.get_template('error_page.html')
     html = template.render(error=error, type=type)
     encode = html.encode('UTF-8')
     return(encode)
 
+# get_job_page
+#
+# Generates HTML progress page for a queued or running job, which refreshes
+# itself until the job completes
+#
+# required args: RNAit_dir - path to RNAit installation (string)
+#                job - dictionary of job state (see jobs.get_job)
+
+
+def get_job_page(RNAit_dir, job):
+    env = get_template_env(RNAit_dir)
+    template = env.get_template('job_page.html')
+    html = template.render(job=job)
+    encode = html.encode('UTF-8')
+    return(encode)
+
 # format_ident
 #
 # Converts proportion of identities (i.e. 0.93) to a percentage
@@ -531,41 +2880,59 @@ def format_ident(val):
     percent = ("%.2f" % (float(val) * 100))
     return(percent)
 
+# get_hsp_data
+#
+# Extracts the fields of an hsp needed to display its alignment
+#
+# requred args: hsp - Bio.Blast.Record.HSP
+#
+# returns: hsp_data - screen_result.Hsp
+
+
+def get_hsp_data(hsp):
+    hsp_data = screen_result.Hsp(
+        score=hsp.score,
+        bits=hsp.bits,
+        expect=hsp.expect,
+        query_start=hsp.query_start,
+        sbjct_start=hsp.sbjct_start,
+        align_length=hsp.align_length,
+        query=hsp.query,
+        match=hsp.match,
+        sbjct=hsp.sbjct,
+    )
+    return(hsp_data)
+
 # format_alignment
 #
 # Produces a text alignment from hsp with HTML linkbreaks/spaces
-# for rendering in a <pre>
+# for rendering in a <pre>. Registered as the 'format_alignment' template
+# filter.
 #
-# requred args: hsp - Bio.Blast.Record.HSP
+# requred args: hsp - hsp data (see get_hsp_data), or the equivalent
+#                     dictionary from the alignment store
 #
 # returns: alignment - string
 
 
 def format_alignment(hsp):
-    query_start = hsp.query_start
-    sbjct_start = hsp.sbjct_start
-    offset = 0
-    alignment_lines = []
-
-    line = "Score: %.2f; bits: %.2f; e-value: %.2f\n" % (
-        hsp.score, hsp.bits, hsp.expect)
-    alignment_lines.append(line)
-    alignment_lines.append("\n")
-
-    for i in range(0, hsp.align_length, 75):
-
-        qline = ("Query: %s %s" %
-                 (str(query_start + offset).rjust(4), hsp.query[i:i + 75]))
-        midline = ("            %s" % (hsp.match[i:i + 75]))
-        hline = ("Sbjct: %s %s" %
-                 (str(sbjct_start + offset).rjust(4), hsp.sbjct[i:i + 75]))
-
-        alignment_lines.append(qline)
-        alignment_lines.append(midline)
-        alignment_lines.append(hline)
+    query = hsp.get('query')
+    match = hsp.get('match')
+    sbjct = hsp.get('sbjct')
+    query_start = hsp.get('query_start')
+    sbjct_start = hsp.get('sbjct_start')
+
+    alignment_lines = [
+        "Score: %.2f; bits: %.2f; e-value: %.2f\n" % (
+            hsp.get('score'), hsp.get('bits'), hsp.get('expect')),
+        "\n",
+    ]
+    for offset in range(0, hsp.get('align_length'), 75):
+        alignment_lines.append("Query: %s %s" % (
+            str(query_start + offset).rjust(4), query[offset:offset + 75]))
+        alignment_lines.append("            " + match[offset:offset + 75])
+        alignment_lines.append("Sbjct: %s %s" % (
+            str(sbjct_start + offset).rjust(4), sbjct[offset:offset + 75]))
         alignment_lines.append('')
-        offset += 75
 
-    alignment = "<br/>".join(alignment_lines)
-    alignment = alignment.replace(' ', '&nbsp;')
-    return(alignment)
+    return("<br/>".join(alignment_lines).replace(' ', '&nbsp;'))
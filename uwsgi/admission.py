@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+
+# Admission control for queries, shared by all uWSGI workers
+#
+# Each query is given an estimated cost, from the length of its sequences and
+# the number of primer pairs expected to be screened for each, and a number of
+# blast slots, the searches it may have running at once. A query is admitted
+# once the slots of all admitted queries leave room for it and its client
+# (an address, grouped by network prefix so a lab counts as one client) has
+# fewer than admission.client_requests queries running.
+#
+# Queries which can't be admitted straight away wait, and are admitted in
+# order of their client's recent usage, the decayed total cost of the queries
+# it has had admitted, so a client submitting a burst of queries can't hold
+# back others. Waiting ties up a uWSGI worker, so the number waiting is
+# bounded overall and per client; beyond these bounds, or when the expected
+# wait is too long, the query is turned away with a time to retry after.
+#
+# State is kept in an sqlite database, with entries belonging to workers which
+# have since died removed whenever it is updated.
+
+import ipaddress
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+# seconds between checks of whether a waiting query can be admitted
+POLL_INTERVAL = 0.2
+# seconds between calls to a waiting query's waiting function (see acquire)
+WAITING_INTERVAL = 10
+
+# client_id
+#
+# Identifies the client making a request, by its address grouped by network
+# prefix (admission.client_prefix for IPv4, default 24, and
+# admission.client_prefix_v6, default 64)
+#
+# required args: environ - WSGI environment
+#                settings - dictionary of admission settings
+#
+# returns: client - string
+
+
+def client_id(environ, settings):
+    value = environ.get(settings.get('client_header', 'REMOTE_ADDR')) or ''
+    # proxies append addresses, so the first is the original client
+    value = value.split(',')[0].strip()
+    try:
+        address = ipaddress.ip_address(value)
+    except ValueError:
+        return(value or 'unknown')
+    if address.version == 4:
+        prefix = int(settings.get('client_prefix', 24))
+    else:
+        prefix = int(settings.get('client_prefix_v6', 64))
+    return(str(ipaddress.ip_network("%s/%s" % (address, prefix), strict=False)))
+
+# estimate_cost
+#
+# Estimates the work a query will take, in units of one PCR product blast
+# search
+#
+# required args: lengths - lengths of the query sequences (list of int)
+#                settings - dictionary of admission settings; expected_pairs
+#                           is the products expected to be screened per
+#                           sequence (default 5), and length_unit the sequence
+#                           length costing as much primer3 time as one search
+#                           (default 2000)
+#
+# optional args: database_count - number of databases each sequence's
+#                                 products are screened against (default 1)
+#
+# returns: cost - float
+
+
+def estimate_cost(lengths, settings, database_count=1):
+    expected_pairs = float(settings.get('expected_pairs', 5))
+    length_unit = float(settings.get('length_unit', 2000))
+    return(sum(expected_pairs * database_count + length / length_unit for length in lengths))
+
+
+class Admission:
+    """sqlite record of admitted and waiting queries"""
+
+    def __init__(self, path, settings):
+        self.settings = settings
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=10, isolation_level=None,
+                                  check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        for table in ('active', 'waiting'):
+            self.db.execute('CREATE TABLE IF NOT EXISTS %s (ticket TEXT PRIMARY KEY, '
+                            'client TEXT, cost REAL, slots INTEGER, pid INTEGER, '
+                            'created REAL)' % table)
+        self.db.execute('CREATE TABLE IF NOT EXISTS clients '
+                        '(client TEXT PRIMARY KEY, usage REAL, updated REAL)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value REAL)')
+
+    # acquire
+    #
+    # Waits for a query to be admitted
+    #
+    # required args: client - client id (string, see client_id)
+    #                cost - estimated cost (float, see estimate_cost)
+    #                slots - blast searches the query may run at once (int)
+    #
+    # optional args: blocking - wait however long it takes, rather than turning
+    #                           the query away when the server is busy
+    #                waiting_function - function called every WAITING_INTERVAL
+    #                                   seconds while the query waits
+    #
+    # returns: ticket - string to pass to release, None if the query was
+    #                   turned away
+    #          retry_after - seconds the client should wait before retrying
+    #                        (int), None if admitted
+
+    def acquire(self, client, cost, slots, blocking=False, waiting_function=None):
+        ticket = uuid.uuid4().hex
+        max_wait = float(self.settings.get('max_wait', 30))
+        deadline = time.time() + max_wait
+        waiting = True
+        try:
+            with self.transaction():
+                self.purge()
+                self.db.execute('INSERT INTO waiting VALUES (?,?,?,?,?,?)',
+                                (ticket, client, cost, slots, os.getpid(), time.time()))
+                if self.admit(ticket):
+                    waiting = False
+                    return(ticket, None)
+                if not blocking:
+                    retry_after = self.busy(client, max_wait)
+                    if retry_after:
+                        return(None, retry_after)
+
+            notified = time.time()
+            while blocking or time.time() < deadline:
+                time.sleep(POLL_INTERVAL)
+                if waiting_function and time.time() - notified >= WAITING_INTERVAL:
+                    waiting_function()
+                    notified = time.time()
+                with self.transaction():
+                    self.purge()
+                    if self.admit(ticket):
+                        waiting = False
+                        return(ticket, None)
+            with self.transaction():
+                return(None, self.retry_after())
+        finally:
+            if waiting:
+                with self.transaction():
+                    self.db.execute('DELETE FROM waiting WHERE ticket=?', (ticket,))
+
+    # release
+    #
+    # Frees the slots of an admitted query, and updates the time taken per
+    # unit of cost used to estimate waits
+    #
+    # required args: ticket - ticket returned by acquire (string)
+
+    def release(self, ticket):
+        with self.transaction():
+            row = self.db.execute('SELECT cost, created FROM active WHERE ticket=?',
+                                  (ticket,)).fetchone()
+            if row is None:
+                return
+            self.db.execute('DELETE FROM active WHERE ticket=?', (ticket,))
+            cost, created = row
+            if cost > 0:
+                seconds_per_cost = (time.time() - created) / cost
+                previous = self.stat('seconds_per_cost')
+                if previous is not None:
+                    seconds_per_cost = 0.8 * previous + 0.2 * seconds_per_cost
+                self.db.execute('INSERT OR REPLACE INTO stats VALUES (?,?)',
+                                ('seconds_per_cost', seconds_per_cost))
+
+    def transaction(self):
+        return(Transaction(self))
+
+    # admit
+    #
+    # Admits a waiting query if it is next in line and there's room for it.
+    # Waiting queries whose client is at its limit are passed over; of the
+    # rest, the one whose client has the least recent usage goes first, and
+    # nothing else is admitted until there's room for it.
+    #
+    # required args: ticket - ticket of the waiting query (string)
+    #
+    # returns: admitted - bool
+
+    def admit(self, ticket):
+        active = self.db.execute('SELECT client, slots FROM active').fetchall()
+        client_requests = int(self.settings.get('client_requests', 2))
+        running = {}
+        for client, slots in active:
+            running[client] = running.get(client, 0) + 1
+
+        candidates = []
+        for row in self.db.execute('SELECT ticket, client, cost, slots, created FROM waiting'):
+            if running.get(row[1], 0) < client_requests:
+                candidates.append((self.usage(row[1]), row[4], row))
+        if not candidates:
+            return(False)
+        candidates.sort()
+        next_ticket, client, cost, slots, created = candidates[0][2]
+        if next_ticket != ticket:
+            return(False)
+        used_slots = sum(row[1] for row in active)
+        if active and used_slots + slots > int(self.settings.get('blast_slots', 8)):
+            return(False)
+
+        self.db.execute('DELETE FROM waiting WHERE ticket=?', (ticket,))
+        self.db.execute('INSERT INTO active VALUES (?,?,?,?,?,?)',
+                        (ticket, client, cost, slots, os.getpid(), time.time()))
+        self.db.execute('INSERT OR REPLACE INTO clients VALUES (?,?,?)',
+                        (client, self.usage(client) + cost, time.time()))
+        return(True)
+
+    # busy
+    #
+    # Decides whether a query which can't be admitted straight away should be
+    # turned away rather than wait
+    #
+    # required args: client - client id (string)
+    #                max_wait - longest time a query may wait (float)
+    #
+    # returns: retry_after - seconds to retry after (int), None if the query
+    #                        should wait
+
+    def busy(self, client, max_wait):
+        waiting = self.db.execute('SELECT client FROM waiting').fetchall()
+        client_waiting = len([row for row in waiting if row[0] == client])
+        if len(waiting) > int(self.settings.get('max_waiting', 4)) or \
+                client_waiting > int(self.settings.get('client_waiting', 1)) or \
+                self.expected_wait() > max_wait:
+            return(self.retry_after())
+        return(None)
+
+    # expected_wait
+    #
+    # Estimates the time until the queries admitted and waiting now are
+    # complete, from their cost, the time taken per unit of cost so far, and
+    # the number running at once
+    #
+    # returns: seconds - float
+
+    def expected_wait(self):
+        seconds_per_cost = self.stat('seconds_per_cost') or 0
+        active_cost, active_count = self.db.execute(
+            'SELECT COALESCE(SUM(cost), 0), COUNT(*) FROM active').fetchone()
+        waiting_cost = self.db.execute(
+            'SELECT COALESCE(SUM(cost), 0) FROM waiting').fetchone()[0]
+        return(seconds_per_cost * (active_cost + waiting_cost) / max(active_count, 1))
+
+    def retry_after(self):
+        retry_after = int(self.expected_wait()) + 1
+        return(min(max(retry_after, int(self.settings.get('min_retry', 5))),
+                   int(self.settings.get('max_retry', 300))))
+
+    # usage
+    #
+    # required args: client - client id (string)
+    #
+    # returns: usage - cost of the client's admitted queries, halving every
+    #                  admission.usage_half_life seconds (float)
+
+    def usage(self, client):
+        row = self.db.execute('SELECT usage, updated FROM clients WHERE client=?',
+                              (client,)).fetchone()
+        if row is None:
+            return(0.0)
+        half_life = float(self.settings.get('usage_half_life', 300))
+        return(row[0] * 0.5 ** (max(time.time() - row[1], 0) / half_life))
+
+    def stat(self, name):
+        row = self.db.execute('SELECT value FROM stats WHERE name=?', (name,)).fetchone()
+        return(row[0] if row else None)
+
+    # purge
+    #
+    # Removes entries belonging to processes which no longer exist, or older
+    # than admission.max_age seconds, and clients with negligible usage
+
+    def purge(self):
+        cutoff = time.time() - float(self.settings.get('max_age', 3600))
+        for table in ('active', 'waiting'):
+            pids = [row[0] for row in self.db.execute('SELECT DISTINCT pid FROM %s' % table)]
+            for pid in pids:
+                if not process_exists(pid):
+                    self.db.execute('DELETE FROM %s WHERE pid=?' % table, (pid,))
+            self.db.execute('DELETE FROM %s WHERE created<?' % table, (cutoff,))
+        self.db.execute('DELETE FROM clients WHERE updated<?', (cutoff,))
+
+
+class Transaction:
+    """Holds the admission database's write lock, and the per-process lock
+    shared by threads using the same connection"""
+
+    def __init__(self, admission):
+        self.admission = admission
+
+    def __enter__(self):
+        self.admission.lock.acquire()
+        try:
+            self.admission.db.execute('BEGIN IMMEDIATE')
+        except sqlite3.Error:
+            self.admission.lock.release()
+            raise
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.admission.db.execute('COMMIT')
+            else:
+                self.admission.db.execute('ROLLBACK')
+        finally:
+            self.admission.lock.release()
+
+# process_exists
+#
+# required args: pid - process id (int)
+#
+# returns: exists - bool
+
+
+def process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return(False)
+    except PermissionError:
+        pass
+    return(True)
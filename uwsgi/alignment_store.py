@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+# Short-lived store of the alignments behind a results page
+#
+# Rather than embedding every hsp alignment in the results page, the page
+# lists only a summary row per hit, and the alignments of each hit are stored
+# here under a key made up of a per-page token, the primer pair, the hit
+# category and the hit number. The page fetches them from
+# /RNAit/query/alignment/<key> when a hit is opened.
+#
+# The store is an sqlite database shared by all uWSGI workers, since the
+# worker answering an alignment request needn't be the one which produced the
+# page. Entries are removed once older than the configured expiry time.
+
+import json
+import sqlite3
+import threading
+import time
+
+
+class AlignmentStore:
+    """sqlite store of hit alignments, expiring after a fixed time"""
+
+    def __init__(self, path, expiry=86400):
+        self.expiry = expiry
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS alignments '
+                        '(key TEXT PRIMARY KEY, value TEXT, created REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS alignments_created '
+                        'ON alignments (created)')
+        self.db.commit()
+
+    # get
+    #
+    # required args: key - alignment key (string)
+    #
+    # returns: hsp_alignments - list of hsp data dictionaries, None if the key
+    #                           is unknown or has expired
+
+    def get(self, key):
+        with self.lock:
+            try:
+                row = self.db.execute(
+                    'SELECT value FROM alignments WHERE key=? AND created>?',
+                    (key, time.time() - self.expiry)).fetchone()
+            except sqlite3.Error:
+                return(None)
+        if row is None:
+            return(None)
+        return(json.loads(row[0]))
+
+    # put_many
+    #
+    # Stores the alignments for a page in a single transaction, removing any
+    # expired entries
+    #
+    # required args: entries - dictionary of alignment key to list of hsp data
+    #                          dictionaries
+
+    def put_many(self, entries):
+        now = time.time()
+        rows = [(key, json.dumps(value), now) for key, value in entries.items()]
+        with self.lock:
+            try:
+                self.db.executemany('INSERT OR REPLACE INTO alignments VALUES (?,?,?)', rows)
+                self.db.execute('DELETE FROM alignments WHERE created<?', (now - self.expiry,))
+                self.db.commit()
+            except sqlite3.Error:
+                # the page will report the alignments as unavailable
+                self.db.rollback()
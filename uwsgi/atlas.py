@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+# Precomputed primer designs for every CDS in a blast database
+#
+# bin/build_atlas.py designs and screens primers for each sequence in a
+# database with a given set of query parameters, and stores the results here,
+# keyed on the database, the parameter set and the gene id. Results are also
+# indexed by a hash of the CDS sequence, so a query pasting in a known CDS can
+# be answered with a lookup whatever its fasta header says.
+#
+# Each entry records the version of the database it was computed from (see
+# result_cache.database_version), and entries from other versions are ignored,
+# so rebuilding a database means rebuilding its atlas. Stored results are
+# JSON, so the blast records are left out as for the result cache.
+
+import hashlib
+import json
+import sqlite3
+import threading
+
+import result_cache
+
+# params_key
+#
+# Generates the key for the parameter set a result was computed with. The
+# adaptive screening and off-target profile settings which change which pairs
+# are chosen are included, so results are only used by a server screening the
+# same way, as is the version of the stored result layout (see
+# result_cache.RESULT_FORMAT).
+#
+# required args: params - dictionary of query parameters
+#                config - dictionary of configuration settings
+#
+# returns: key - string
+
+
+def params_key(params, config):
+    key = "%s:%s:%s:%s:%s:%s:%s" % ((result_cache.RESULT_FORMAT,) + tuple(
+        int(params.get(name)) for name in (
+            'melting_temp', 'product_min', 'product_max', 'string_min',
+            'string_max', 'subunit_length')))
+    screen_config = config.get('adaptive_screen')
+    if screen_config:
+        key = "%s:%s:%s" % (key, int(screen_config.get('candidates')),
+                            int(screen_config.get('suitable_pairs', 5)))
+    if (config.get('offtarget_profile') or {}).get('exclude'):
+        key = "%s:offtarget" % key
+    return(key)
+
+# seq_hash
+#
+# required args: seq - CDS sequence (string)
+#
+# returns: hash - string
+
+
+def seq_hash(seq):
+    return(hashlib.sha256(str(seq).upper().encode('UTF-8')).hexdigest())
+
+
+class Atlas:
+    """sqlite store of precomputed results"""
+
+    def __init__(self, path, readonly=False):
+        self.lock = threading.Lock()
+        if readonly:
+            self.db = sqlite3.connect('file:%s?mode=ro' % path, uri=True,
+                                      timeout=10, check_same_thread=False)
+            return
+        self.db = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS atlas '
+                        '(db TEXT, db_version TEXT, params TEXT, gene_id TEXT, '
+                        'seq_hash TEXT, result TEXT, '
+                        'PRIMARY KEY (db, params, gene_id))')
+        self.db.execute('CREATE INDEX IF NOT EXISTS atlas_seq_hash '
+                        'ON atlas (db, params, seq_hash)')
+        self.db.commit()
+
+    # lookup
+    #
+    # required args: db - blast database name (string)
+    #                db_version - version from database_version() (string)
+    #                params - key from params_key() (string)
+    #                seq - query sequence (string)
+    #
+    # returns: result - dictionary of 'primers', 'blast_results' and, if
+    #                   built with an off-target profile, 'offtarget_runs' (see
+    #                   offtarget.get_runs), or of 'error', None if the sequence
+    #                   isn't in the atlas
+
+    def lookup(self, db, db_version, params, seq):
+        with self.lock:
+            try:
+                row = self.db.execute(
+                    'SELECT result FROM atlas WHERE db=? AND params=? AND '
+                    'seq_hash=? AND db_version=? LIMIT 1',
+                    (db, params, seq_hash(seq), db_version)).fetchone()
+            except sqlite3.Error:
+                return(None)
+        if row is None:
+            return(None)
+        return(json.loads(row[0]))
+
+    # gene_ids
+    #
+    # Lists the genes already stored for a database version and parameter set,
+    # so an interrupted build can carry on where it left off
+    #
+    # required args: db - blast database name (string)
+    #                db_version - version from database_version() (string)
+    #                params - key from params_key() (string)
+    #
+    # returns: gene_ids - set of strings
+
+    def gene_ids(self, db, db_version, params):
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT gene_id FROM atlas WHERE db=? AND params=? AND db_version=?',
+                (db, params, db_version)).fetchall()
+        return(set(row[0] for row in rows))
+
+    # put_many
+    #
+    # Stores a set of results in a single transaction
+    #
+    # required args: db - blast database name (string)
+    #                db_version - version from database_version() (string)
+    #                params - key from params_key() (string)
+    #                entries - list of (gene id, sequence, result) tuples, with
+    #                          results as returned by lookup()
+
+    def put_many(self, db, db_version, params, entries):
+        rows = []
+        for gene_id, seq, result in entries:
+            rows.append((db, db_version, params, gene_id, seq_hash(seq),
+                         json.dumps(result)))
+        with self.lock:
+            self.db.executemany('INSERT OR REPLACE INTO atlas VALUES (?,?,?,?,?,?)', rows)
+            self.db.commit()
@@ -0,0 +1,390 @@
+#!/usr/bin/env python
+
+# Long-lived pool of blastn workers for RNAit
+#
+# uWSGI workers submit queries over a local unix socket rather than forking
+# blastn themselves. Each blast database gets its own bounded set of worker
+# threads and job queue, and the database files are held memory-mapped so that
+# each blastn run reads its indexes from the page cache rather than disk.
+#
+# blastn has no resident server mode, so each job is still a blastn process,
+# but it is started from this small process rather than from a uWSGI worker,
+# with concurrency per database bounded by the number of workers. When a
+# database queue is full the job is rejected immediately so callers can
+# report the service as busy rather than queueing without limit. Each search
+# is killed if it runs for longer than the timeout, and a client is answered
+# with an error if its job hasn't completed within the timeout, after which
+# its search is killed or, if still queued, dropped. So a hung blastn ties up
+# neither a pool thread nor a uWSGI worker.
+#
+# Messages are JSON encoded and sent with Connection.send_bytes, so nothing
+# received over the socket is ever unpickled.
+#
+# Unless the databases are given with -db, the database directory is rescanned
+# periodically, so databases added by bin/manage_databases.py are served
+# without a restart, and each database's files are remapped when it is
+# switched to a new version. Queries for databases the pool doesn't serve yet
+# are run by the caller instead.
+
+import argparse
+import glob
+import json
+import mmap
+import os
+import queue
+import subprocess
+import threading
+import time
+import yaml
+from multiprocessing.connection import Listener, Client
+
+# seconds between checks for dead worker threads and database changes
+SUPERVISE_INTERVAL = 5
+# default seconds a blast search may take, overridden by blast_pool.timeout
+BLAST_TIMEOUT = 600
+# seconds a client waits for a reply beyond the timeout before giving up
+REPLY_MARGIN = 10
+# seconds between checks of whether a running search has been cancelled
+CANCEL_INTERVAL = 1
+
+# submit
+#
+# Submits a blast query to a running pool
+#
+# required args: socket_path - path to pool unix socket (string)
+#                db - blast database name (string)
+#                query - fasta formatted query sequences (string)
+#                outfmt - blastn output format specification (string)
+#
+# optional args: timeout - seconds the pool allows the search (int)
+#
+# returns: output - blastn output (string)
+#          error - runtime error (string)
+#
+# raises OSError if the pool is not running or doesn't serve the database,
+# allowing callers to fall back to running blastn directly
+
+
+def submit(socket_path, db, query, outfmt, timeout=BLAST_TIMEOUT):
+    conn = Client(socket_path, family='AF_UNIX')
+    try:
+        conn.send_bytes(json.dumps(
+            {'db': db, 'query': query, 'outfmt': outfmt}).encode('UTF-8'))
+        if not conn.poll(timeout + REPLY_MARGIN):
+            return(None, 'The blast service did not reply within %s seconds' % timeout)
+        reply = json.loads(conn.recv_bytes().decode('UTF-8'))
+    except EOFError:
+        raise ConnectionResetError('blast pool closed connection')
+    finally:
+        conn.close()
+    if reply.get('unknown_database'):
+        raise FileNotFoundError(reply.get('error'))
+    return(reply.get('output'), reply.get('error'))
+
+# run_blastn
+#
+# Runs a single blastn search, reading the query from stdin and returning the
+# results from stdout. A blastn process killed by a signal is retried once,
+# and one still running after the timeout, or once cancelled, is killed.
+#
+# required args: db - blast database name (string)
+#                query - fasta formatted query sequences (string)
+#                outfmt - blastn output format specification (string)
+#
+# optional args: timeout - seconds to allow blastn to run (int)
+#                cancelled - threading.Event set if the search is no longer
+#                            wanted
+#
+# returns: output - blastn output (string)
+#          error - runtime error (string)
+
+
+def run_blastn(db, query, outfmt, timeout=BLAST_TIMEOUT, cancelled=None):
+    cmd = ['blastn', '-task', 'blastn', '-db', db, '-outfmt', outfmt]
+    for attempt in range(2):
+        try:
+            proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE, universal_newlines=True)
+        except OSError as err:
+            return(None, str(err))
+        try:
+            stdout, stderr = wait_blastn(proc, query, timeout, cancelled)
+        except subprocess.TimeoutExpired:
+            if cancelled is not None and cancelled.is_set():
+                return(None, 'blastn search was cancelled')
+            return(None, 'blastn did not finish within %s seconds' % timeout)
+        if proc.returncode >= 0:
+            break
+    if proc.returncode != 0:
+        return(None, stderr or 'blastn exited with status %s' % proc.returncode)
+    return(stdout, None)
+
+# wait_blastn
+#
+# Sends the query to a blastn process and waits for its output, killing it if
+# it runs for longer than the timeout or is cancelled
+#
+# required args: proc - subprocess.Popen object
+#                query - fasta formatted query sequences (string)
+#                timeout - seconds to allow blastn to run (int)
+#                cancelled - threading.Event, or None
+#
+# returns: stdout - blastn output (string)
+#          stderr - blastn error output (string)
+#
+# raises subprocess.TimeoutExpired if blastn was killed
+
+
+def wait_blastn(proc, query, timeout, cancelled):
+    deadline = time.time() + timeout
+    try:
+        while True:
+            wait = deadline - time.time()
+            if cancelled is not None:
+                wait = min(wait, CANCEL_INTERVAL)
+            try:
+                return(proc.communicate(query, timeout=max(0, wait)))
+            except subprocess.TimeoutExpired:
+                # the query has been sent, and must not be sent again
+                query = None
+                if time.time() >= deadline or (cancelled is not None and cancelled.is_set()):
+                    raise
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.communicate()
+        raise
+
+# find_databases
+#
+# required args: db_dir - blast database directory (string)
+#
+# returns: databases - list of blast database names
+
+
+def find_databases(db_dir):
+    return(sorted(set(os.path.basename(f).split('.')[0]
+                      for f in glob.glob(os.path.join(db_dir, '*.nsq')))))
+
+# database_files
+#
+# Finds the index and sequence files of a blast database, following the links
+# to its current version (see databases.py)
+#
+# required args: db_dir - blast database directory (string)
+#                db - blast database name (string)
+#
+# returns: db_files - sorted list of file paths
+
+
+def database_files(db_dir, db):
+    db_files = []
+    db_path = os.path.join(db_dir, db)
+    # only this database's own files and volumes, not those of other databases
+    # whose names start with its name
+    for db_file in glob.glob(db_path + '.n??') + glob.glob(db_path + '.[0-9][0-9].n??'):
+        db_file = os.path.realpath(db_file)
+        if os.path.exists(db_file) and os.path.getsize(db_file) > 0:
+            db_files.append(db_file)
+    return(sorted(db_files))
+
+# map_database
+#
+# Memory-maps the index and sequence files of a blast database so they stay
+# resident in the page cache while the pool serves that version
+#
+# required args: db_files - list of file paths (see database_files)
+#
+# returns: maps - list of mmap objects
+
+
+def map_database(db_files):
+    maps = []
+    for db_file in db_files:
+        with open(db_file, 'rb') as fh:
+            mapped = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(mapped, 'madvise'):
+            mapped.madvise(mmap.MADV_WILLNEED)
+        maps.append(mapped)
+    return(maps)
+
+
+class DatabaseWorkers:
+    """Bounded job queue and worker threads for a single blast database"""
+
+    def __init__(self, db, db_dir, workers, queue_size, timeout=BLAST_TIMEOUT):
+        self.db = db
+        self.db_dir = db_dir
+        self.timeout = timeout
+        self.db_files = database_files(db_dir, db)
+        self.maps = map_database(self.db_files)
+        self.jobs = queue.Queue(maxsize=queue_size)
+        self.threads = [None] * workers
+        self.supervise()
+
+    # submit
+    #
+    # Queues a job without blocking
+    #
+    # required args: job - dictionary containing 'request', 'done' and
+    #                      'cancelled' (Events)
+    #
+    # returns: True if queued, False if the queue is full
+
+    def submit(self, job):
+        try:
+            self.jobs.put_nowait(job)
+        except queue.Full:
+            return(False)
+        return(True)
+
+    # supervise
+    #
+    # (Re)starts any worker thread which is not running
+
+    def supervise(self):
+        for i, thread in enumerate(self.threads):
+            if thread is None or not thread.is_alive():
+                thread = threading.Thread(target=self.work, daemon=True,
+                                          name='%s-%s' % (self.db, i))
+                thread.start()
+                self.threads[i] = thread
+
+    # refresh
+    #
+    # Remaps the database files if the database has been switched to another
+    # version, releasing the previous version's files
+
+    def refresh(self):
+        db_files = database_files(self.db_dir, self.db)
+        if db_files == self.db_files:
+            return
+        old_maps = self.maps
+        self.db_files = db_files
+        self.maps = map_database(db_files)
+        for mapped in old_maps:
+            mapped.close()
+
+    def work(self):
+        while True:
+            job = self.jobs.get()
+            if job['cancelled'].is_set():
+                # client has already been answered with a timeout
+                self.jobs.task_done()
+                continue
+            try:
+                request = job['request']
+                output, error = run_blastn(
+                    self.db, request.get('query'), request.get('outfmt'), self.timeout,
+                    job['cancelled'])
+                job['reply'] = {'output': output, 'error': error}
+            except Exception as err:
+                job['reply'] = {'output': None, 'error': str(err)}
+                raise
+            finally:
+                job['done'].set()
+                self.jobs.task_done()
+
+# handle_connection
+#
+# Reads a single request from a client connection, passes it to the workers
+# for the requested database and returns the reply. A job which hasn't
+# completed within the timeout, whether queued or running, is answered with
+# an error, and is cancelled: dropped if it hasn't yet started, otherwise its
+# blastn is killed.
+#
+# required args: conn - multiprocessing.connection.Connection
+#                pool - dictionary of database name -> DatabaseWorkers
+#
+# optional args: timeout - seconds to wait for the job (int)
+
+
+def handle_connection(conn, pool, timeout=BLAST_TIMEOUT):
+    try:
+        request = json.loads(conn.recv_bytes().decode('UTF-8'))
+        workers = pool.get(request.get('db'))
+        if workers is None:
+            reply = {'error': 'Unknown blast database: %s' % request.get('db'),
+                     'unknown_database': True}
+        else:
+            job = {'request': request, 'done': threading.Event(),
+                   'cancelled': threading.Event()}
+            if not workers.submit(job):
+                reply = {'error': 'The blast service is busy, please try again shortly'}
+            elif job['done'].wait(timeout):
+                reply = job['reply']
+            else:
+                job['cancelled'].set()
+                reply = {'error': 'The blast search did not finish within %s seconds'
+                         % timeout}
+        conn.send_bytes(json.dumps(reply).encode('UTF-8'))
+    except (EOFError, OSError, ValueError):
+        pass
+    finally:
+        conn.close()
+
+# serve
+#
+# Starts workers for each database and accepts client connections until
+# interrupted
+#
+# required args: socket_path - path to unix socket to listen on (string)
+#                db_dir - blast database directory (string)
+#                databases - list of blast database names, None for all those
+#                            in db_dir, rescanned as databases are added
+#                workers - number of concurrent blastn runs per database (int)
+#                queue_size - maximum queued jobs per database (int)
+#
+# optional args: timeout - seconds a search may take (int)
+
+
+def serve(socket_path, db_dir, databases, workers, queue_size, timeout=BLAST_TIMEOUT):
+    pool = {}
+    for db in databases or find_databases(db_dir):
+        pool[db] = DatabaseWorkers(db, db_dir, workers, queue_size, timeout)
+
+    def supervise():
+        while True:
+            time.sleep(SUPERVISE_INTERVAL)
+            if not databases:
+                for db in find_databases(db_dir):
+                    if db not in pool:
+                        pool[db] = DatabaseWorkers(db, db_dir, workers, queue_size,
+                                                   timeout)
+            for db_workers in list(pool.values()):
+                db_workers.supervise()
+                db_workers.refresh()
+
+    threading.Thread(target=supervise, daemon=True).start()
+
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    old_umask = os.umask(0o077)
+    listener = Listener(socket_path, family='AF_UNIX')
+    os.umask(old_umask)
+    try:
+        while True:
+            conn = listener.accept()
+            threading.Thread(target=handle_connection, args=(conn, pool, timeout),
+                             daemon=True).start()
+    finally:
+        listener.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Persistent blastn worker pool for RNAit")
+    parser.add_argument('-config', help='RNAit configuration file',
+                        default=os.path.dirname(os.path.realpath(__file__)) + '/RNAit.yaml')
+    parser.add_argument('-db', action='append',
+                        help='Database name (default: all databases in BLASTDB)')
+    args = parser.parse_args()
+
+    with open(args.config) as s:
+        config = yaml.safe_load(s)
+    pool_config = config.get('blast_pool') or {}
+
+    db_dir = os.environ.get('BLASTDB', config.get('db_dir'))
+
+    serve(pool_config.get('socket'), db_dir, args.db,
+          int(pool_config.get('workers', 2)), int(pool_config.get('queue_size', 16)),
+          int(pool_config.get('timeout', BLAST_TIMEOUT)))
@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+
+# Blast database builds and the manifest of installed databases
+#
+# bin/manage_databases.py builds each database into its own versioned
+# directory, then switches to it by replacing a single symlink:
+#
+#   <db_dir>/versions/<name>/<release>-<checksum>/<name>, <name>.n??, <name>.kmi
+#   <db_dir>/<name>.current -> versions/<name>/<release>-<checksum>
+#   <db_dir>/<name>, <name>.n??, <name>.kmi -> <name>.current/...
+#
+# so blastn, the k-mer index and gene id lookups go on finding each database
+# at <db_dir>/<name> (via BLASTDB), and never see a partly built one. The
+# previous versions are kept until they're pruned, so searches started before
+# a switch can finish.
+#
+# <db_dir>/manifest.json lists the installed databases, with the organism,
+# source release, source checksum and sequence count of each, and is what the
+# web application offers as valid 'database' values.
+
+import glob
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import time
+
+import kmer_index
+
+MANIFEST = 'manifest.json'
+
+# manifests by path, see load_manifest()
+manifests = {}
+
+# load_manifest
+#
+# Reads the manifest of a database directory. Manifests are kept for the life
+# of the process, and reread if the file changes.
+#
+# required args: db_dir - blast database directory (string)
+#
+# returns: manifest - dictionary of database name to manifest entry (see
+#                     build_database), None if there is no manifest
+
+
+def load_manifest(db_dir):
+    path = os.path.join(db_dir or '', MANIFEST)
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return(None)
+    cached = manifests.get(path)
+    if cached is not None and cached[0] == mtime:
+        return(cached[1])
+    try:
+        with open(path) as fh:
+            manifest = json.load(fh).get('databases')
+    except (OSError, ValueError):
+        return(None)
+    manifests[path] = (mtime, manifest)
+    return(manifest)
+
+# save_manifest
+#
+# Replaces the manifest of a database directory
+#
+# required args: db_dir - blast database directory (string)
+#                manifest - dictionary of database name to manifest entry
+
+
+def save_manifest(db_dir, manifest):
+    path = os.path.join(db_dir, MANIFEST)
+    with open(path + '.tmp', 'w') as fh:
+        json.dump({'databases': manifest}, fh, indent=2, sort_keys=True)
+        fh.write("\n")
+    os.replace(path + '.tmp', path)
+
+# file_checksum
+#
+# required args: path - file path (string)
+#
+# returns: checksum - sha256 hex digest (string)
+
+
+def file_checksum(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(1 << 20), b''):
+            digest.update(block)
+    return(digest.hexdigest())
+
+# reformat_fasta
+#
+# Copies a TriTrypDB CDS fasta file, keeping the id and the third '|'
+# separated field of each header, e.g.
+#
+#   >Tb927.1.120:mRNA-p1 | transcript=Tb927.1.120:mRNA | gene=Tb927.1.120 | ...
+#
+# becomes '>Tb927.1.120:mRNA-p1  gene=Tb927.1.120 ', and rewrapping sequences
+# to 60 columns. The output is the same as reading and writing each record with
+# SeqIO, but is streamed in a single pass.
+#
+# required args: in_path - TriTrypDB fasta file (string)
+#                out_path - output fasta file (string)
+#
+# returns: count - number of sequences written (int)
+#
+# raises ValueError for headers with fewer than three fields
+
+
+def reformat_fasta(in_path, out_path):
+    count = 0
+    with open(in_path, 'rb') as in_fh, open(out_path, 'wb', buffering=1 << 20) as out_fh:
+        seq = []
+
+        def write_seq():
+            data = b''.join(seq)
+            out_fh.write(b''.join(data[i:i + 60] + b"\n" for i in range(0, len(data), 60)))
+
+        for line in in_fh:
+            if line.startswith(b'>'):
+                if count:
+                    write_seq()
+                    seq = []
+                title = line[1:].rstrip().decode('UTF-8')
+                fields = title.split('|')
+                if len(fields) < 3:
+                    raise ValueError("Unexpected fasta header in %s: %s" % (in_path, title))
+                seq_id = title.split(None, 1)[0] if title.split() else ''
+                description = fields[2].replace("\r", " ")
+                if description and description.split(None, 1)[:1] == [seq_id]:
+                    header = description
+                elif description:
+                    header = "%s %s" % (seq_id, description)
+                else:
+                    header = seq_id
+                out_fh.write(b'>' + header.encode('UTF-8') + b"\n")
+                count += 1
+            elif count:
+                seq.append(line.rstrip().replace(b' ', b'').replace(b"\r", b''))
+        if count:
+            write_seq()
+    return(count)
+
+# build_database
+#
+# Reformats a source fasta file and builds its blast database and k-mer index
+# in a new version directory, then switches the database to it. The build is
+# skipped if the manifest entry has the same source checksum, unless forced.
+#
+# required args: db_dir - blast database directory (string)
+#                name - database name (string)
+#                source - TriTrypDB fasta file (string)
+#                organism - organism name (string)
+#                release - source release (string)
+#
+# optional args: entry - current manifest entry for the database (dictionary)
+#                force - rebuild even if the source is unchanged
+#                keep - number of versions to keep, including the new one
+#
+# returns: entry - manifest entry: dictionary of 'organism', 'release',
+#                  'source', 'checksum', 'sequences', 'version' and 'built',
+#                  or None if the build was skipped
+
+
+def build_database(db_dir, name, source, organism, release, entry=None,
+                   force=False, keep=2):
+    checksum = file_checksum(source)
+    if entry and entry.get('checksum') == checksum and not force and \
+            os.path.isdir(version_path(db_dir, name, entry.get('version'))):
+        return(None)
+
+    version = "%s-%s" % (release, checksum[:12])
+    if os.path.exists(version_path(db_dir, name, version)):
+        # a forced rebuild mustn't replace the version in use
+        version = "%s-%s" % (version, time.strftime('%Y%m%d%H%M%S'))
+    final_dir = version_path(db_dir, name, version)
+    build_dir = final_dir + '.building'
+    shutil.rmtree(build_dir, ignore_errors=True)
+    os.makedirs(build_dir)
+    try:
+        db_path = os.path.join(build_dir, name)
+        count = reformat_fasta(source, db_path)
+        subprocess.check_call(['makeblastdb', '-dbtype', 'nucl', '-in', db_path,
+                               '-out', db_path, '-title', name],
+                              stdout=subprocess.DEVNULL)
+        kmer_index.build_index(db_path, db_path + '.kmi')
+        os.rename(build_dir, final_dir)
+    except BaseException:
+        shutil.rmtree(build_dir, ignore_errors=True)
+        raise
+
+    switch_version(db_dir, name, version)
+    prune_versions(db_dir, name, keep)
+    entry = {
+        'organism': organism,
+        'release': str(release),
+        'source': os.path.basename(source),
+        'checksum': checksum,
+        'sequences': count,
+        'version': version,
+        'built': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+    return(entry)
+
+# version_path
+#
+# required args: db_dir - blast database directory (string)
+#                name - database name (string)
+#                version - version name (string)
+#
+# returns: path - version directory (string)
+
+
+def version_path(db_dir, name, version):
+    return(os.path.join(db_dir, 'versions', name, version or ''))
+
+# switch_version
+#
+# Points a database at one of its built versions. The <name>.current symlink
+# is replaced in one step, then the links to each file are brought into line
+# with the files of the version, replacing any files from before versioned
+# builds were used.
+#
+# required args: db_dir - blast database directory (string)
+#                name - database name (string)
+#                version - version name (string)
+
+
+def switch_version(db_dir, name, version):
+    current = os.path.join(db_dir, name + '.current')
+    replace_link(os.path.relpath(version_path(db_dir, name, version), db_dir), current)
+
+    version_files = set(os.listdir(version_path(db_dir, name, version)))
+    for file_name in version_files:
+        replace_link(os.path.join(name + '.current', file_name),
+                     os.path.join(db_dir, file_name))
+    # remove links to files the new version doesn't have, e.g. from an older
+    # version of makeblastdb
+    for path in glob.glob(os.path.join(db_dir, name + '.*')):
+        file_name = os.path.basename(path)
+        if os.path.islink(path) and not os.path.exists(path) and file_name not in version_files:
+            os.remove(path)
+
+
+def replace_link(target, path):
+    if os.path.islink(path) and os.readlink(path) == target:
+        return
+    os.symlink(target, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+# prune_versions
+#
+# Removes the oldest versions of a database, never removing the current one
+#
+# required args: db_dir - blast database directory (string)
+#                name - database name (string)
+#                keep - number of versions to keep (int)
+
+
+def prune_versions(db_dir, name, keep):
+    current = os.path.realpath(os.path.join(db_dir, name + '.current'))
+    versions = [path for path in glob.glob(version_path(db_dir, name, '*'))
+                if os.path.isdir(path) and not path.endswith('.building')]
+    others = [path for path in versions if os.path.realpath(path) != current]
+    others.sort(key=os.path.getmtime, reverse=True)
+    for path in others[max(keep - 1, 0):]:
+        shutil.rmtree(path, ignore_errors=True)
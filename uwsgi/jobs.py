@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+# Background execution of RNAit queries
+#
+# Jobs are run on a thread pool within the uWSGI worker which accepted them,
+# while their state is kept as JSON files in a job directory shared by all
+# workers, so whichever worker handles a status request can report on the job.
+# The completed results page for each job is written alongside its state.
+#
+# The number of queued and running jobs is bounded across all workers by
+# counting active jobs in the job directory when a job is created. Job files
+# are removed once they are older than the configured expiry time.
+
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+# per-worker executor, created by submit() on first use
+job_executor = None
+job_executor_lock = threading.Lock()
+
+job_id_regex = re.compile(r'^[0-9a-f]{32}$')
+
+# create_job
+#
+# Creates a new queued job, provided the number of active jobs is below the
+# queue size. Expired jobs are removed first.
+#
+# required args: job_dir - job directory (string)
+#                queue_size - maximum number of queued or running jobs (int)
+#                expiry - seconds after which jobs are removed (int)
+#                timeout - seconds without progress after which an active job
+#                          is considered lost (int)
+#
+# returns: job_id - string, None if the queue is full
+
+
+def create_job(job_dir, queue_size, expiry, timeout):
+    os.makedirs(job_dir, exist_ok=True)
+    purge_expired(job_dir, expiry)
+
+    active = 0
+    for file_name in os.listdir(job_dir):
+        if file_name.endswith('.json'):
+            job = get_job(job_dir, file_name[:-5], timeout)
+            if job and job.get('state') in ('queued', 'running'):
+                active += 1
+    if active >= queue_size:
+        return(None)
+
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    write_job(job_dir, {
+        'id': job_id,
+        'state': 'queued',
+        'stage': 'Waiting to start',
+        'done': 0,
+        'total': 0,
+        'created': now,
+        'updated': now,
+    })
+    return(job_id)
+
+# get_job
+#
+# Reads the current state of a job
+#
+# required args: job_dir - job directory (string)
+#                job_id - job id (string)
+#                timeout - seconds without progress after which an active job
+#                          is reported as failed (int)
+#
+# returns: job - dictionary of job state, None if the job doesn't exist
+
+
+def get_job(job_dir, job_id, timeout):
+    if not job_id_regex.match(job_id):
+        return(None)
+    try:
+        with open(os.path.join(job_dir, job_id + '.json')) as fh:
+            job = json.load(fh)
+    except (OSError, ValueError):
+        return(None)
+
+    # jobs are lost if the worker running them is restarted
+    if (job.get('state') in ('queued', 'running') and
+            time.time() - job.get('updated') > timeout):
+        job['state'] = 'failed'
+        job['error'] = 'The job was interrupted, please resubmit your query'
+    return(job)
+
+# update_job
+#
+# Updates the state of a job
+#
+# required args: job_dir - job directory (string)
+#                job_id - job id (string)
+#                fields - job state fields to update (keyword arguments)
+
+
+def update_job(job_dir, job_id, **fields):
+    path = os.path.join(job_dir, job_id + '.json')
+    try:
+        with open(path) as fh:
+            job = json.load(fh)
+    except (OSError, ValueError):
+        return
+    job.update(fields)
+    job['updated'] = time.time()
+    write_job(job_dir, job)
+
+# write_job
+#
+# Atomically writes job state, so readers never see a partial file
+#
+# required args: job_dir - job directory (string)
+#                job - dictionary of job state
+
+
+def write_job(job_dir, job):
+    path = os.path.join(job_dir, job.get('id') + '.json')
+    with open(path + '.tmp', 'w') as fh:
+        json.dump(job, fh)
+    os.replace(path + '.tmp', path)
+
+# save_result / get_result
+#
+# Stores and retrieves the encoded results page of a completed job
+#
+# required args: job_dir - job directory (string)
+#                job_id - job id (string)
+#                html - encoded html page (bytes)
+
+
+def save_result(job_dir, job_id, html):
+    path = os.path.join(job_dir, job_id + '.html')
+    with open(path + '.tmp', 'wb') as fh:
+        fh.write(html)
+    os.replace(path + '.tmp', path)
+
+
+def get_result(job_dir, job_id):
+    if not job_id_regex.match(job_id):
+        return(None)
+    try:
+        with open(os.path.join(job_dir, job_id + '.html'), 'rb') as fh:
+            return(fh.read())
+    except OSError:
+        return(None)
+
+# purge_expired
+#
+# Removes job state and results older than the expiry time
+#
+# required args: job_dir - job directory (string)
+#                expiry - seconds after which jobs are removed (int)
+
+
+def purge_expired(job_dir, expiry):
+    cutoff = time.time() - expiry
+    for file_name in os.listdir(job_dir):
+        path = os.path.join(job_dir, file_name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.unlink(path)
+        except OSError:
+            # already removed by another worker
+            pass
+
+# submit
+#
+# Runs a job on the background executor for this worker. The function is
+# called with a progress callback (stage, done, total) as its first argument
+# and should return the encoded results page.
+#
+# required args: job_dir - job directory (string)
+#                job_id - job id (string)
+#                workers - number of concurrent jobs per uWSGI worker (int)
+#                function - function to run
+#                args - further arguments to pass to function
+
+
+def submit(job_dir, job_id, workers, function, *args):
+    global job_executor
+    with job_executor_lock:
+        if job_executor is None:
+            job_executor = ThreadPoolExecutor(max_workers=workers)
+
+    def progress(stage, done=0, total=0):
+        update_job(job_dir, job_id, state='running', stage=stage,
+                   done=done, total=total)
+
+    def run():
+        try:
+            progress('Starting')
+            html = function(progress, *args)
+            save_result(job_dir, job_id, html)
+            update_job(job_dir, job_id, state='complete', stage='Complete')
+        except Exception as err:
+            update_job(job_dir, job_id, state='failed', error=str(err))
+
+    job_executor.submit(run)
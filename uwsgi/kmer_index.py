@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+
+# Exact k-mer index of the transcripts in a blast database
+#
+# Any identical stretch of at least the subunit length (15-25bp) between a PCR
+# product and a transcript must contain a shared 15-mer, so an index of every
+# 15-mer in a database gives a fast upper bound on the identical stretches a
+# blast search could report. Products sharing no stretch of the subunit length
+# with anything other than one identical copy of themselves can only be
+# classified as 'Suitable' by classify_blast_record(), so don't need
+# searching.
+#
+# K-mers are stored in canonical form (the lesser of the k-mer and its reverse
+# complement, 2 bits per base) since blastn searches both strands. The index
+# file holds a header, the sorted k-mers and the transcript each comes from as
+# parallel uint32 arrays, then the length and title of each transcript:
+#
+#   magic (8 bytes), k, kmer count, transcript count (uint32)
+#   kmers (uint32 * kmer count)
+#   transcript ids (uint32 * kmer count)
+#   transcript lengths (uint32 * transcript count)
+#   transcript titles (UTF-8, newline separated)
+#
+# Indexes are opened with numpy.memmap, so are shared between processes via
+# the page cache rather than being loaded into each worker.
+
+import os
+import numpy as np
+from Bio import SeqIO
+
+K = 15
+MAGIC = b'RNAitKMI'
+HEADER_SIZE = len(MAGIC) + 3 * 4
+
+# 2-bit base codes, with 4 marking bases (N etc) which can't be indexed
+base_codes = np.full(256, 4, dtype=np.uint8)
+for base, code in (('A', 0), ('C', 1), ('G', 2), ('T', 3)):
+    base_codes[ord(base)] = code
+    base_codes[ord(base.lower())] = code
+
+# loaded indexes by path, see load()
+indexes = {}
+
+# get_kmers
+#
+# Calculates the canonical k-mer at each position of a sequence
+#
+# required args: seq - sequence (string)
+#
+# returns: kmers - numpy uint32 array, one per position
+#          valid - numpy bool array, False for k-mers containing non-ACGT bases
+
+
+def get_kmers(seq):
+    n = len(seq) - K + 1
+    if n < 1:
+        return(np.zeros(0, dtype=np.uint32), np.zeros(0, dtype=bool))
+    codes = base_codes[np.frombuffer(str(seq).encode('ascii', 'replace'), dtype=np.uint8)]
+    windows = np.lib.stride_tricks.sliding_window_view(codes, K)
+    valid = windows.max(axis=1) < 4
+
+    powers = (4 ** np.arange(K - 1, -1, -1)).astype(np.uint32)
+    safe = np.where(codes < 4, codes, 0).astype(np.uint32)
+    safe_windows = np.lib.stride_tricks.sliding_window_view(safe, K)
+    forward = safe_windows.dot(powers).astype(np.uint32)
+    # reverse complement of each window: complement bases and reverse order
+    reverse = (3 - safe_windows[:, ::-1]).dot(powers).astype(np.uint32)
+    return(np.minimum(forward, reverse), valid)
+
+# build_index
+#
+# Builds a k-mer index from a fasta file
+#
+# required args: fasta - fasta file of database transcripts (string)
+#                index_path - index file to write (string)
+
+
+def build_index(fasta, index_path):
+    kmer_arrays = []
+    id_arrays = []
+    lengths = []
+    titles = []
+    for record in SeqIO.parse(fasta, 'fasta'):
+        kmers, valid = get_kmers(record.seq)
+        kmers = np.unique(kmers[valid])
+        kmer_arrays.append(kmers)
+        id_arrays.append(np.full(len(kmers), len(titles), dtype=np.uint32))
+        lengths.append(len(record.seq))
+        titles.append(record.description.replace('\n', ' '))
+
+    if kmer_arrays:
+        kmers = np.concatenate(kmer_arrays)
+        ids = np.concatenate(id_arrays)
+    else:
+        kmers = np.zeros(0, dtype=np.uint32)
+        ids = np.zeros(0, dtype=np.uint32)
+    order = np.lexsort((ids, kmers))
+
+    with open(index_path + '.tmp', 'wb') as fh:
+        fh.write(MAGIC)
+        fh.write(np.array([K, len(kmers), len(titles)], dtype=np.uint32).tobytes())
+        fh.write(kmers[order].tobytes())
+        fh.write(ids[order].tobytes())
+        fh.write(np.array(lengths, dtype=np.uint32).tobytes())
+        fh.write("\n".join(titles).encode('UTF-8'))
+    os.replace(index_path + '.tmp', index_path)
+
+# index_path
+#
+# Locates the index file for a blast database, which is written alongside the
+# blast indexes as <db>.kmi
+#
+# required args: db - blast database name (string)
+#
+# returns: path - string, None if there is no index
+
+
+def index_path(db):
+    db_paths = [db]
+    if os.environ.get('BLASTDB'):
+        db_paths.append(os.path.join(os.environ.get('BLASTDB'), db))
+    for db_path in db_paths:
+        if os.path.exists(db_path + '.kmi'):
+            return(db_path + '.kmi')
+    return(None)
+
+# load
+#
+# Opens the k-mer index for a blast database. Indexes are kept open for the
+# life of the process, and reopened if the file is rebuilt.
+#
+# required args: db - blast database name (string)
+#
+# returns: index - dictionary of 'kmers', 'ids', 'lengths' and 'titles', or
+#                  None if the database has no index
+
+
+def load(db):
+    path = index_path(db)
+    if path is None:
+        return(None)
+    mtime = os.path.getmtime(path)
+    index = indexes.get(path)
+    if index is not None and index.get('mtime') == mtime:
+        return(index)
+
+    with open(path, 'rb') as fh:
+        header = fh.read(HEADER_SIZE)
+    if header[:len(MAGIC)] != MAGIC:
+        return(None)
+    k, kmer_count, transcript_count = np.frombuffer(header[len(MAGIC):], dtype=np.uint32)
+    if k != K:
+        return(None)
+
+    offset = HEADER_SIZE
+    kmers = np.memmap(path, dtype=np.uint32, mode='r', offset=offset, shape=(kmer_count,)) \
+        if kmer_count else np.zeros(0, dtype=np.uint32)
+    offset += 4 * int(kmer_count)
+    ids = np.memmap(path, dtype=np.uint32, mode='r', offset=offset, shape=(kmer_count,)) \
+        if kmer_count else np.zeros(0, dtype=np.uint32)
+    offset += 4 * int(kmer_count)
+    with open(path, 'rb') as fh:
+        fh.seek(offset)
+        lengths = np.frombuffer(fh.read(4 * int(transcript_count)), dtype=np.uint32)
+        titles = fh.read().decode('UTF-8').split("\n")
+
+    index = {
+        'mtime': mtime,
+        'kmers': kmers,
+        'ids': ids,
+        'lengths': lengths,
+        'titles': titles,
+    }
+    indexes[path] = index
+    return(index)
+
+# screen
+#
+# Finds the transcripts sharing identical stretches of sequence with a product
+#
+# required args: index - index returned by load()
+#                seq - product sequence (string)
+#                min_length - minimum identical stretch to report (int)
+#
+# returns: shared - list of (transcript id, longest identical stretch)
+#                   tuples, longest first. Stretches are upper bounds, since
+#                   consecutive shared k-mers needn't be consecutive in the
+#                   transcript.
+
+
+def screen(index, seq, min_length):
+    kmers, valid = get_kmers(seq)
+    if len(kmers) == 0:
+        return([])
+
+    starts = np.searchsorted(index['kmers'], kmers, side='left')
+    ends = np.searchsorted(index['kmers'], kmers, side='right')
+    counts = np.where(valid, ends - starts, 0)
+    if counts.sum() == 0:
+        return([])
+
+    # (transcript id, query position) for every shared k-mer
+    positions = np.repeat(np.arange(len(kmers)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    ids = np.asarray(index['ids'])[np.repeat(starts, counts) + offsets]
+
+    order = np.lexsort((positions, ids))
+    ids = ids[order]
+    positions = positions[order]
+
+    # runs of consecutive positions within the same transcript
+    breaks = np.flatnonzero((np.diff(ids) != 0) | (np.diff(positions) != 1)) + 1
+    run_starts = np.concatenate(([0], breaks))
+    run_lengths = np.diff(np.concatenate((run_starts, [len(ids)])))
+
+    longest = {}
+    for run_start, run_length in zip(run_starts, run_lengths):
+        transcript = int(ids[run_start])
+        stretch = int(run_length) + K - 1
+        if stretch > longest.get(transcript, 0):
+            longest[transcript] = stretch
+
+    shared = [(transcript, stretch) for transcript, stretch in longest.items()
+              if stretch >= min_length]
+    shared.sort(key=lambda x: -x[1])
+    return(shared)
+
+# classify
+#
+# Classifies a product from its shared stretches
+#
+# required args: seq - product sequence (string)
+#                shared - list returned by screen()
+#                subunit_length - maximum permitted identical stretch (int)
+#
+# returns: status - 'unique' if at most one transcript shares a stretch of
+#                   the subunit length and that transcript contains the whole
+#                   product, 'bad' if a second transcript does, otherwise
+#                   'unknown'. Only 'unique' is certain to agree with blast.
+
+
+def classify(seq, shared, subunit_length):
+    shared = [s for s in shared if s[1] >= subunit_length]
+    if len(shared) == 0:
+        return('unique')
+    if len(shared) == 1 and shared[0][1] == len(seq):
+        return('unique')
+    if len(shared) > 1 and shared[1][1] > subunit_length:
+        return('bad')
+    return('unknown')
@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+
+# Request metrics: per-stage timings, counters and optional profiling
+#
+# Timings and counters are kept per process, labelled by stage, database etc,
+# and are also collected for the request in progress so each request can be
+# logged as a single JSON line. Requests are tracked through a context
+# variable, which code running work on other threads copies across (see
+# context()).
+#
+# Each uWSGI worker writes its totals to <metrics.dir>/<pid>.json at the end
+# of every request, and the metrics endpoint sums the files of all workers into
+# Prometheus text format. Totals from a worker which is restarted with the same
+# pid start again from zero, which Prometheus treats as a counter reset.
+#
+# With metrics.profile_rate set, that fraction of requests are run under
+# cProfile, and the profile written to metrics.profile_dir.
+
+import contextvars
+import cProfile
+import json
+import os
+import random
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# descriptions of each metric, in the order they are output
+metric_help = {
+    'rnait_requests_total': ('counter', 'Requests handled, by endpoint'),
+    'rnait_request_seconds': ('summary', 'Request wall time, by endpoint'),
+    'rnait_stage_seconds': ('summary', 'Wall time spent in each stage of a request'),
+    'rnait_primer_pairs_total': ('counter', 'Primer pair products screened, by status'),
+    'rnait_hits_total': ('counter', 'Blast hits listed, by category'),
+    'rnait_admissions_total': ('counter', 'Queries admitted or turned away as busy'),
+    'rnait_admission_wait_seconds': ('summary', 'Time queries waited for admission'),
+    'rnait_cache_lookups_total': ('counter', 'Lookups in the result and primer caches, atlas and k-mer index, by outcome'),
+    'rnait_primer3_searches_total': ('counter', 'primer3 designs made by a narrowed or a full search'),
+}
+
+# the 'metrics' section of the configuration, see configure()
+settings = {}
+
+totals = {}
+totals_lock = threading.Lock()
+
+current_request = contextvars.ContextVar('current_request', default=None)
+
+# span
+#
+# Times a stage of a request, e.g.
+#
+#   with metrics.span('primer3'):
+#       primers = primer3.bindings.designPrimers(...)
+#
+# required args: stage - stage name (string)
+#                labels - further labels (keyword arguments)
+
+
+@contextmanager
+def span(stage, **labels):
+    start = time.time()
+    try:
+        yield
+    finally:
+        elapsed = time.time() - start
+        observe('rnait_stage_seconds', elapsed, stage=stage, **labels)
+        request = current_request.get()
+        if request is not None:
+            with request['lock']:
+                request['stages'][stage] = request['stages'].get(stage, 0) + elapsed
+
+# count
+#
+# Increments a counter
+#
+# required args: name - metric name (string, see metric_help)
+#
+# optional args: value - amount to add (default 1)
+#                labels - labels (keyword arguments)
+
+
+def count(name, value=1, **labels):
+    add(name, labels, value)
+    request = current_request.get()
+    if request is not None:
+        key = name + ''.join('.%s' % labels[label] for label in sorted(labels))
+        with request['lock']:
+            request['counts'][key] = request['counts'].get(key, 0) + value
+
+# observe
+#
+# Records a timing in a summary metric
+#
+# required args: name - metric name (string, see metric_help)
+#                seconds - duration (float)
+#                labels - labels (keyword arguments)
+
+
+def observe(name, seconds, **labels):
+    add(name + '_sum', labels, seconds)
+    add(name + '_count', labels, 1)
+
+
+def add(name, labels, value):
+    key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+    with totals_lock:
+        totals[key] = totals.get(key, 0) + value
+
+# configure
+#
+# Applies the 'metrics' section of the configuration, called whenever the
+# configuration is loaded
+#
+# required args: metrics_config - dictionary of settings, or None
+
+
+def configure(metrics_config):
+    global settings
+    settings = metrics_config or {}
+
+# context
+#
+# Returns a function which runs its arguments in the current request context,
+# for submitting work to thread pools:
+#
+#   executor.submit(metrics.context(), function, *args)
+#
+# returns: run - function
+
+
+def context():
+    return(contextvars.copy_context().run)
+
+# start_request
+#
+# Starts tracking a request, and starts profiling it if it is sampled
+#
+# required args: endpoint - name of the endpoint handling the request (string)
+#
+# returns: request - dictionary of request state, passed to finish_request
+
+
+def start_request(endpoint):
+    request = {
+        'endpoint': endpoint,
+        'start': time.time(),
+        'stages': {},
+        'counts': {},
+        'lock': threading.Lock(),
+        'profile': None,
+    }
+    if random.random() < float(settings.get('profile_rate', 0)):
+        request['profile'] = cProfile.Profile()
+        request['profile'].enable()
+    request['token'] = current_request.set(request)
+    return(request)
+
+# finish_request
+#
+# Records the request's totals, logs it, saves any profile and writes this
+# worker's totals for the metrics endpoint
+#
+# required args: request - dictionary returned by start_request
+#
+# optional args: status - HTTP status line or error (string)
+
+
+def finish_request(request, status=None):
+    elapsed = time.time() - request['start']
+    if request['profile'] is not None:
+        request['profile'].disable()
+    try:
+        current_request.reset(request['token'])
+    except ValueError:
+        # finished from a different context, e.g. by the server after
+        # iterating a streamed response
+        current_request.set(None)
+
+    count('rnait_requests_total', endpoint=request['endpoint'])
+    observe('rnait_request_seconds', elapsed, endpoint=request['endpoint'])
+
+    if settings.get('log_requests'):
+        log = {
+            'time': round(request['start'], 3),
+            'pid': os.getpid(),
+            'endpoint': request['endpoint'],
+            'status': status,
+            'seconds': round(elapsed, 4),
+            'stages': {stage: round(seconds, 4) for stage, seconds in request['stages'].items()},
+            'counts': request['counts'],
+        }
+        sys.stderr.write(json.dumps(log) + "\n")
+
+    if request['profile'] is not None and settings.get('profile_dir'):
+        try:
+            os.makedirs(settings.get('profile_dir'), exist_ok=True)
+            request['profile'].dump_stats(os.path.join(
+                settings.get('profile_dir'), "%s_%s_%.0f.prof" % (
+                    request['endpoint'], os.getpid(), request['start'] * 1000)))
+        except OSError:
+            pass
+
+    if settings.get('dir'):
+        save(settings.get('dir'))
+
+# instrument_response
+#
+# Wraps a WSGI response so the request is finished once the response has been
+# sent, which for streamed responses is after the application has returned
+#
+# required args: request - dictionary returned by start_request
+#                response - WSGI response iterable
+#                status - function returning the response status (string)
+#
+# yields: response pieces
+
+
+def instrument_response(request, response, status):
+    try:
+        for piece in response:
+            yield piece
+    finally:
+        finish_request(request, status())
+
+# save
+#
+# Writes this process's totals for the metrics endpoint
+#
+# required args: metrics_dir - directory shared by all workers (string)
+
+
+def save(metrics_dir):
+    with totals_lock:
+        rows = [[name, list(labels), value] for (name, labels), value in totals.items()]
+    path = os.path.join(metrics_dir, "%s.json" % os.getpid())
+    try:
+        os.makedirs(metrics_dir, exist_ok=True)
+        with open(path + '.tmp', 'w') as fh:
+            json.dump(rows, fh)
+        os.replace(path + '.tmp', path)
+    except OSError:
+        # metrics shouldn't fail the request
+        pass
+
+# render
+#
+# Generates the Prometheus text exposition of the totals of all workers
+#
+# optional args: metrics_dir - directory shared by all workers (string), if
+#                              not given only this process's totals are shown
+#
+# returns: text - string
+
+
+def render(metrics_dir=None):
+    combined = {}
+    if metrics_dir and os.path.isdir(metrics_dir):
+        for file_name in os.listdir(metrics_dir):
+            if not file_name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(metrics_dir, file_name)) as fh:
+                    rows = json.load(fh)
+            except (OSError, ValueError):
+                continue
+            for name, labels, value in rows:
+                key = (name, tuple(tuple(label) for label in labels))
+                combined[key] = combined.get(key, 0) + value
+    else:
+        with totals_lock:
+            combined = dict(totals)
+
+    lines = []
+    for metric, (metric_type, description) in metric_help.items():
+        lines.append("# HELP %s %s" % (metric, description))
+        lines.append("# TYPE %s %s" % (metric, metric_type))
+        for (name, labels), value in sorted(combined.items()):
+            if name not in (metric, metric + '_sum', metric + '_count'):
+                continue
+            label_text = ','.join('%s="%s"' % (k, v.replace('\\', '\\\\').replace('"', '\\"'))
+                                  for k, v in labels)
+            if label_text:
+                lines.append("%s{%s} %s" % (name, label_text, value))
+            else:
+                lines.append("%s %s" % (name, value))
+    return("\n".join(lines) + "\n")
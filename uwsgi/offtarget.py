@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+# Off-target profile of a query
+#
+# Before primers are designed, the whole query is searched once against the
+# selected database. Each identical stretch of at least the subunit length
+# which it shares with a transcript other than its own (or with its own
+# transcript at another position, i.e. a repeat) is recorded, and the number
+# of stretches covering each base of the query makes up its off-target profile.
+#
+# A product containing the whole of such a stretch is classified 'Bad' by
+# classify_blast_record(), so primer3 can be limited to placing products within
+# the clean regions between stretches (see clean_regions). A product may
+# overlap a stretch by less than the subunit length without containing an
+# identical stretch of that length, so clean regions reach that far into their
+# neighbouring stretches.
+
+import re
+import numpy as np
+
+# get_runs
+#
+# Finds the off-target identical stretches in a blast search of the whole
+# query. The first single HSP covering nearly all of the query with >99%
+# identity is taken as the query's own transcript and skipped.
+#
+# required args: blast_record - Bio.Blast.Record.Blast of the query
+#                subunit_length - minimum identical stretch (int)
+#
+# returns: runs - list of [start, end] query positions of each stretch
+#                 (0-based, end exclusive)
+
+
+def get_runs(blast_record, subunit_length):
+    midline_regex = re.compile(r"\|{" + str(subunit_length) + r",}")
+    query_length = blast_record.query_letters
+    runs = []
+    self_found = False
+    for alignment in blast_record.alignments:
+        for hsp in alignment.hsps:
+            if not self_found and hsp.identities > 0.99 * hsp.align_length and \
+                    hsp.align_length >= 0.95 * query_length:
+                self_found = True
+                continue
+            for match in midline_regex.finditer(hsp.match):
+                # identical stretches contain no gaps, so only gaps before the
+                # stretch offset its query position
+                start = hsp.query_start - 1 + match.start() - \
+                    hsp.query.count('-', 0, match.start())
+                runs.append([start, start + match.end() - match.start()])
+    return(runs)
+
+# get_coverage
+#
+# required args: runs - list of [start, end] stretches (see get_runs)
+#                length - query length (int)
+#
+# returns: coverage - numpy int32 array of the number of stretches covering
+#                     each base of the query
+
+
+def get_coverage(runs, length):
+    delta = np.zeros(length + 1, dtype=np.int32)
+    if runs:
+        runs = np.clip(np.array(runs, dtype=np.int64), 0, length)
+        np.add.at(delta, runs[:, 0], 1)
+        np.add.at(delta, runs[:, 1], -1)
+    return(np.cumsum(delta[:-1], dtype=np.int32))
+
+# clean_regions
+#
+# Finds the regions of a query a product can lie in without containing an
+# off-target stretch
+#
+# required args: coverage - off-target profile (see get_coverage)
+#                subunit_length - minimum identical stretch (int)
+#                min_length - minimum product size (int)
+#
+# returns: regions - list of [start, end] regions (0-based, end exclusive) at
+#                    least min_length long
+
+
+def clean_regions(coverage, subunit_length, min_length):
+    bad = np.concatenate(([True], coverage > 0, [True]))
+    # changes between bad and clean bases alternate clean starts and ends
+    edges = np.flatnonzero(np.diff(bad.astype(np.int8)))
+    regions = []
+    for start, end in zip(edges[0::2], edges[1::2]):
+        start = max(int(start) - subunit_length + 1, 0)
+        end = min(int(end) + subunit_length - 1, len(coverage))
+        if end - start >= min_length:
+            regions.append([start, end])
+    return(regions)
+
+# get_bins
+#
+# Summarises a profile for drawing, as the highest coverage in each of a
+# number of equal bins
+#
+# required args: coverage - off-target profile (see get_coverage)
+#                bins - number of bins (int)
+#
+# returns: values - numpy array of the maximum coverage in each bin
+
+
+def get_bins(coverage, bins):
+    if len(coverage) == 0:
+        return(np.zeros(0, dtype=np.int32))
+    bins = min(bins, len(coverage))
+    edges = np.linspace(0, len(coverage), bins + 1).astype(np.int64)
+    return(np.maximum.reduceat(coverage, edges[:-1]))
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+
+# Content-addressed cache of classified PCR product blast results, also used
+# for primer3 designs (see design_key)
+#
+# Results are keyed on the blast database name and version, a hash of the
+# product sequence and the stringency/subunit length parameters used to
+# classify the hits. The database version is derived from the size and
+# modification time of the database files, so rebuilding a database with
+# bin/reformat_tritrypdb_fasta.py (which reruns makeblastdb) changes the key
+# and existing entries are no longer used.
+#
+# Entries are held in a size bounded in-memory LRU, and optionally in an
+# sqlite database which can be shared between uWSGI workers. Cached values are
+# stored as JSON, so must only contain plain dictionaries, lists and scalars.
+
+import glob
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import primer3
+
+# version of the cached blast_data layout (see screen_result.py), part of
+# every key so entries from older versions of RNAit are ignored
+RESULT_FORMAT = 3
+
+# database_version
+#
+# Derives a version string for a blast database from its files
+#
+# required args: db - blast database name, as passed to blastn (string)
+#
+# returns: version - string, empty if the database files can't be found
+
+
+def database_version(db):
+    db_paths = [db]
+    if os.environ.get('BLASTDB'):
+        db_paths.append(os.path.join(os.environ.get('BLASTDB'), db))
+
+    for db_path in db_paths:
+        # only this database's own files and volumes, not those of other
+        # databases whose names start with its name
+        db_files = sorted(glob.glob(db_path + '.n??') +
+                          glob.glob(db_path + '.[0-9][0-9].n??'))
+        if db_files:
+            stats = []
+            for db_file in db_files:
+                stat = os.stat(db_file)
+                stats.append("%s:%s:%s" % (
+                    os.path.basename(db_file), stat.st_size, stat.st_mtime_ns))
+            return(hashlib.sha1(";".join(stats).encode('UTF-8')).hexdigest())
+    return('')
+
+# result_key
+#
+# Generates a cache key for a classified blast result
+#
+# required args: db - blast database name (string)
+#                db_version - version from database_version() (string)
+#                seq - product sequence (string)
+#                string_min, string_max, subunit_length - classification
+#                parameters (int)
+#
+# returns: key - string
+
+
+def result_key(db, db_version, seq, string_min, string_max, subunit_length):
+    seq_hash = hashlib.sha256(seq.upper().encode('UTF-8')).hexdigest()
+    return("%s:%s:%s:%s:%s:%s:%s" % (RESULT_FORMAT, db, db_version, seq_hash,
+                                     string_min, string_max, subunit_length))
+
+# profile_key
+#
+# Generates the cache key for the off-target stretches of a query (see
+# offtarget.py)
+#
+# required args: db - blast database name (string)
+#                db_version - version from database_version() (string)
+#                seq - query sequence (string)
+#                subunit_length - minimum identical stretch (int)
+#
+# returns: key - string
+
+
+def profile_key(db, db_version, seq, subunit_length):
+    seq_hash = hashlib.sha256(seq.upper().encode('UTF-8')).hexdigest()
+    return("profile:%s:%s:%s:%s:%s" % (RESULT_FORMAT, db, db_version, seq_hash,
+                                       subunit_length))
+
+# design_key
+#
+# Generates the cache key for a primer3 design. The primer3 version is
+# included, since a new release may design different primers.
+#
+# required args: template - template sequence (string)
+#                global_args - dictionary of primer3 global arguments
+#
+# returns: key - string
+
+
+def design_key(template, global_args):
+    seq_hash = hashlib.sha256(template.encode('UTF-8')).hexdigest()
+    args = json.dumps(global_args, sort_keys=True, separators=(',', ':'))
+    return("primer3:%s:%s:%s" % (primer3.__version__, seq_hash, args))
+
+# template_key
+#
+# Generates the cache key for what is known of a template from its previous
+# designs (see get_primer_pairs)
+#
+# required args: template - template sequence (string)
+#
+# returns: key - string
+
+
+def template_key(template):
+    seq_hash = hashlib.sha256(template.encode('UTF-8')).hexdigest()
+    return("primer3_template:%s:%s" % (primer3.__version__, seq_hash))
+
+
+class ResultCache:
+    """In-memory LRU of results, backed by an optional shared sqlite store"""
+
+    def __init__(self, memory_entries=1024, disk_path=None, disk_entries=100000):
+        self.memory_entries = memory_entries
+        self.disk_entries = disk_entries
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.disk = None
+        if disk_path:
+            self.disk = sqlite3.connect(disk_path, timeout=10,
+                                        check_same_thread=False)
+            self.disk.execute('PRAGMA journal_mode=WAL')
+            self.disk.execute('CREATE TABLE IF NOT EXISTS results '
+                              '(key TEXT PRIMARY KEY, value TEXT, accessed REAL)')
+            self.disk.commit()
+
+    # get
+    #
+    # required args: key - cache key (string)
+    #
+    # returns: value or None if not cached. Values are shared between callers
+    #          so must not be modified
+
+    def get(self, key):
+        with self.lock:
+            value = self.memory.get(key)
+            if value is not None:
+                self.memory.move_to_end(key)
+                return(value)
+            if self.disk is None:
+                return(None)
+            try:
+                row = self.disk.execute(
+                    'SELECT value FROM results WHERE key=?', (key,)).fetchone()
+                if row is None:
+                    return(None)
+                self.disk.execute('UPDATE results SET accessed=? WHERE key=?',
+                                  (time.time(), key))
+                self.disk.commit()
+            except sqlite3.Error:
+                return(None)
+            value = json.loads(row[0])
+            self._remember(key, value)
+            return(value)
+
+    # put
+    #
+    # required args: key - cache key (string)
+    #                value - JSON serialisable value
+
+    def put(self, key, value):
+        with self.lock:
+            self._remember(key, value)
+            if self.disk is None:
+                return
+            try:
+                self.disk.execute('INSERT OR REPLACE INTO results VALUES (?,?,?)',
+                                  (key, json.dumps(value), time.time()))
+                self.disk.execute(
+                    'DELETE FROM results WHERE key IN (SELECT key FROM results '
+                    'ORDER BY accessed DESC LIMIT -1 OFFSET ?)', (self.disk_entries,))
+                self.disk.commit()
+            except sqlite3.Error:
+                # another worker holding the lock for too long shouldn't fail
+                # the request, we just lose this entry from the shared store
+                self.disk.rollback()
+
+    def _remember(self, key, value):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
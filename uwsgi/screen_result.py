@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+# Classified blast screens of pcr products
+#
+# The screen of each product is held from blast until the results page is
+# rendered, and may list hundreds of hits for a repeat-rich query, so it is
+# kept as the fixed-field classes below, holding only what the results page,
+# alignment store and JSON api use, rather than the blast record it was
+# classified from.
+#
+# Each class can be read as a mapping (get, [] and keys), so code written for
+# the dictionaries RNAit used previously works unchanged, and unset fields read
+# as missing keys. to_dict() gives the plain data stored in the result cache
+# and atlas, and from_dict() restores it.
+
+
+class Compact:
+    """Fixed-field record, read as a mapping"""
+
+    __slots__ = ()
+    # fields holding lists of other records, as {field: class}
+    nested = {}
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name))
+
+    def get(self, name, default=None):
+        value = getattr(self, name, None) if name in self.__slots__ else None
+        return(default if value is None else value)
+
+    def __getitem__(self, name):
+        value = self.get(name)
+        if value is None:
+            raise KeyError(name)
+        return(value)
+
+    def keys(self):
+        return([name for name in self.__slots__ if getattr(self, name) is not None])
+
+    def items(self):
+        return([(name, getattr(self, name)) for name in self.keys()])
+
+    # to_dict
+    #
+    # returns: data - dictionary of the fields which are set, with nested
+    #                 records also converted
+
+    def to_dict(self):
+        data = {}
+        for name in self.keys():
+            value = getattr(self, name)
+            if name in self.nested:
+                value = [item.to_dict() for item in value]
+            data[name] = value
+        return(data)
+
+    # from_dict
+    #
+    # required args: data - dictionary as produced by to_dict (keys which
+    #                       aren't fields are ignored)
+    #
+    # returns: record - instance of the class
+
+    @classmethod
+    def from_dict(cls, data):
+        record = cls(**data)
+        for name, item_class in cls.nested.items():
+            value = getattr(record, name)
+            if value is not None:
+                setattr(record, name, [item_class.from_dict(item) for item in value])
+        return(record)
+
+
+class Hsp(Compact):
+    """Fields of an hsp needed to display its alignment (see format_alignment)"""
+
+    __slots__ = ('score', 'bits', 'expect', 'query_start', 'sbjct_start',
+                 'align_length', 'query', 'match', 'sbjct')
+
+
+class Hit(Compact):
+    """Blast hit listed on the results page"""
+
+    __slots__ = ('accession', 'description', 'subj_length', 'status', 'reasons',
+                 'hsps', 'ident', 'hsp_alignments', 'hsp_hit_lengths')
+    nested = {'hsp_alignments': Hsp}
+
+
+class ScreenResult(Compact):
+    """Classified blast screen of a pcr product (see classify_blast_record)"""
+
+    __slots__ = ('primer_status', 'self_hits', 'self_alignments',
+                 'conflicting_alignments', 'matching_alignments', 'kmer_screened')
+    nested = {
+        'self_alignments': Hit,
+        'conflicting_alignments': Hit,
+        'matching_alignments': Hit,
+    }